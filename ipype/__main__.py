@@ -1,7 +1,10 @@
+import json
 import click
 from pathlib import Path
 from ipype.pipeline import IPypeApp, Pipeline
 from traitlets.config import Config
+from ipype.storage import OUTPUT_MODES
+from ipype.inprocess import KERNEL_BACKENDS
 
 
 @click.group(invoke_without_command=True)
@@ -16,11 +19,36 @@ def main(ctx, **args):
 @main.command(context_settings=dict(ignore_unknown_options=True,))
 @click.option('--pipeline', '-p', type=click.Path(exists=True))
 @click.option('--output_dir', '-o', type=click.Path(exists=False))
+@click.option('--output-mode', type=click.Choice(OUTPUT_MODES), default='files',
+              help='Write outputs as files, gzipped notebooks or one compressed archive.')
+@click.option('--only', multiple=True, help='Run only this notebook (name, stem or index); repeatable.')
+@click.option('--from', 'from_notebook', default='', help='Run from this notebook on.')
+@click.option('--until', 'until_notebook', default='', help='Run up to and including this notebook.')
+@click.option('--status-port', type=int, default=0, help='Serve the live run status as JSON on this local port.')
+@click.option('--profile', is_flag=True, help='Profile every cell with cProfile into results/profiles.')
+@click.option('--profile-memory', is_flag=True, help='With --profile, also trace allocations with tracemalloc.')
+@click.option('--defer-html', is_flag=True, help='Skip html during the run; use ipype render or ipype view.')
+@click.option('--kernel-backend', type=click.Choice(KERNEL_BACKENDS), default='subprocess',
+              help='Run trusted Python notebooks in this process instead of kernel subprocesses.')
+@click.option('--external-images', is_flag=True, help='Write report images once into html/assets/ instead of inlining them.')
+@click.option('--speculate', is_flag=True, help='Run the next notebook ahead with its previous inputs; kept if they still match.')
 @click.argument('cmdline_args', nargs=-1, type=click.UNPROCESSED)
-def run(pipeline, output_dir, **cmdline_args):
+def run(pipeline, output_dir, output_mode, only, from_notebook, until_notebook, status_port,
+        profile, profile_memory, defer_html, kernel_backend, external_images, speculate, **cmdline_args):
     c = Config()
     c.Pipeline.path = pipeline
     c.Pipeline.output_dir = output_dir
+    c.Pipeline.output_mode = output_mode
+    c.Pipeline.only = list(only)
+    c.Pipeline.from_notebook = from_notebook
+    c.Pipeline.until_notebook = until_notebook
+    c.Pipeline.status_port = status_port
+    c.Pipeline.profile = profile or profile_memory
+    c.Pipeline.profile_memory = profile_memory
+    c.Pipeline.defer_html = defer_html
+    c.Pipeline.kernel_backend = kernel_backend
+    c.Pipeline.external_images = external_images
+    c.Pipeline.speculate = speculate
     c.Pipeline.cmdline_args = cmdline_args['cmdline_args']
     app = IPypeApp(config=c)
     app.initialize()
@@ -31,6 +59,49 @@ def run(pipeline, output_dir, **cmdline_args):
     #pipeline.start()
     
 
+@main.command(context_settings=dict(ignore_unknown_options=True,))
+@click.option('--pipeline', '-p', type=click.Path(exists=True))
+@click.option('--output_dir', '-o', type=click.Path(exists=False))
+@click.argument('cmdline_args', nargs=-1, type=click.UNPROCESSED)
+def plan(pipeline, output_dir, **cmdline_args):
+    """Show which notebooks a run would execute or reuse, without running them."""
+    from ipype.planner import format_plan
+    
+    c = Config()
+    c.Pipeline.path = pipeline
+    c.Pipeline.output_dir = output_dir
+    c.Pipeline.cmdline_args = cmdline_args['cmdline_args']
+    app = IPypeApp(config=c)
+    app.initialize()
+    
+    print("Args: {}".format(dict(app.pipeline.config['Pipeline'].get('Args', {}))))
+    print(format_plan(app.pipeline.plan()))
+    
+
+@main.command(context_settings=dict(ignore_unknown_options=True,))
+@click.option('--pipeline', '-p', type=click.Path(exists=True))
+@click.option('--output_dir', '-o', type=click.Path(exists=False))
+@click.option('--debounce', type=float, default=1.0, help='Seconds without changes before a run starts.')
+@click.option('--poll', 'poll_interval', type=float, default=0.5, help='Seconds between checks for changes.')
+@click.option('--no-initial', is_flag=True, help='Do not first run the notebooks changed since the last run.')
+@click.argument('cmdline_args', nargs=-1, type=click.UNPROCESSED)
+def watch(pipeline, output_dir, debounce, poll_interval, no_initial, **cmdline_args):
+    """Re-run changed notebooks, and the notebooks downstream of them, whenever the pipeline changes."""
+    import logging
+    from ipype.watch import PipelineWatcher
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    
+    watcher = PipelineWatcher(pipeline, output_dir, cmdline_args['cmdline_args'],
+                              debounce=debounce, poll_interval=poll_interval)
+    print("Watching {}".format(str(watcher.path)))
+    
+    try:
+        watcher.watch(initial=not no_initial)
+    except KeyboardInterrupt:
+        pass
+
+
 @main.command()
 def rerun():
     
@@ -46,11 +117,192 @@ def rerun():
     c.Pipeline.path = pipeline_config['pipeline_dir']
     c.Pipeline.output_dir = output_dir
     c.Pipeline.cmdline_args = pipeline_config['cmdline_args']
+    c.Pipeline.output_mode = pipeline_config.get('output_mode', 'files')
+    c.Pipeline.defer_html = pipeline_config.get('defer_html', False)
+    c.Pipeline.kernel_backend = pipeline_config.get('kernel_backend', 'subprocess')
+    c.Pipeline.external_images = pipeline_config.get('external_images', False)
+    c.Pipeline.speculate = pipeline_config.get('speculate', False)
     
     app = IPypeApp(config=c)
     app.initialize()
     app.pipeline.start()
         
+
+@main.command()
+@click.argument('journals', nargs=-1, type=click.Path(exists=True))
+def compact(journals):
+    """Turn execution journals of crashed runs into executed notebooks."""
+    from ipype.journal import compact_journal
+    
+    for journal in journals:
+        print(compact_journal(journal))
+        
+
+@main.command()
+@click.argument('output_dirs', nargs=-1, type=click.Path(exists=True))
+@click.option('--quota', default=None, help='Evict least recently used artifacts until all fit in this size (e.g. 10G).')
+@click.option('--max-age', type=float, default=None, help='Evict artifacts unused for this many days.')
+@click.option('--keep-runs', type=int, default=1, help='Most recent runs whose referenced artifacts and notebooks are kept.')
+@click.option('--delete', is_flag=True, help='Delete the evicted artifacts (default: only report).')
+def gc(output_dirs, quota, max_age, keep_runs, delete):
+    """Report (and with --delete reclaim) the space of unreferenced run artifacts."""
+    from ipype.artifacts import plan_gc, apply_gc, format_gc_plan, parse_size, format_size
+    
+    gc_plan = plan_gc(output_dirs or ['.'], quota=parse_size(quota) if quota else None,
+                      max_age_days=max_age, keep_runs=keep_runs)
+    print(format_gc_plan(gc_plan))
+    
+    if delete:
+        print("Freed {}".format(format_size(apply_gc(gc_plan))))
+        
+
+
+@main.command()
+@click.argument('output_dir', default='.', type=click.Path(exists=True))
+@click.option('--force', is_flag=True, help='Render every report, even if unchanged.')
+@click.option('--external-images', is_flag=True, help='Write images once into html/assets/ instead of inlining them.')
+def render(output_dir, force, external_images):
+    """Render the executed notebooks of an output dir to html (after a --defer-html run)."""
+    from ipype.report import ReportRenderer, find_executed_notebooks
+    
+    renderer = ReportRenderer(output_dir, external_images=external_images)
+    entries = renderer.render_all(find_executed_notebooks(output_dir), title=Path(output_dir).absolute().name, force=force)
+    print("{} reports in {}".format(len(entries), str(renderer.html_dir)))
+
+
+@main.command()
+@click.argument('output_dir', default='.', type=click.Path(exists=True))
+@click.option('--port', type=int, default=8000, help='Local HTTP port to listen on.')
+@click.option('--external-images', is_flag=True, help='Write images once into html/assets/ instead of inlining them.')
+def view(output_dir, port, external_images):
+    """Browse the reports of an output dir, rendering each one when first opened."""
+    from ipype.viewer import ReportViewer
+    
+    server = ReportViewer(output_dir, external_images=external_images).serve(port)
+    print("Serving reports on http://127.0.0.1:{}/".format(port))
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+@main.command()
+@click.option('--port', type=int, default=None, help='Listen on this local HTTP port instead of a Unix socket; '
+              'clients need the token the service writes to a file only its user can read.')
+@click.option('--socket', 'socket_path', default=None, help='Unix socket to listen on (default service.sock in $XDG_RUNTIME_DIR/ipype '
+              'or ~/.cache/ipype).')
+@click.option('--concurrency', type=int, default=1, help='Pipelines run at the same time.')
+@click.option('--warm-kernels', type=int, default=1, help='Kernels kept started ahead of the notebooks.')
+@click.option('--kernel', 'kernel_name', default='python3', help='Kernel of the warm kernels.')
+@click.option('--max-finished-jobs', type=int, default=1000, help='Finished jobs kept for polling (oldest forgotten first).')
+def serve(port, socket_path, concurrency, warm_kernels, kernel_name, max_finished_jobs):
+    """Run pipelines submitted to a local job queue."""
+    from ipype.service import PipelineService, make_server, default_socket_path, default_token_path
+    
+    service = PipelineService(concurrency=concurrency, warm_kernels=warm_kernels, kernel_name=kernel_name,
+                              max_finished_jobs=max_finished_jobs)
+    server = make_server(service, port=port, socket_path=socket_path)
+    if port:
+        print("Serving ipype jobs on http://127.0.0.1:{}/jobs (token in {})".format(port, default_token_path(port)))
+    else:
+        print("Serving ipype jobs on {}".format(socket_path or default_socket_path()))
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+@main.command()
+@click.option('--notebooks', type=int, default=5, help='Notebooks in the benchmark pipeline.')
+@click.option('--cells', type=int, default=3, help='Cells per notebook.')
+@click.option('--repeat', type=int, default=3, help='Runs per kernel backend.')
+@click.option('--kernel-backend', 'kernel_backends', multiple=True, type=click.Choice(KERNEL_BACKENDS),
+              help='Benchmark only this kernel backend; repeatable.')
+def benchmark(notebooks, cells, repeat, kernel_backends):
+    """Time a pipeline of tiny notebooks with each kernel backend."""
+    from ipype.benchmark import run_benchmark, format_benchmark
+    
+    timings = run_benchmark(notebooks, cells, repeat, kernel_backends or KERNEL_BACKENDS)
+    print(format_benchmark(timings, notebooks))
+
+
+@main.command()
+@click.option('--iterations', type=int, default=200, help='Pipeline runs in this process.')
+@click.option('--notebooks', type=int, default=3, help='Notebooks in the synthetic pipeline.')
+@click.option('--cells', type=int, default=3, help='Cells per notebook.')
+@click.option('--warmup', type=int, default=10, help='Runs the growth of the last runs is compared to.')
+@click.option('--fail-every', type=int, default=0, help='Every n-th run fails in its last notebook (0: never).')
+@click.option('--kernel-backend', type=click.Choice(KERNEL_BACKENDS), default='subprocess')
+@click.option('--max-rss-growth', default=None, help='Allowed growth of the resident memory (default 64M).')
+@click.option('--max-fd-growth', type=int, default=None, help='Allowed growth of the open file descriptors (default 4).')
+@click.option('--max-thread-growth', type=int, default=None, help='Allowed growth of the threads (default 2).')
+@click.option('--max-child-growth', type=int, default=None, help='Allowed growth of the child processes (default 0).')
+@click.option('--csv', 'csv_path', type=click.Path(), default=None, help='Write every sample to this CSV file.')
+@click.option('--verbose', '-v', is_flag=True, help='Print every sample.')
+def soak(iterations, notebooks, cells, warmup, fail_every, kernel_backend, max_rss_growth, max_fd_growth,
+         max_thread_growth, max_child_growth, csv_path, verbose):
+    """Run a synthetic pipeline many times in one process and fail if its resources keep growing."""
+    from ipype.soak import run_soak, parse_thresholds, format_soak, format_sample, write_soak_csv
+    
+    thresholds = parse_thresholds(max_rss_growth, max_fd_growth, max_thread_growth, max_child_growth)
+    result = run_soak(iterations, notebooks, cells, warmup=warmup, fail_every=fail_every, thresholds=thresholds,
+                      kernel_backend=kernel_backend, on_sample=(lambda sample: print(format_sample(sample))) if verbose else None)
+    
+    if csv_path:
+        write_soak_csv(result, csv_path)
+    
+    print(format_soak(result))
+    if not result.ok:
+        raise SystemExit(1)
+
+
+def _service_client(port, socket_path):
+    from ipype.service import ServiceClient
+    return ServiceClient(port=port, socket_path=socket_path)
+
+
+@main.command(context_settings=dict(ignore_unknown_options=True,))
+@click.option('--pipeline', '-p', type=click.Path(exists=True))
+@click.option('--output_dir', '-o', type=click.Path(exists=False))
+@click.option('--output-mode', type=click.Choice(OUTPUT_MODES), default='files')
+@click.option('--priority', type=int, default=0, help='Jobs with a higher priority run first.')
+@click.option('--port', type=int, default=None)
+@click.option('--socket', 'socket_path', default=None)
+@click.argument('cmdline_args', nargs=-1, type=click.UNPROCESSED)
+def submit(pipeline, output_dir, output_mode, priority, port, socket_path, **cmdline_args):
+    """Submit a run to an ipype service."""
+    request = {'pipeline': pipeline,
+               'output_dir': output_dir,
+               'output_mode': output_mode,
+               'args': list(cmdline_args['cmdline_args'])}
+    
+    print(json.dumps(_service_client(port, socket_path).submit(request, priority), indent=1))
+
+
+@main.command()
+@click.argument('job_id', required=False)
+@click.option('--port', type=int, default=None)
+@click.option('--socket', 'socket_path', default=None)
+def jobs(job_id, port, socket_path):
+    """Show the jobs of an ipype service, or one job."""
+    client = _service_client(port, socket_path)
+    print(json.dumps(client.job(job_id) if job_id else client.jobs(), indent=1))
+
+
+@main.command()
+@click.argument('job_id')
+@click.option('--port', type=int, default=None)
+@click.option('--socket', 'socket_path', default=None)
+def cancel(job_id, port, socket_path):
+    """Cancel a queued or running job of an ipype service."""
+    print(json.dumps(_service_client(port, socket_path).cancel(job_id), indent=1))
+    
     
 if __name__ == "__main__":
     main()
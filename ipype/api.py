@@ -0,0 +1,170 @@
+import os
+import copy
+import hashlib
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+from nbformat.notebooknode import NotebookNode
+from traitlets.config import Config
+
+from ipype.preprocessors import IPypeExecutePreprocessor
+from ipype.notebook import open_notebook, notebook_node_to_html, get_notebook_declarations, gather_map_outputs
+from ipype.storage import OUTPUT_MODES, make_storage, notebook_to_bytes
+from ipype.pipeline import calibrate_pipeline_info, mark_notebook_started, mark_notebook_finished, \
+    continues_session, declared_kernel_backend, run_map_instances
+
+
+MEMORY = 'memory'
+
+
+class PipelineResult(object):
+    """Executed notebooks, harvested outputs and (optionally) html of an in-memory run."""
+
+    def __init__(self):
+        #notebook name -> executed NotebookNode, in pipeline order
+        self.notebooks = OrderedDict()
+        #notebook name -> pipeline_info['outputs']
+        self.notebook_outputs = OrderedDict()
+        #notebook name -> html, with html=True
+        self.html = OrderedDict()
+
+    @property
+    def outputs(self):
+        """Outputs of the last notebook, i.e. of the whole pipeline."""
+        if not self.notebook_outputs:
+            return {}
+        return next(reversed(self.notebook_outputs.values()))
+
+    def __repr__(self):
+        return "PipelineResult({})".format(list(self.notebooks))
+
+
+def _load_notebook(notebook, index):
+    #(name, NotebookNode) of a path, a NotebookNode or a (name, NotebookNode) pair
+    if isinstance(notebook, tuple):
+        name, nb = notebook
+        return name, copy.deepcopy(nb)
+    if isinstance(notebook, NotebookNode):
+        return "notebook_{}".format(index), copy.deepcopy(notebook)
+    return Path(str(notebook)).stem, open_notebook(notebook)
+
+
+def _calibrate(nb, pipeline_config, name, index, count, previous_name, inputs):
+    pipeline_info = copy.deepcopy(dict(pipeline_config['Pipeline']))
+    pipeline_info['pipeline_notebooks_count'] = count
+
+    return calibrate_pipeline_info(nb, pipeline_info, name + '.exec.ipynb', index, previous_name,
+                                   hashlib.md5(notebook_to_bytes(nb)).hexdigest(), inputs)
+
+
+def _execute(preprocessor, nb, cwd):
+    mark_notebook_started(nb['metadata']['pipeline_info'])
+    preprocessor.preprocess(nb, {'metadata': {'path': cwd}})
+    mark_notebook_finished(nb['metadata']['pipeline_info'])
+
+    return nb
+
+
+def run_pipeline(notebooks, args=None, outputs=MEMORY, output_dir=None, html=False,
+                 kernel_name='', kernel_backend='subprocess', cwd=None, timeout=-1, log=None, map_workers=0):
+    """Run notebooks as a pipeline and return a PipelineResult.
+
+    notebooks are paths, NotebookNodes or (name, NotebookNode) pairs; they are not
+    modified. args become pipeline_info['Args']. With outputs='memory' nothing is
+    written to disk; any other output mode ('files', 'gzip', 'zip', ...) also writes
+    the executed notebooks (and html) into output_dir, laid out like a command-line run.
+    Declared __session__s share a kernel and __map_over__ notebooks run one instance
+    per element, map_workers (default: one per cpu) at a time, like Pipeline does.
+    kernel_backend='inprocess' runs (trusted) Python notebooks in this interpreter
+    instead of kernel subprocesses.
+    """
+    if outputs != MEMORY and outputs not in OUTPUT_MODES:
+        raise Exception("Unknown outputs {}: use one of {}.".format(outputs, ", ".join([MEMORY] + OUTPUT_MODES)))
+
+    if outputs != MEMORY and output_dir is None:
+        raise Exception("outputs={} writes to disk and needs an output_dir.".format(outputs))
+
+    if outputs != MEMORY:
+        output_dir = Path(str(output_dir)).absolute()
+
+    cwd = str(cwd or output_dir or os.getcwd())
+
+    pipeline_config = Config()
+    pipeline_config['Pipeline']['Args'] = Config(args or {})
+    pipeline_config['Pipeline']['output_dir'] = str(output_dir or '')
+
+    def make_preprocessor():
+        preprocessor = IPypeExecutePreprocessor(timeout=timeout, kernel_name=kernel_name,
+                                                pipeline_config=pipeline_config)
+        preprocessor.log = log or logging.getLogger(__name__)
+        return preprocessor
+
+    entries = [_load_notebook(notebook, index) for index, notebook in enumerate(notebooks)]
+    declarations = [get_notebook_declarations(nb, name) for name, nb in entries]
+
+    result = PipelineResult()
+    inputs = {}
+    previous_name = None
+
+    def keep(name, nb):
+        result.notebooks[name] = nb
+        if storage is not None:
+            storage.write_notebook(nb, output_dir / 'exec_notebooks' / (name + '.exec.ipynb'))
+        if html:
+            result.html[name] = notebook_node_to_html(nb)
+            if storage is not None:
+                storage.write_text(output_dir / 'html' / (name + '.html'), result.html[name])
+
+    preprocessor = make_preprocessor()
+    #opened right before the try that closes it
+    storage = make_storage(output_dir, outputs) if outputs != MEMORY else None
+
+    try:
+        for index, (name, nb) in enumerate(entries):
+            map_over = declarations[index].get('__map_over__')
+
+            if map_over is None:
+                next_declarations = declarations[index + 1] if index + 1 < len(entries) else None
+                preprocessor.keep_kernel = continues_session(declarations[index], next_declarations)
+
+                if getattr(preprocessor, 'km', None) is None:
+                    preprocessor.kernel_backend = declared_kernel_backend(declarations[index], kernel_backend, name)
+                
+                _calibrate(nb, pipeline_config, name, index, len(entries), previous_name, inputs)
+                _execute(preprocessor, nb, cwd)
+                notebook_outputs = nb['metadata']['pipeline_info'].get('outputs', {})
+                keep(name, nb)
+            else:
+                def run_instance(map_index, map_count, instance_inputs):
+                    instance_name = "{}.{}".format(name, map_index)
+                    instance_nb = _calibrate(copy.deepcopy(nb), pipeline_config, instance_name, index,
+                                             len(entries), previous_name, instance_inputs)
+                    instance_nb['metadata']['pipeline_info'].update(map_over=map_over, map_index=map_index,
+                                                                    map_count=map_count)
+                    #every instance runs in its own kernel subprocess
+                    instance_preprocessor = make_preprocessor()
+                    try:
+                        _execute(instance_preprocessor, instance_nb, cwd)
+                    finally:
+                        instance_preprocessor.shutdown()
+                    return instance_name, instance_nb
+
+                instances = run_map_instances(name, inputs, map_over, run_instance, map_workers)
+
+                for instance_name, instance_nb in instances:
+                    keep(instance_name, instance_nb)
+                notebook_outputs = gather_map_outputs(inputs, [instance_nb['metadata']['pipeline_info'].get('outputs', {}) \
+                                                               for instance_name, instance_nb in instances],
+                                                      declarations[index].get('__outputs__'))
+
+            result.notebook_outputs[name] = notebook_outputs
+            inputs = notebook_outputs
+            previous_name = name
+    finally:
+        preprocessor.keep_kernel = False
+        preprocessor.shutdown()
+        if storage is not None:
+            storage.close()
+
+    return result
@@ -4,16 +4,20 @@ from io import StringIO
 
 from traitlets.config import Config
 from traitlets.config.manager import BaseJSONConfigManager
-from traitlets.traitlets import Bool, Unicode, List, Dict, Tuple, default
+from traitlets.traitlets import Bool, Int, Unicode, List, Dict, Tuple, default
 from nbconvert.nbconvertapp import NbConvertApp
 from nbconvert.exporters import export
 from nbconvert.writers import FilesWriter
+import nbformat
 
 
 
 from ipype.config import Pipeline
 from ipype.notebook import get_notebooks_in_zip, is_valid_notebook, \
-    export_notebook, open_notebook
+    export_notebook, open_notebook, ZipFileTuple
+from ipype.sources import SourceStore, default_source_store
+from ipype.report import HTMLRenderCache, write_html_index, render_digest
+from ipype.logs import LogPipeline
 
 class IPype(NbConvertApp):
     name = Unicode('ipype')
@@ -39,6 +43,9 @@ class IPype(NbConvertApp):
     classes = List([Pipeline])
     
     config_file = Unicode(u'', config=True, help="Load this config file")
+    defer_html = Bool(False, config=True, help="Skip the html export; render later with ipype render or ipype view")
+    log_max_bytes = Int(50 * 1024 * 1024, config=True, help="Rotate logs/pipeline.log beyond this size (0: never)")
+    log_backup_count = Int(5, config=True, help="Rotated log files kept")
     # config_file is reachable only with --MyApp.config_file=... or --help-all
     
     
@@ -75,26 +82,29 @@ class IPype(NbConvertApp):
             else:
                 raise Exception("Could not validate notebook")
 
-        _notebooks = [str(f) for f in filenames]
-        
-        #copy notebooks to pipeline subfolder
+        #link notebooks to pipeline subfolder from the content-addressed source store
         copied_notebooks = []
+        notebook_names = []
+        
+        for notebook in filenames:
+            if isinstance(notebook, ZipFileTuple):
+                notebook_names.append(notebook.member_info.filename)
+            else:
+                notebook_names.append(Path(notebook).name)
+        
+        source_store = SourceStore(default_source_store())
+        source_store.populate(pipeline_path, output_path / 'pipeline', (), notebook_names)
         
-        for notebook in _notebooks:
-            notebook_pth = Path(notebook)
-            from nbconvert.exporters import NotebookExporter
-            pipeline_writer = FilesWriter(build_directory=str(output_path / 'pipeline'))
-            pipeline_output, resources = export(NotebookExporter, notebook, resources={})
-            pipeline_writer.write(pipeline_output, resources, notebook_name=notebook_pth.stem)
-            copied_notebook_pth = output_path / 'pipeline' / notebook_pth.name
+        for notebook_name in notebook_names:
+            copied_notebook_pth = output_path / 'pipeline' / notebook_name
             assert copied_notebook_pth.exists()
             copied_notebooks.append(str(copied_notebook_pth.absolute()))
         
         self.notebooks = copied_notebooks
+        self.notebook_indices = {notebook: index for index, notebook in enumerate(self.notebooks)}
         
         #add it into the Pipeline metadata
         self.config.pipeline_notebooks = [nb for nb in self.notebooks]
-        self.config.executed_notebooks = []
      
     def _output_subdir(self, subdir):
         return str(self._output / subdir)
@@ -121,15 +131,32 @@ class IPype(NbConvertApp):
         logs_subdir.mkdir(exist_ok=True)
         pipeline_log_pth = logs_subdir / 'pipeline.log'
 
-        log_file_handler = logging.FileHandler(str(pipeline_log_pth))
-        log_file_handler.setLevel(logging.INFO)
+        #initialized again (e.g. for another output dir): replace, not add, the log file
+        self.close_logging()
+        
+        #written (and rotated) by a background thread
+        self._log_pipeline = LogPipeline(max_bytes=self.log_max_bytes, backup_count=self.log_backup_count)
         log_file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        log_file_handler.setFormatter(log_file_formatter)
+        log_file_handler = self._log_pipeline.handler(pipeline_log_pth, logging.INFO, log_file_formatter)
         self.log.addHandler(log_file_handler)
+        self._log_file_handler = log_file_handler
         
         self.log.info("Application logging was set up.") #log
 
 
+    def close_logging(self):
+        log_file_handler = getattr(self, '_log_file_handler', None)
+        if log_file_handler is not None:
+            self.log.removeHandler(log_file_handler)
+            log_file_handler.close()
+            self._log_file_handler = None
+        
+        log_pipeline = getattr(self, '_log_pipeline', None)
+        if log_pipeline is not None:
+            log_pipeline.close()
+            self._log_pipeline = None
+
+
     def write_json_config(self):
         self.log.debug("Call: IPype.write_json_config().") #log
         #save a config.json into the output dir
@@ -149,11 +176,21 @@ class IPype(NbConvertApp):
         
         #initialize notebooks ("that have been executed") as empty list
         self.executed_notebooks = []
+        self.last_executed_outputs = None
+        
+        self.html_render_cache = HTMLRenderCache(self._output_subdir('html'))
         
         #loop over the notebooks
         for notebook in self.notebooks:
             self.log.debug("Call: IPype.convert_single_notebook() for notebook: {}".format(notebook))
             self.convert_single_notebook(notebook)
+        
+        self.html_render_cache.save()
+        
+        #one index page linking all the reports
+        index_entries = [{'name': Path(notebook).stem, 'href': Path(notebook).stem + '.html'} \
+                         for notebook in self.notebooks]
+        write_html_index(self._output_subdir('html'), index_entries, title=self._path.name)
             
     
     def convert_single_notebook(self, notebook_filename, input_buffer=None):
@@ -183,15 +220,27 @@ class IPype(NbConvertApp):
         self.writers['exec_writer'].write(exec_output, resources, notebook_name=notebook_pth.with_suffix('.exec').name)
         executed_notebook_pth = exec_subdir / notebook_pth.with_suffix('.exec.ipynb').name
         self.executed_notebooks.append(str(executed_notebook_pth))
+        self.last_executed_outputs = resources.get('pipeline_outputs')
         ##############################################################
         
         #html
+        if self.defer_html:
+            return
+        
+        html_name = notebook_pth.stem + '.html'
+        #keyed like ReportRenderer: the raw bytes change with the start and finish times of every run
+        digest = render_digest(nbformat.reads(exec_output, as_version=4))
+        if self.html_render_cache.is_current(html_name, digest):
+            self.log.info("Skipping html export of {} (unchanged)".format(str(executed_notebook_pth))) #log
+            return
+        
         self.log.info("Exporting executed notebook {} to html..".format(str(executed_notebook_pth))) #log
         from ipype.exporters import HTMLExporter
         resources.update(output_subdir=str(self._output / 'html'), notebook_name=notebook_pth.stem)
         exec_output_filelike = StringIO(exec_output)
         html_output, resources = export(HTMLExporter, exec_output_filelike, resources=resources)
         self.writers['html_writer'].write(html_output, resources, notebook_name=notebook_pth.stem)
+        self.html_render_cache.update(html_name, digest, notebook=str(executed_notebook_pth))
         ##############################################################
         
         
@@ -208,7 +257,9 @@ class IPype(NbConvertApp):
                 'notebook_filename': str(notebook_pth),
                 'pipeline_dir': self._output_subdir('pipeline'),
                 'pipeline_notebooks': self.notebooks,
-                'executed_notebooks': self.executed_notebooks,
+                'notebook_index': self.notebook_indices.get(str(notebook_pth)),
+                'last_executed_notebook': self.executed_notebooks[-1] if self.executed_notebooks else None,
+                'last_executed_outputs': self.last_executed_outputs,
                 'pipeline_info': self.Pipeline.config,
                 }
 
@@ -0,0 +1,287 @@
+import os
+import re
+import json
+import time
+from pathlib import Path
+
+from ipype.journal import JOURNAL_SUFFIX
+from ipype.storage import bytes_to_notebook, find_output_archive, iter_archive_members, read_output_bytes
+
+
+#output subdirs holding artifacts that can be evicted
+ARTIFACT_SUBDIRS = ['data', 'results', 'tmp']
+#executed notebooks are evicted only from runs that are not retained
+CACHED_NOTEBOOKS_SUBDIR = 'exec_notebooks'
+
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(size):
+    """'500M', '10G', '1.5T' or a number of bytes."""
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    match = re.match(r'^\s*([\d.]+)\s*([KMGT]?)i?B?\s*$', str(size), re.IGNORECASE)
+    if match is None:
+        raise Exception("Invalid size {}: use e.g. 500M or 10G.".format(size))
+
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(size):
+    for unit in ['B', 'K', 'M', 'G']:
+        if abs(size) < 1024:
+            return "{:.1f}{}".format(size, unit) if unit != 'B' else "{}B".format(size)
+        size /= 1024.0
+    return "{:.1f}T".format(size)
+
+
+class Artifact(object):
+    """One file of a run's artifact subdirs."""
+
+    def __init__(self, path, run, subdir):
+        stat = path.stat()
+        self.path = path
+        self.run = run
+        self.subdir = subdir
+        self.size = stat.st_size
+        #atime is not updated on relatime/noatime mounts, the later of both is the last use
+        self.last_used = max(stat.st_atime, stat.st_mtime)
+        self.live = False
+
+    def __repr__(self):
+        return "Artifact({!r}, {})".format(str(self.path), format_size(self.size))
+
+
+def is_run_dir(path):
+    #not config.json alone: pipeline source dirs have one too, with bundled data/ and results/
+    return (path / CACHED_NOTEBOOKS_SUBDIR).is_dir() or (path / 'status.json').exists() \
+        or find_output_archive(path) is not None
+
+
+def find_run_dirs(paths, exclude=()):
+    """Output dirs of runs: the given dirs, or their subdirs for a dir of sweeps.
+
+    Dirs in exclude (e.g. the pipeline source dir) are never run dirs.
+    """
+    exclude = set(Path(str(pth)).resolve() for pth in exclude)
+    run_dirs = []
+
+    for path in paths:
+        path = Path(str(path)).absolute()
+        if path.resolve() in exclude:
+            continue
+        if is_run_dir(path):
+            run_dirs.append(path)
+        elif path.is_dir():
+            run_dirs.extend(sorted(sub for sub in path.iterdir() \
+                                   if sub.is_dir() and sub.resolve() not in exclude and is_run_dir(sub)))
+
+    return run_dirs
+
+
+def run_last_used(run_dir):
+    times = [pth.stat().st_mtime for pth in (run_dir / 'status.json', run_dir / 'config.json') if pth.exists()]
+    return max(times) if times else run_dir.stat().st_mtime
+
+
+def is_running(run_dir):
+    try:
+        with open(str(run_dir / 'status.json')) as f:
+            return json.load(f).get('state') == 'running'
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def _output_strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from _output_strings(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            yield from _output_strings(v)
+
+
+def executed_notebooks(run_dir):
+    exec_notebooks_dir = run_dir / CACHED_NOTEBOOKS_SUBDIR
+    if not exec_notebooks_dir.is_dir():
+        return []
+    return sorted(pth for pth in exec_notebooks_dir.iterdir() \
+                  if '.exec.ipynb' in pth.name and not pth.name.endswith(JOURNAL_SUFFIX))
+
+
+def executed_notebook_bytes(run_dir):
+    #executed notebooks of a run, as (gzipped) files or in its output archive
+    for exec_notebook in executed_notebooks(run_dir):
+        try:
+            yield read_output_bytes(exec_notebook)
+        except OSError:
+            continue
+
+    archive_pth = find_output_archive(run_dir)
+    if archive_pth is None:
+        return
+
+    #an unreadable archive fails the gc rather than having its references evicted
+    for name, data in iter_archive_members(archive_pth, CACHED_NOTEBOOKS_SUBDIR + '/'):
+        if '.exec.ipynb' in name and not name.endswith(JOURNAL_SUFFIX):
+            yield data
+
+
+def referenced_paths(run_dir):
+    """Paths named in the pipeline_info['outputs'] of a run's executed notebooks."""
+    references = set()
+
+    for data in executed_notebook_bytes(run_dir):
+        try:
+            outputs = bytes_to_notebook(data)['metadata'].get('pipeline_info', {}).get('outputs', {})
+        except Exception:
+            continue #unreadable notebooks reference nothing
+
+        for value in _output_strings(outputs):
+            if not value or len(value) > 4096 or '\n' in value:
+                continue
+            path = Path(value)
+            if not path.is_absolute():
+                path = run_dir / path
+            try:
+                if path.exists():
+                    references.add(path.resolve())
+            except OSError:
+                continue
+
+    return references
+
+
+def collect_artifacts(run_dir, subdirs):
+    artifacts = []
+
+    for subdir in subdirs:
+        for root, dirs, files in os.walk(str(run_dir / subdir)):
+            for name in files:
+                try:
+                    artifacts.append(Artifact(Path(root) / name, run_dir, subdir))
+                except FileNotFoundError:
+                    pass
+
+    return artifacts
+
+
+class GCPlan(object):
+    """Artifacts of a set of runs, which ones are live, and which ones to evict."""
+
+    def __init__(self, runs, retained, artifacts, evict):
+        self.runs = runs
+        self.retained = retained
+        self.artifacts = artifacts
+        self.evict = evict
+
+    @property
+    def total_size(self):
+        return sum(artifact.size for artifact in self.artifacts)
+
+    @property
+    def live_size(self):
+        return sum(artifact.size for artifact in self.artifacts if artifact.live)
+
+    @property
+    def reclaimable_size(self):
+        return self.total_size - self.live_size
+
+    @property
+    def evict_size(self):
+        return sum(artifact.size for artifact in self.evict)
+
+
+def plan_gc(paths, quota=None, max_age_days=None, keep_runs=1, now=None, exclude=()):
+    """Decide which artifacts to evict.
+
+    The keep_runs most recently used runs (and running ones) are retained: their
+    executed notebooks are kept and every artifact referenced by their outputs
+    is live. Unreferenced artifacts older than max_age_days are evicted, then
+    the least recently used ones until all artifacts fit in quota bytes.
+    Dirs in exclude are not collected.
+    """
+    now = time.time() if now is None else now
+
+    runs = sorted(find_run_dirs(paths, exclude), key=run_last_used, reverse=True)
+    retained = set(runs[:keep_runs]) | set(run for run in runs if is_running(run))
+
+    artifacts = []
+    references = set()
+
+    for run in runs:
+        subdirs = ARTIFACT_SUBDIRS if run in retained else ARTIFACT_SUBDIRS + [CACHED_NOTEBOOKS_SUBDIR]
+        artifacts.extend(collect_artifacts(run, subdirs))
+        if run in retained:
+            references.update(referenced_paths(run))
+
+    for artifact in artifacts:
+        path = artifact.path.resolve()
+        #a referenced dir keeps all the files below it
+        artifact.live = path in references or any(parent in references for parent in path.parents)
+
+    evictable = sorted((artifact for artifact in artifacts if not artifact.live), key=lambda artifact: artifact.last_used)
+
+    evict = []
+    if max_age_days is not None:
+        evict = [artifact for artifact in evictable if now - artifact.last_used > max_age_days * 86400]
+
+    if quota is not None:
+        evicted = set(id(artifact) for artifact in evict)
+        size = sum(artifact.size for artifact in artifacts) - sum(artifact.size for artifact in evict)
+        for artifact in evictable:
+            if size <= quota:
+                break
+            if id(artifact) not in evicted:
+                evict.append(artifact)
+                size -= artifact.size
+
+    return GCPlan(runs, retained, artifacts, evict)
+
+
+def apply_gc(gc_plan):
+    """Delete the evicted artifacts and the dirs they leave empty; returns the freed bytes."""
+    freed = 0
+    parents = set()
+
+    for artifact in gc_plan.evict:
+        try:
+            artifact.path.unlink()
+        except FileNotFoundError:
+            continue
+        freed += artifact.size
+        parents.add(artifact.path.parent)
+
+    for parent in sorted(parents, key=lambda pth: len(pth.parts), reverse=True):
+        while parent.name not in ARTIFACT_SUBDIRS + [CACHED_NOTEBOOKS_SUBDIR]:
+            try:
+                parent.rmdir()
+            except OSError:
+                break #not empty
+            parent = parent.parent
+
+    return freed
+
+
+def format_gc_plan(gc_plan):
+    lines = []
+
+    for run in gc_plan.runs:
+        run_artifacts = [artifact for artifact in gc_plan.artifacts if artifact.run == run]
+        run_evict = [artifact for artifact in gc_plan.evict if artifact.run == run]
+        lines.append("{:<9} {:>9} total {:>9} live {:>9} to evict  {}".format(
+            "retained" if run in gc_plan.retained else "expired",
+            format_size(sum(artifact.size for artifact in run_artifacts)),
+            format_size(sum(artifact.size for artifact in run_artifacts if artifact.live)),
+            format_size(sum(artifact.size for artifact in run_evict)),
+            str(run)))
+
+    lines.append("")
+    lines.append("{} runs, {} artifacts: {} total, {} live, {} reclaimable, {} to evict".format(
+        len(gc_plan.runs), len(gc_plan.artifacts), format_size(gc_plan.total_size),
+        format_size(gc_plan.live_size), format_size(gc_plan.reclaimable_size), format_size(gc_plan.evict_size)))
+
+    return "\n".join(lines)
@@ -0,0 +1,49 @@
+import time
+import statistics
+
+import nbformat
+
+from ipype.api import run_pipeline
+from ipype.inprocess import KERNEL_BACKENDS
+
+
+def benchmark_notebooks(notebooks=5, cells=3):
+    """A pipeline of tiny notebooks, each one passing a counter to the next."""
+    entries = []
+
+    for index in range(notebooks):
+        nb = nbformat.v4.new_notebook()
+        nb.cells.append(nbformat.v4.new_code_cell("count = pipeline_info['inputs'].get('count', 0)"))
+        for cell in range(cells):
+            nb.cells.append(nbformat.v4.new_code_cell("count = count + 1"))
+        nb.cells.append(nbformat.v4.new_code_cell("pipeline_info['outputs'] = {'count': count}"))
+        nb.metadata['kernelspec'] = {'name': 'python3', 'display_name': 'Python 3', 'language': 'python'}
+        entries.append(("notebook_{}".format(index), nb))
+
+    return entries
+
+
+def run_benchmark(notebooks=5, cells=3, repeat=3, kernel_backends=KERNEL_BACKENDS):
+    """Seconds of every in-memory run of the benchmark pipeline, per kernel backend."""
+    entries = benchmark_notebooks(notebooks, cells)
+    timings = {}
+
+    for kernel_backend in kernel_backends:
+        timings[kernel_backend] = []
+        for i in range(repeat):
+            started = time.perf_counter()
+            run_pipeline(entries, kernel_backend=kernel_backend)
+            timings[kernel_backend].append(time.perf_counter() - started)
+
+    return timings
+
+
+def format_benchmark(timings, notebooks):
+    lines = ["{:<12} {:>9} {:>9} {:>9} {:>12}".format("backend", "min", "median", "max", "per notebook")]
+
+    for kernel_backend, seconds in timings.items():
+        lines.append("{:<12} {:>8.3f}s {:>8.3f}s {:>8.3f}s {:>11.3f}s".format(
+            kernel_backend, min(seconds), statistics.median(seconds), max(seconds),
+            statistics.median(seconds) / max(1, notebooks)))
+
+    return "\n".join(lines)
@@ -1,3 +1,6 @@
+import json
+import zipfile
+from zipfile import is_zipfile
 from pathlib import Path
 import traitlets
 from traitlets.config import Config, Configurable
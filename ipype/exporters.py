@@ -1,16 +1,28 @@
 from pathlib import Path
-from traitlets import default
+from traitlets import default, Bool
 from nbconvert.exporters import HTMLExporter as BaseHTMLExporter
 from nbconvert.exporters import NotebookExporter
-from ipype.preprocessors import CalibratePipelineNotebookPreprocessor, ExecutePipelineNotebookPreprocessor, CustomJsCssPreprocessor
+from ipype.preprocessors import CalibratePipelineNotebookPreprocessor, ExecutePipelineNotebookPreprocessor, CustomJsCssPreprocessor, \
+ExternalImagesPreprocessor, AssetStore, ASSETS_SUBDIR
 
 class HTMLExporter(BaseHTMLExporter):
-    preprocessors = [CustomJsCssPreprocessor]
+    preprocessors = [CustomJsCssPreprocessor, ExternalImagesPreprocessor]
+    
+    external_images = Bool(False, help="Write image outputs as content-addressed files into <output_subdir>/assets/ "
+                           "instead of inlining them as base64").tag(config=True)
     
     @default('default_template_path')
     def _default_template_path_default(self):
         template_dir = Path(__loader__.path).parent / 'custom'
         return str(template_dir)
+    
+    def from_notebook_node(self, nb, resources=None, **kw):
+        resources = dict(resources or {})
+        
+        if self.external_images and resources.get('assets') is None and resources.get('output_subdir'):
+            resources['assets'] = AssetStore(Path(resources['output_subdir']) / ASSETS_SUBDIR)
+        
+        return super().from_notebook_node(nb, resources=resources, **kw)
 
     
  
@@ -0,0 +1,73 @@
+import os
+import threading
+
+
+KERNEL_BACKENDS = ['subprocess', 'inprocess']
+
+#an in-process kernel shares the interpreter (and the working dir) with ipype,
+#so one notebook at a time runs in it, in the output dir of its run; ipype itself
+#only uses absolute paths, and a service running concurrent jobs does not use it
+_lock = threading.RLock()
+_kernel = None
+_cwd = []
+
+
+def acquire_inprocess_kernel(cwd=None):
+    """The in-process kernel (km, kc) of this process, with an empty namespace.
+
+    Held by the calling notebook until release_inprocess_kernel. The kernel is
+    started once and reused: IPython's shell is a singleton per process anyway.
+    """
+    global _kernel
+
+    _lock.acquire()
+
+    try:
+        if _kernel is None:
+            from ipykernel.inprocess.manager import InProcessKernelManager
+
+            km = InProcessKernelManager()
+            km.start_kernel()
+            kc = km.client()
+            kc.start_channels()
+            kc.allow_stdin = False
+            _kernel = (km, kc)
+
+        km, kc = _kernel
+        km.kernel.shell.reset(new_session=False)
+
+        _cwd.append(os.getcwd())
+        if cwd is not None:
+            os.chdir(str(cwd))
+    except:
+        _lock.release()
+        raise
+
+    return km, kc
+
+
+def release_inprocess_kernel():
+    km, kc = _kernel
+
+    try:
+        #messages nobody waited for must not reach the next notebook
+        for channel in (kc.iopub_channel, kc.shell_channel):
+            while channel.msg_ready():
+                channel.get_msg(block=False)
+
+        km.kernel.shell.reset(new_session=False)
+        os.chdir(_cwd.pop())
+    finally:
+        _lock.release()
+
+
+def shutdown_inprocess_kernel():
+    global _kernel
+
+    with _lock:
+        if _kernel is None:
+            return
+        km, kc = _kernel
+        _kernel = None
+        kc.stop_channels()
+        km.shutdown_kernel()
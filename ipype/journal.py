@@ -0,0 +1,101 @@
+import os
+import json
+import time
+from pathlib import Path
+
+from nbformat.notebooknode import from_dict
+
+
+JOURNAL_SUFFIX = '.journal'
+
+
+def journal_path_for(notebook_exec_pth):
+    notebook_exec_pth = Path(str(notebook_exec_pth))
+    return notebook_exec_pth.with_name(notebook_exec_pth.name + JOURNAL_SUFFIX)
+
+
+class ExecutionJournal(object):
+    """Append-only sidecar of a notebook while it is being executed.
+
+    The first line holds the notebook as it was before execution, every
+    following line holds one executed cell. Each cell is written once, so the
+    cost stays linear in the size of the outputs. The file is flushed after
+    every cell and fsync'ed at most every fsync_interval seconds.
+    """
+
+    def __init__(self, path, fsync_interval=10.0):
+        self.path = Path(str(path))
+        self.fsync_interval = fsync_interval
+        self._f = None
+        self._last_fsync = 0
+
+    def _append(self, record):
+        self._f.write(json.dumps(record) + '\n')
+        self._f.flush()
+
+        now = time.time()
+        if now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._f.fileno())
+            self._last_fsync = now
+
+    #preprocessor observer interface
+    def notebook_started(self, nb, resources):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._f = open(str(self.path), 'w')
+        self._last_fsync = 0
+        self._append({'notebook': nb})
+
+    def cell_executed(self, cell, cell_index):
+        if self._f is not None:
+            self._append({'cell_index': cell_index, 'cell': cell})
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+def load_journal(journal_pth):
+    """Rebuild the (partially) executed notebook recorded in a journal."""
+    nb = None
+
+    with open(str(journal_pth)) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break #truncated last line of a crashed run
+
+            if 'notebook' in record:
+                nb = from_dict(record['notebook'])
+            elif nb is not None:
+                nb['cells'][record['cell_index']] = from_dict(record['cell'])
+
+    if nb is None:
+        raise ValueError("Empty execution journal: {}".format(str(journal_pth)))
+
+    #cells the crashed run never reached may lack the fields of an executed code cell
+    for cell in nb['cells']:
+        if cell.get('cell_type') == 'code':
+            cell.setdefault('outputs', [])
+            cell.setdefault('execution_count', None)
+
+    return nb
+
+
+def compact_journal(journal_pth, storage=None):
+    """Turn a journal into a valid .exec.ipynb notebook and remove the journal."""
+    journal_pth = Path(str(journal_pth))
+    notebook_exec_pth = journal_pth.with_name(journal_pth.name[:-len(JOURNAL_SUFFIX)])
+
+    nb = load_journal(journal_pth)
+    nb['metadata'].setdefault('pipeline_info', {})['incomplete'] = True
+
+    if storage is None:
+        from ipype.storage import FilesStorage
+        storage = FilesStorage(notebook_exec_pth.parent)
+
+    notebook_exec_pth = storage.write_notebook(nb, notebook_exec_pth)
+    journal_pth.unlink()
+
+    return notebook_exec_pth
@@ -0,0 +1,151 @@
+import copy
+import queue
+import logging
+import threading
+from pathlib import Path
+from logging.handlers import RotatingFileHandler
+
+
+#records written per batch, i.e. between two flushes
+BATCH_SIZE = 512
+
+_STOP = object()
+
+
+class BatchedFileHandler(RotatingFileHandler):
+    """A (rotating, with max_bytes) file handler whose writes are flushed per batch, by commit."""
+
+    def __init__(self, path, max_bytes=0, backup_count=0):
+        Path(str(path)).parent.mkdir(parents=True, exist_ok=True)
+        super().__init__(str(path), maxBytes=max_bytes, backupCount=backup_count, delay=True)
+
+    def flush(self):
+        pass #see commit
+
+    def commit(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+
+
+class QueueLogHandler(logging.Handler):
+    """Queues the records of a logger for a BatchedFileHandler, written by the LogPipeline thread."""
+
+    def __init__(self, log_pipeline, target):
+        super().__init__(target.level)
+        self.log_pipeline = log_pipeline
+        self.target = target
+
+    def prepare(self, record):
+        #the message is merged now: its args may change before the writer gets to it
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.log_pipeline.put(self.target, self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class LogPipeline(object):
+    """Log files written by one background thread, so that logging never blocks on disk I/O.
+
+    Records are queued by QueueLogHandlers (and by capture, for the lines of a
+    stream) and written in batches, with one flush per file and batch.
+    """
+
+    def __init__(self, max_bytes=0, backup_count=0, batch_size=BATCH_SIZE):
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        self._targets = {}
+        self._readers = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write, name='ipype-log-writer', daemon=True)
+        self._writer.start()
+
+    def _target(self, path, level=logging.NOTSET, formatter=None, rotate=True):
+        path = str(Path(str(path)).absolute())
+        with self._lock:
+            if path not in self._targets:
+                target = BatchedFileHandler(path, self.max_bytes if rotate else 0, self.backup_count)
+                target.setLevel(level)
+                target.setFormatter(formatter or logging.Formatter('%(message)s'))
+                self._targets[path] = target
+            return self._targets[path]
+
+    def handler(self, path, level=logging.NOTSET, formatter=None, rotate=True):
+        """A handler to add to a logger, for the log file at path."""
+        return QueueLogHandler(self, self._target(path, level, formatter, rotate))
+
+    def capture(self, stream, path, formatter=None):
+        """Log the lines of a binary stream (e.g. a kernel's stderr) to path until it is closed."""
+        target = self._target(path, formatter=formatter or logging.Formatter('%(asctime)s - %(message)s'))
+
+        def read():
+            with stream:
+                for line in iter(stream.readline, b''):
+                    record = logging.makeLogRecord({'msg': line.decode('utf-8', 'replace').rstrip('\n'),
+                                                    'levelno': logging.INFO, 'levelname': 'INFO'})
+                    self.put(target, record)
+
+        reader = threading.Thread(target=read, name='ipype-log-capture', daemon=True)
+        reader.start()
+        self._readers.append(reader)
+        return reader
+
+    def put(self, target, record):
+        if not self._closed:
+            self._queue.put((target, record))
+
+    def _write(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            written = set()
+            for item in batch:
+                if item is _STOP:
+                    continue
+                target, record = item
+                target.handle(record)
+                written.add(target)
+
+            for target in written:
+                try:
+                    target.commit()
+                except Exception:
+                    pass #e.g. a full disk: keep the writer alive
+
+            if any(item is _STOP for item in batch):
+                return
+
+    def close(self, timeout=1.0):
+        """Write the queued records and close the log files."""
+        if self._closed:
+            return
+
+        #lines still in the pipes of kernels that just exited
+        for reader in self._readers:
+            reader.join(timeout)
+
+        self._closed = True
+        self._queue.put(_STOP)
+        self._writer.join()
+
+        with self._lock:
+            for target in self._targets.values():
+                target.close()
+            self._targets = {}
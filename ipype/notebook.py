@@ -1,3 +1,5 @@
+import ast
+import logging
 from pathlib import Path
 from functools import reduce
 import zipfile
@@ -5,15 +7,16 @@ import hashlib
 from collections import namedtuple
 import nbformat
 from nbformat.reader import reads as reader_reads, NotJSONError
-from nbformat.validator import validate, ValidationError
+from nbformat.validator import ValidationError
 from nbconvert.preprocessors import ExecutePreprocessor
 
+from ipype.storage import read_output_bytes, bytes_to_notebook
+
 ZipFileTuple = namedtuple('ZipFileTuple', ['zipfile_path','member_info'])
 
 def open_notebook(notebook):
-
-    with open(str(notebook)) as f:
-        nb = nbformat.read(f, as_version=nbformat.current_nbformat)
+    #transparently reads .ipynb.gz files and notebooks inside output archives
+    nb = bytes_to_notebook(read_output_bytes(notebook))
     
     return nb
     
@@ -54,29 +57,98 @@ def execute_notebook(notebook_pth, notebook_out_pth, preprocessor_instance=Execu
     
     
 
+def notebook_node_to_html(nb, output_subdir=None, assets=None):
+    from ipype.exporters import HTMLExporter
+    
+    html_exporter = HTMLExporter()
+    #html_exporter.template_file = 'basic'
+    
+    #with an AssetStore, images are written to it and referenced by relative url
+    resources = {'output_subdir': output_subdir, 'assets': assets}
+    body, resources = html_exporter.from_notebook_node(nb, resources=resources)
+    
+    return body
+    
+
 def notebook_to_html(notebook_pth, notebook_out_pth):
     notebook_pth = Path(notebook_pth).absolute()
     notebook_out_pth = Path(notebook_out_pth).absolute()
     
-    notebook = str(notebook_pth)
     notebook_out = str(notebook_out_pth)
     
-    nb = None
-    
-    from ipype.exporters import HTMLExporter
-    
-    html_exporter = HTMLExporter()
-    #html_exporter.template_file = 'basic'
-    
-    with open(notebook) as f:
-        nb = nbformat.read(f, as_version=4)
+    nb = open_notebook(notebook_pth)
         
-    body, resources = html_exporter.from_notebook_node(nb)
+    body = notebook_node_to_html(nb, str(notebook_out_pth.parent))
     
     with open(notebook_out, 'w') as f:
         print(body, file=f)
     
 
+def read_notebook_source_bytes(notebook_file):
+    #a pipeline notebook is either a Path or a ZipFileTuple
+    if isinstance(notebook_file, ZipFileTuple):
+        with zipfile.ZipFile(str(notebook_file.zipfile_path), 'r') as zipped:
+            return zipped.read(notebook_file.member_info.filename)
+    
+    with open(str(notebook_file), 'rb') as f:
+        return f.read()
+
+
+def get_source_declarations(source, notebook_name=None):
+    """Literal dunder assignments (__inputs__, __outputs__...) of a cell source.
+    
+    The source is parsed, never executed: a declaration whose value is not a
+    literal (e.g. __outputs__ = ['a'] + extra) is skipped with a warning.
+    """
+    declarations = {}
+    
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return declarations
+    
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        for target in node.targets:
+            if isinstance(target, ast.Name) and target.id.startswith('__') and target.id.endswith('__'):
+                try:
+                    declarations[target.id] = ast.literal_eval(node.value)
+                except ValueError:
+                    logging.getLogger(__name__).warning("Skipping declaration {} of {}: not a literal value."\
+                                                        .format(target.id, notebook_name or "a notebook"))
+    
+    return declarations
+
+
+def get_notebook_declarations(nb, notebook_name=None):
+    #pipeline declarations live in the first cell of the notebook
+    if len(nb['cells']) == 0 or nb['cells'][0]['cell_type'] != 'code':
+        return {}
+    
+    return get_source_declarations(nb['cells'][0]['source'], notebook_name)
+
+
+def gather_map_outputs(inputs, instance_outputs, gathered_keys=None):
+    """Combine the outputs of the instances of a mapped notebook.
+    
+    Every gathered key becomes a list with one value per instance, in order.
+    When no keys are given, the keys an instance added or changed are gathered.
+    All other keys pass through from the inputs.
+    """
+    outputs = dict(inputs)
+    
+    if gathered_keys is None:
+        gathered_keys = set()
+        for outputs_ in instance_outputs:
+            gathered_keys.update(k for k, v in outputs_.items() if k not in inputs or inputs[k] != v)
+    
+    for k in gathered_keys:
+        outputs[k] = [outputs_.get(k) for outputs_ in instance_outputs]
+    
+    return outputs
+
+
 def get_notebooks_in_zip(zip_file, notebook_ext="ipynb"):
     notebooks = []
     
@@ -101,17 +173,18 @@ def extract_notebook_from_zip(zip_file, notebook_filename, output_dir):
         
 
 def is_valid_notebook(notebook_file):
-    with open(notebook_file) as myfile:
-        data = "".join(line for line in myfile)
+    from ipype.validation import notebook_digest, validate_notebook
+    
+    with open(str(notebook_file), 'rb') as f:
+        data = f.read()
     
     try:
-        nb = reader_reads(data)
-        validate(nb)
-        return True
-    except ValidationError as e:
-        return False
-    except NotJSONError as e:
+        nb = reader_reads(data.decode('utf-8'))
+    except (NotJSONError, ValidationError, UnicodeDecodeError):
         return False
+    
+    #cached by content digest, the schema is checked once per version of the notebook
+    return validate_notebook(nb, notebook_digest(data)) is None
         
 
 def get_notebook_pipeline_info(notebook_filename):
@@ -156,18 +229,26 @@ def calculate_notebook_node_hash(notebook_node):
         
         v = notebook_node[k]
         
+        md5.update(str(k).encode())
+        
         if isinstance(v, str):
             values = [v]
         elif isinstance(v, (list, tuple)):
             values = v
+        else:
+            values = [repr(v)]
         
         for val in values:
+            if not isinstance(val, str):
+                md5.update(repr(val).encode())
+                continue
+            
             p = Path(val)
             try:
                 val_to_byte = md5sum(p).encode()
             except IsADirectoryError as e:
                 val_to_byte = str(p).encode()
-            except FileNotFoundError as e:
+            except OSError as e: #not an existing file
                 val_to_byte = val.encode()
             
             md5.update(val_to_byte)
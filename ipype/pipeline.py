@@ -1,3 +1,4 @@
+import os
 import logging
 import zipfile
 import shutil
@@ -5,11 +6,12 @@ import io
 import copy
 from zipfile import is_zipfile
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import traitlets
-from traitlets.config import Configurable, Application
-from traitlets.config.loader import KeyValueConfigLoader
+from traitlets.config import Configurable, Application, Config
+from traitlets.config.loader import KeyValueConfigLoader, ConfigFileNotFound
 from traitlets.config.manager import BaseJSONConfigManager
 
 import nbformat
@@ -18,11 +20,119 @@ from nbconvert.exporters import Exporter
 
 from ipype.preprocessors import IPypeExecutePreprocessor
 from ipype.config import ZippedPipelineConfigLoader, DirPipelineConfigLoader
-from ipype.notebook import export_notebook, execute_notebook, notebook_to_html, \
-get_notebooks_in_zip, extract_notebook_from_zip, ZipFileTuple, is_valid_notebook
+from ipype.notebook import export_notebook, notebook_node_to_html, \
+get_notebooks_in_zip, extract_notebook_from_zip, ZipFileTuple, is_valid_notebook, \
+open_notebook, md5sum, get_notebook_declarations, calculate_notebook_node_hash, gather_map_outputs
+from ipype.report import ReportRenderer
+from ipype.inprocess import KERNEL_BACKENDS
+from ipype.storage import OUTPUT_MODES, make_storage, bytes_to_notebook
+from ipype.journal import JOURNAL_SUFFIX, ExecutionJournal, journal_path_for, compact_journal
+from ipype.planner import plan_pipeline
+from ipype.registry import RunRegistry, EXECUTED, RESTORED
+from ipype.status import StatusTracker
+from ipype.profiling import SUMMARY_FILENAME, write_profile_summary
+from ipype.sources import LINK_MODES, SourceStore, default_source_store
+from ipype.artifacts import plan_gc, apply_gc, parse_size, format_size
+from ipype.logs import LogPipeline
+from ipype.speculation import SPECULATIVE_SUBDIR, SNAPSHOT_SUBDIR, PROMOTED_SUBDIRS, Speculation, \
+    snapshot_inputs, relocate, promote_outputs
 
 
 
+def find_pipeline_notebooks(path, notebook_pattern="*.ipynb"):
+    """Source notebooks of a pipeline dir, zip or single notebook, in pipeline order."""
+    path = Path(str(path)).absolute()
+    
+    if path.is_dir():
+        return sorted(path.glob(notebook_pattern))
+    elif is_zipfile(str(path)):
+        return get_notebooks_in_zip(str(path))
+    elif path.is_file():
+        if is_valid_notebook(str(path)):
+            return [path] # list with one notebook
+        else:
+            raise Exception("Could not validate notebook")
+    
+    raise Exception("No pipeline at {}".format(str(path)))
+
+
+#shared by Pipeline and the in-memory ipype.api.run_pipeline
+
+def calibrate_pipeline_info(nb, pipeline_info, notebook_exec_name, notebook_index, previous_notebook,
+                            source_hash, inputs):
+    """Set the pipeline_info of a notebook about to be executed: the run's pipeline_info, its inputs
+    (the outputs of the previous notebook) and where it stands in the pipeline."""
+    if 'pipeline_info' not in nb['metadata']:
+        nb['metadata']['pipeline_info'] = pipeline_info
+    else: #assume it is a dict / dict-like
+        nb['metadata']['pipeline_info'].update(pipeline_info)
+    
+    nb['metadata']['pipeline_info']['notebook_filename'] = notebook_exec_name
+    nb['metadata']['pipeline_info']['notebook_name'] = notebook_exec_name.split(".exec.ipynb")[0]
+    nb['metadata']['pipeline_info']['notebook_index'] = notebook_index
+    nb['metadata']['pipeline_info']['source_hash'] = source_hash
+    nb['metadata']['pipeline_info']['previous_notebook'] = previous_notebook
+    
+    #inputs from previous notebook outputs (empty dict for the first notebook)
+    nb['metadata']['pipeline_info']['inputs'] = inputs
+    nb['metadata']['pipeline_info']['inputs_hash'] = calculate_notebook_node_hash(inputs)
+    
+    return nb
+
+
+def mark_notebook_started(pipeline_info):
+    notebook_started = datetime.now()
+    pipeline_info['notebook_started'] = notebook_started.isoformat()
+    pipeline_info['notebook_started_timestamp'] = notebook_started.timestamp()
+    return notebook_started
+
+
+def mark_notebook_finished(pipeline_info):
+    pipeline_info['outputs_hash'] = calculate_notebook_node_hash(pipeline_info.get('outputs', {}))
+    
+    notebook_finished = datetime.now()
+    pipeline_info['notebook_finished'] = notebook_finished.isoformat()
+    pipeline_info['notebook_finished_timestamp'] = notebook_finished.timestamp()
+    return notebook_finished
+
+
+def continues_session(declarations, next_declarations):
+    """Whether the kernel of a notebook stays alive for the next notebook of the pipeline."""
+    if next_declarations is None or '__map_over__' in next_declarations:
+        return False
+    
+    session = declarations.get('__session__')
+    return session is not None and session == next_declarations.get('__session__')
+
+
+def declared_kernel_backend(declarations, default, notebook_name):
+    kernel_backend = declarations.get('__kernel_backend__', default)
+    
+    if kernel_backend not in KERNEL_BACKENDS:
+        raise Exception("Notebook {} declares an unknown __kernel_backend__ {}: use one of {}."\
+                        .format(notebook_name, kernel_backend, ", ".join(KERNEL_BACKENDS)))
+    
+    return kernel_backend
+
+
+def run_map_instances(notebook_name, inputs, map_over, run_instance, max_workers=0):
+    """Call run_instance(map_index, map_count, instance_inputs) once per element of the
+    list-valued input map_over, max_workers (default: one per cpu) at a time; returns the results in order."""
+    items = inputs.get(map_over)
+    
+    if not isinstance(items, (list, tuple)):
+        raise Exception("Notebook {} maps over {}, which is not a list-valued input.".format(notebook_name, map_over))
+    
+    def run(map_index):
+        instance_inputs = copy.deepcopy(dict(inputs))
+        instance_inputs[map_over] = items[map_index]
+        return run_instance(map_index, len(items), instance_inputs)
+    
+    max_workers = max(1, min(max_workers or os.cpu_count() or 1, len(items)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run, range(len(items))))
+
+
 #class Pipeline(Configurable):
 class Pipeline(Exporter):
     requires = traitlets.List()
@@ -30,39 +140,107 @@ class Pipeline(Exporter):
     output_dir = traitlets.Unicode().tag(config=True)
     cmdline_args = traitlets.Tuple().tag(config=True)
     notebook_pattern = traitlets.Unicode("*.ipynb")
+    incremental_html = traitlets.Bool(True, help="Skip html export of executed notebooks "
+                                      "whose content is unchanged since the last render.").tag(config=True)
+    output_mode = traitlets.Enum(OUTPUT_MODES, default_value='files',
+                                 help="How output artifacts are written: separate files, "
+                                 "gzip-compressed notebooks, or one zip/tar.gz/tar.xz archive.").tag(config=True)
+    journal_cells = traitlets.Bool(True, help="Record every executed cell in an append-only "
+                                   ".exec.ipynb.journal sidecar while a notebook runs.").tag(config=True)
+    journal_fsync_interval = traitlets.Float(10.0, help="Minimum seconds between fsyncs "
+                                             "of the execution journal.").tag(config=True)
+    only = traitlets.List(traitlets.Unicode(), help="Run only these notebooks "
+                          "(file name, stem or index).").tag(config=True)
+    from_notebook = traitlets.Unicode('', help="Run from this notebook on.").tag(config=True)
+    until_notebook = traitlets.Unicode('', help="Run up to (and including) this notebook.").tag(config=True)
+    map_workers = traitlets.Int(0, help="Parallel instances of a __map_over__ notebook "
+                                "(0: one per CPU).").tag(config=True)
+    sessions = traitlets.Bool(True, help="Run consecutive notebooks declaring the same "
+                              "__session__ in one shared kernel.").tag(config=True)
+    status_interval = traitlets.Float(1.0, help="Minimum seconds between rewrites of "
+                                      "status.json.").tag(config=True)
+    status_port = traitlets.Int(0, help="Serve the live status as JSON on this local "
+                                "HTTP port (0: disabled).").tag(config=True)
+    profile = traitlets.Bool(False, help="Profile every cell in the kernel with cProfile and "
+                             "save results/profiles/<notebook>.pstats.").tag(config=True)
+    profile_memory = traitlets.Bool(False, help="Also trace allocations with tracemalloc "
+                                    "when profiling.").tag(config=True)
+    profile_top = traitlets.Int(30, help="Number of hotspots in the profile summaries.").tag(config=True)
+    stream_head_lines = traitlets.Int(0, help="Stream output lines kept from the start of each cell, the full stream "
+                                      "is written to logs/ (0 with stream_tail_lines 0: unbounded).").tag(config=True)
+    stream_tail_lines = traitlets.Int(0, help="Stream output lines kept from the end of each cell.").tag(config=True)
+    source_store = traitlets.Unicode('', help="Content-addressed store the pipeline sources are "
+                                     "linked from into pipeline/ ('': ~/.cache/ipype/sources).").tag(config=True)
+    source_link_mode = traitlets.Enum(LINK_MODES, default_value='hardlink',
+                                      help="How pipeline/ files are linked to the source store "
+                                      "(falling back to the next mode).").tag(config=True)
+    source_patterns = traitlets.List(traitlets.Unicode(), ['*.ipynb'],
+                                     help="Source files brought into pipeline/ (e.g. 'data/*' "
+                                     "for bundled data).").tag(config=True)
+    artifact_quota = traitlets.Unicode('', help="After a run, evict unreferenced artifacts of data/, results/ "
+                                       "and tmp/ (least recently used first) beyond this size, e.g. 10G.").tag(config=True)
+    artifact_max_age = traitlets.Float(0, help="After a run, evict unreferenced artifacts unused "
+                                       "for this many days (0: never).").tag(config=True)
+    kernel_backend = traitlets.Enum(KERNEL_BACKENDS, default_value='subprocess',
+                                    help="Run notebooks in kernel subprocesses, or trusted Python notebooks in "
+                                    "this interpreter ('inprocess'); a notebook can declare "
+                                    "__kernel_backend__ in its first cell.").tag(config=True)
+    external_images = traitlets.Bool(False, help="Write the images of the html reports once, as content-addressed "
+                                     "files in html/assets/, instead of inlining them in every report.").tag(config=True)
+    log_max_bytes = traitlets.Int(50 * 1024 * 1024, help="Rotate pipeline.log (and the kernel logs) "
+                                  "beyond this size (0: never).").tag(config=True)
+    log_backup_count = traitlets.Int(5, help="Rotated log files kept.").tag(config=True)
+    defer_html = traitlets.Bool(False, help="Skip the html export during the run; reports are rendered "
+                                "later by ipype render or on request by ipype view.").tag(config=True)
+    overlap_stages = traitlets.Bool(True, help="Start the kernel of the next notebook while a notebook runs, "
+                                    "and write and render executed notebooks in the background.").tag(config=True)
+    speculate = traitlets.Bool(False, help="While a notebook runs, run the next one with the inputs recorded by "
+                               "the previous run; its result is kept if its actual inputs match, "
+                               "otherwise it is run again.").tag(config=True)
     
     output_subdirs = traitlets.List(['data','exec_notebooks','html','logs','pipeline', 'results','tmp'])
     
     _preprocessors = traitlets.List(['ipype.preprocessors.IPypeExecutePreprocessor'])
+    
+    #warm kernels shared by the runs of an ipype service
+    kernel_pool = None
+    #set (e.g. by a service) to stop the run before its next notebook
+    cancelled = False
+    #unset (e.g. by a service running concurrent jobs) to run inprocess notebooks in kernel subprocesses
+    allow_inprocess = True
 
     def initialize(self):
+        #a copy: the pipeline records its notebooks and dirs in its config,
+        #which must not leak into the application or other pipelines
+        self.config = copy.deepcopy(self.config)
+        
         self._path = Path(self.path).absolute()
         self._output = Path(self.output_dir).absolute()
 
-        if self._path.is_dir():
-            self._notebooks = sorted(self._path.glob(self.notebook_pattern))
-        elif is_zipfile(str(self._path)):
-            self._notebooks = get_notebooks_in_zip(str(self._path))
-        elif self._path.is_file():
-            if is_valid_notebook(str(self._path)):
-                self._notebooks = [self._path] # list with one notebook
-            else:
-                raise Exception("Could not validate notebook")
+        self._notebooks = find_pipeline_notebooks(self._path, self.notebook_pattern)
 
+        self.init_logger()
+        
         self.init_configloader()
         
         self.init_preprocessor()
         
         
     def init_configloader(self):
+        pipeline_config = Config()
+        
         if self._path.is_dir():
             self.configloader = DirPipelineConfigLoader(str(self._path))
-            pipeline_config = self.configloader.load_config()
         elif is_zipfile(str(self._path)):
             self.configloader = ZippedPipelineConfigLoader(str(self._path))
-            pipeline_config = self.configloader.load_config()
         else:
-            pass
+            self.configloader = None
+        
+        if self.configloader is not None:
+            try:
+                pipeline_config = self.configloader.load_config()
+            except ConfigFileNotFound:
+                pass #pipeline without a config file
         
         kv_config_loader = KeyValueConfigLoader(self.cmdline_args)
         kv_config_loader.log.setLevel(logging.ERROR) #shut up the useless warnings
@@ -76,14 +254,32 @@ class Pipeline(Exporter):
         self.config['Pipeline']['pipeline_dir'] = str(self._output_subdir('pipeline'))
         
         
-    def init_preprocessor(self):
+    def _make_preprocessor(self):
         preprocessor = IPypeExecutePreprocessor(timeout=-1, pipeline_config=self.config)
-        preprocessor.log = self.parent.log
-        self.preprocessor = preprocessor
+        preprocessor.log = self.logger
+        preprocessor.kernel_pool = self.kernel_pool
+        if getattr(self, 'status', None) is not None:
+            preprocessor.observers.append(self.status)
+        preprocessor.stream_head_lines = self.stream_head_lines
+        preprocessor.stream_tail_lines = self.stream_tail_lines
+        preprocessor.stream_log_dir = str(self._output_subdir('logs'))
+        preprocessor.log_pipeline = getattr(self, 'log_pipeline', None)
+        if self.profile:
+            preprocessor.profile_dir = str(self._output_subdir('results') / 'profiles')
+            preprocessor.profile_memory = self.profile_memory
+            preprocessor.profile_top = self.profile_top
+        return preprocessor
+    
+    def init_preprocessor(self):
+        self.preprocessor = self._make_preprocessor()
     
     def _output_subdir(self, subdir):
         return (self._output / subdir)
     
+    def _exec_notebook_path(self, notebook_filename):
+        notebook_exec_name = Path(notebook_filename).with_suffix('.exec.ipynb').name
+        return self._output_subdir('exec_notebooks') / notebook_exec_name
+    
     def _make_output_dir(self):
         self._output.mkdir(exist_ok=True)
 
@@ -92,45 +288,90 @@ class Pipeline(Exporter):
             subdir_pth = self._output / subdir
             subdir_pth.mkdir(exist_ok=True)
     
-    def _setup_logging(self):
+    def init_storage(self):
+        self.storage = make_storage(self._output, self.output_mode)
+    
+    def init_status(self):
+        self.status = StatusTracker(self._output / 'status.json',
+                                    write_interval=self.status_interval, port=self.status_port)
+        self.preprocessor.observers.append(self.status)
+        
+        if self.status_port:
+            self.logger.info("Serving live status on http://127.0.0.1:{}/".format(self.status_port))
+    
+    def recover_journals(self):
+        #journals left behind by a crashed run become (incomplete) executed notebooks
+        for journal_pth in sorted(self._output_subdir('exec_notebooks').glob('*' + JOURNAL_SUFFIX)):
+            try:
+                notebook_exec_pth = compact_journal(journal_pth, self.storage)
+            except Exception as e:
+                self.logger.warning("Could not recover execution journal {}: {}".format(str(journal_pth), repr(e)))
+                continue
+            self.logger.info("Recovered partially executed notebook {}".format(str(notebook_exec_pth)))
+    
+    def init_logger(self):
+        #every run logs through its own logger, a child of the application log that is
+        #not registered with logging, so runs in one process never share file handlers
         try:
-            self.logger = self.log = self.parent.log
+            parent_log = self.parent.log
         except:
             print("error setting up logging")
-            self.logger = self.log = logging.getLogger(__name__)
+            parent_log = logging.getLogger(__name__)
         
+        self.logger = self.log = logging.Logger('{}.run{}'.format(parent_log.name, id(self)))
+        self.logger.parent = parent_log
         self.logger.setLevel(logging.INFO)
-
-        log_file_handler = logging.FileHandler(str(self._output / 'pipeline.log'))
-        log_file_handler.setLevel(logging.INFO)
-        self.logger.addHandler(log_file_handler)
-
-        timestamp_log_handler = logging.FileHandler(str(self._output_subdir('logs') / 'timestamps.log'))
+        self.log_handlers = []
+    
+    def _setup_logging(self):
+        #log files are written by a background thread, logging calls never wait for the disk
+        self.log_pipeline = LogPipeline(max_bytes=self.log_max_bytes, backup_count=self.log_backup_count)
+        
+        log_file_handler = self.log_pipeline.handler(self._output / 'pipeline.log', logging.INFO)
+        
         timestamp_formatter = logging.Formatter('%(asctime)s - %(message)s')
-        timestamp_log_handler.setFormatter(timestamp_formatter)
-        timestamp_log_handler.setLevel(logging.DEBUG)
-        self.logger.addHandler(timestamp_log_handler)
+        timestamp_log_handler = self.log_pipeline.handler(self._output_subdir('logs') / 'timestamps.log',
+                                                          logging.DEBUG, timestamp_formatter, rotate=False)
+        
+        for handler in (log_file_handler, timestamp_log_handler):
+            self.logger.addHandler(handler)
+            self.log_handlers.append(handler)
+        
+        #kernel stderr goes to logs/<notebook>.kernel.log
+        self.preprocessor.log_pipeline = self.log_pipeline
+    
+    def close_logging(self):
+        for handler in self.log_handlers:
+            self.logger.removeHandler(handler)
+            handler.close()
+        self.log_handlers = []
+        
+        if getattr(self, 'log_pipeline', None) is not None:
+            self.preprocessor.log_pipeline = None
+            self.log_pipeline.close()
+            self.log_pipeline = None
         
     
     def init_notebooks(self):
-        #copy "unexecuted" notebooks (to pipeline subdir)
+        #link the "unexecuted" notebooks (to pipeline subdir) from the source store,
+        #unchanged files are neither re-read nor stored twice
         self.extracted_notebooks = []
         
+        pipeline_subdir = self._output_subdir('pipeline')
+        source_store = SourceStore(self.source_store or default_source_store(), link_mode=self.source_link_mode)
+        
         for notebook_file in self._notebooks:
             if isinstance(notebook_file, ZipFileTuple):
                 zipfiletuple = notebook_file
-                extract_notebook_from_zip(str(zipfiletuple.zipfile_path), zipfiletuple.member_info.filename, self._output_subdir('pipeline'))
-                dst_notebook_pth = self._output_subdir('pipeline') / zipfiletuple.member_info.filename
-                self.extracted_notebooks.append(dst_notebook_pth)
-
-            elif isinstance(notebook_file, Path):
-                dst_notebook_pth = self._output_subdir('pipeline') / notebook_file.name
-                try:
-                    shutil.copy(str(notebook_file), str(dst_notebook_pth))
-                except shutil.SameFileError: #when the input pipeline_dir = output_dir
-                    pass #happy: do nothing
-                
-                self.extracted_notebooks.append(dst_notebook_pth)
+                dst_notebook_pth = pipeline_subdir / zipfiletuple.member_info.filename
+            else:
+                dst_notebook_pth = pipeline_subdir / notebook_file.name
+            
+            self.extracted_notebooks.append(dst_notebook_pth)
+        
+        notebook_names = [dst_notebook_pth.relative_to(pipeline_subdir).as_posix() \
+                          for dst_notebook_pth in self.extracted_notebooks]
+        source_store.populate(self._path, pipeline_subdir, list(self.source_patterns), notebook_names)
                 
 
         #list and set the notebooks (all extracted notebooks)
@@ -139,12 +380,8 @@ class Pipeline(Exporter):
         #add it into the Pipeline metadata
         self.config['Pipeline']['pipeline_notebooks'] = [str(nb) for nb in self.notebooks]
         
-        
-        #copy custom files
-        module_path = Path(__loader__.path).absolute().parent
-        custom_js = module_path / 'custom' / 'custom.js'
-        custom_css = module_path / 'custom' / 'custom.css'
-        shutil.copy(str(custom_js), str(self._output_subdir('html')))
+        #indexed in-memory records of the notebooks of this run
+        self.registry = RunRegistry(self.notebooks)
         
         
     
@@ -158,84 +395,214 @@ class Pipeline(Exporter):
         configmanager.set('config', self.config['Pipeline'])
     
     
-    def export_single_notebook(self, notebook_filename, resources=None, input_buffer=None):
+    def calibrate_notebook(self, nb, notebook_filename_pth, notebook_exec_pth, notebook_index, inputs):
+        notebook_exec_name = notebook_exec_pth.name
         
-        notebook_filename_pth = Path(notebook_filename)
-        notebook_exec_name = notebook_filename_pth.with_suffix('.exec.ipynb').name
-        notebook_exec_pth = self._output_subdir('exec_notebooks') / notebook_exec_name
+        #a copy, so that notebooks never share (and modify) the pipeline config;
+        #the notebook list is referenced through config.json instead of copied
+        pipeline_info_dict = copy.deepcopy({k: v for k, v in dict(self.config)['Pipeline'].items() \
+                                            if k != 'pipeline_notebooks'})
+        pipeline_info_dict['pipeline_config'] = str(self._output / 'config.json')
+        pipeline_info_dict['pipeline_notebooks_count'] = len(self.registry)
         
-        nb = None
-    
-        with open(str(notebook_filename_pth)) as f:
-            nb = nbformat.read(f, as_version=nbformat.current_nbformat)
-
-        resources = {'metadata': {'path': str(self._output)}}
+        previous_notebook = str(self.notebooks[notebook_index - 1]) if notebook_index > 0 else None
+        calibrate_pipeline_info(nb, pipeline_info_dict, notebook_exec_name, notebook_index, previous_notebook,
+                                md5sum(notebook_filename_pth), inputs)
+        nb['metadata']['pipeline_info']['notebook_path'] = str(notebook_exec_pth)
         
-        pipeline_info_dict = dict(self.config)['Pipeline']
+        return nb
+    
+    
+    def execute_notebook(self, nb, notebook_filename_pth, notebook_exec_pth, preprocessor=None, journal_cells=None,
+                         working_dir=None):
         
-        if 'pipeline_info' not in nb['metadata']:
-            nb['metadata']['pipeline_info'] = pipeline_info_dict
-        else: #assume it is a dict / dict-like
-            nb['metadata']['pipeline_info'].update(pipeline_info_dict)
-            
-        nb['metadata']['pipeline_info']['notebook_filename'] = notebook_exec_name
-        nb['metadata']['pipeline_info']['notebook_name'] = notebook_exec_name.split(".exec.ipynb")[0]
-        nb['metadata']['pipeline_info']['notebook_path'] = str(notebook_exec_pth)
-        nb['metadata']['pipeline_info']['notebook_index'] = notebook_index = self.notebooks.index(notebook_filename_pth)
+        if preprocessor is None:
+            preprocessor = self.preprocessor
+        if journal_cells is None:
+            journal_cells = self.journal_cells
         
-        if notebook_index == 0:
-            nb['metadata']['pipeline_info']['previous_notebook'] = None 
-            #set inputs to empty dict
-            nb['metadata']['pipeline_info']['inputs'] = {}
-            
-        else:
-            nb['metadata']['pipeline_info']['previous_notebook'] = str(self.notebooks[notebook_index - 1])
-            #set inputs from previous notebook outputs
-            nb['metadata']['pipeline_info']['inputs'] = self.get_last_exec_notebook_outputs()        
+        resources = {'metadata': {'path': str(working_dir or self._output)}}
         
-        notebook_started = datetime.now()
-        nb['metadata']['pipeline_info']['notebook_started'] = notebook_started.isoformat()
-        nb['metadata']['pipeline_info']['notebook_started_timestamp'] = notebook_started.timestamp()
+        mark_notebook_started(nb['metadata']['pipeline_info'])
 
 
-        self.logger.info("Starting to execute {}".format(str(notebook_filename_pth)))
+        self.logger.info("Starting to execute {}".format(str(notebook_exec_pth.name)))
         
-        self.preprocessor.preprocess(nb, resources)
+        journal = None
+        if journal_cells:
+            journal = ExecutionJournal(journal_path_for(notebook_exec_pth),
+                                       fsync_interval=self.journal_fsync_interval)
+            preprocessor.observers.append(journal)
         
-        notebook_finished = datetime.now()
-        nb['metadata']['pipeline_info']['notebook_finished'] = notebook_finished.isoformat()
-        nb['metadata']['pipeline_info']['notebook_finished_timestamp'] = notebook_finished.timestamp()
-        self.logger.info("Finished executing {} at {}".format(str(notebook_filename_pth), notebook_finished))
+        try:
+            preprocessor.preprocess(nb, resources)
+        except:
+            #no journal when the notebook failed before its first cell (e.g. kernel start)
+            if journal is not None and journal.path.exists():
+                journal.close()
+                #the execution error is re-raised below, a broken journal must not mask it
+                try:
+                    partial_pth = compact_journal(journal.path, self.storage)
+                except Exception as e:
+                    self.logger.warning("Could not write partially executed notebook from {}: {}"\
+                                        .format(str(journal.path), repr(e)))
+                else:
+                    self.logger.info("Wrote partially executed notebook {}".format(str(partial_pth)))
+            raise
+        finally:
+            if journal is not None:
+                journal.close()
+                preprocessor.observers.remove(journal)
+        
+        if 'profile_path' in resources:
+            self.profile_paths.append(resources['profile_path'])
+        
+        notebook_finished = mark_notebook_finished(nb['metadata']['pipeline_info'])
+        self.logger.info("Finished executing {} at {}".format(str(notebook_exec_pth.name), notebook_finished))
         
         return nb, resources
+    
+    
+    def export_single_notebook(self, notebook_filename, resources=None, input_buffer=None):
+        
+        notebook_filename_pth = Path(notebook_filename)
+        notebook_exec_pth = self._exec_notebook_path(notebook_filename_pth)
+        notebook_index = self.registry.index_of(notebook_filename_pth)
+        
+        nb = open_notebook(notebook_filename_pth)
+        
+        self.calibrate_notebook(nb, notebook_filename_pth, notebook_exec_pth, notebook_index,
+                                self.get_notebook_inputs(notebook_index))
+        
+        return self.execute_notebook(nb, notebook_filename_pth, notebook_exec_pth)
+    
+    
+    def write_exec_notebook(self, nb, notebook_exec_pth):
+        notebook_exec_pth_written = self.storage.write_notebook(nb, notebook_exec_pth)
+        
+        #the complete notebook is written, the journal is not needed anymore
+        try:
+            journal_path_for(notebook_exec_pth).unlink()
+        except FileNotFoundError:
+            pass
+        
+        return notebook_exec_pth_written
             
         
     def convert_single_notebook(self, notebook_filename, input_buffer=None):
         
         notebook_filename = Path(notebook_filename)
-        notebook_exec_name = notebook_filename.with_suffix('.exec.ipynb').name
-        notebook_exec_pth = self._output_subdir('exec_notebooks') / notebook_exec_name
+        record = self.registry.get(notebook_filename)
+        
+        self.registry.mark_running(record, datetime.now().isoformat())
+        try:
+            nb, resources = self.export_single_notebook(notebook_filename)
+        except:
+            self.registry.mark_failed(record)
+            raise
+        self.finish_single_notebook(notebook_filename, nb)
         
+        return nb, resources
+    
+    
+    def finish_single_notebook(self, notebook_filename, nb):
+        notebook_exec_pth = self._exec_notebook_path(notebook_filename)
         
-        nb, resources = self.export_single_notebook(notebook_filename)
+        #the next notebook takes its inputs from the registry, not from the written notebook
+        self.submit_stage(self.write_exec_notebook, nb, notebook_exec_pth)
+        notebook_exec_pth = self.storage.notebook_path(notebook_exec_pth)
+        self.exec_notebooks.append(notebook_exec_pth)
         
-        with io.open(str(notebook_exec_pth), 'wt', encoding='utf-8') as f:
-            nbformat.write(nb, f)
+        if self.stage_executor is not None and self.incremental_html and not self.storage.is_archive \
+                and not self.defer_html:
+            self.submit_stage(self.render_notebook_html, notebook_exec_pth)
         
+        pipeline_info = nb['metadata']['pipeline_info']
+        self.registry.mark_executed(self.registry.get(notebook_filename), notebook_exec_pth,
+                                    pipeline_info.get('outputs', {}), pipeline_info['notebook_finished'])
     
-        self.exec_notebooks.append(notebook_exec_pth)
     
-        return nb, resources
+    def convert_map_notebook(self, notebook_filename, declarations):
+        """Run one instance of a notebook per element of its __map_over__ input, in parallel."""
+        
+        notebook_filename_pth = Path(notebook_filename)
+        notebook_exec_pth = self._exec_notebook_path(notebook_filename_pth)
+        notebook_index = self.registry.index_of(notebook_filename_pth)
+        map_over = declarations['__map_over__']
+        
+        inputs = self.get_notebook_inputs(notebook_index)
+        
+        source_nb = open_notebook(notebook_filename_pth)
+        
+        def run_instance(map_index, map_count, instance_inputs):
+            instance_exec_pth = notebook_exec_pth.with_name("{}.{}.exec.ipynb".format(notebook_filename_pth.stem, map_index))
+            
+            nb = copy.deepcopy(source_nb)
+            self.calibrate_notebook(nb, notebook_filename_pth, instance_exec_pth, notebook_index, instance_inputs)
+            nb['metadata']['pipeline_info'].update(map_over=map_over, map_index=map_index, map_count=map_count)
+            
+            if self.cancelled:
+                raise Exception("Run cancelled.")
+            
+            #every instance runs in its own kernel, interrupted by cancel
+            preprocessor = self._make_preprocessor()
+            self.map_preprocessors.append(preprocessor)
+            try:
+                nb, resources = self.execute_notebook(nb, notebook_filename_pth, instance_exec_pth,
+                                                      preprocessor=preprocessor)
+            finally:
+                self.map_preprocessors.remove(preprocessor)
+            
+            return self.write_exec_notebook(nb, instance_exec_pth), nb['metadata']['pipeline_info'].get('outputs', {})
+        
+        notebook_started = datetime.now()
+        self.registry.mark_running(self.registry[notebook_index], notebook_started.isoformat())
+        
+        try:
+            instances = run_map_instances(str(notebook_filename_pth), inputs, map_over, run_instance, self.map_workers)
+        except:
+            self.registry.mark_failed(self.registry[notebook_index])
+            raise
+        
+        notebook_finished = datetime.now()
+        
+        instance_exec_pths = [instance_exec_pth for instance_exec_pth, instance_outputs in instances]
+        outputs = gather_map_outputs(inputs, [instance_outputs for instance_exec_pth, instance_outputs in instances],
+                                     declarations.get('__outputs__'))
+        
+        #a summary notebook carries the gathered outputs to the downstream notebooks
+        nb = nbformat.v4.new_notebook()
+        nb['cells'].append(nbformat.v4.new_markdown_cell(
+            "Mapped over `{}` ({} instances):\n\n".format(map_over, len(instances)) + \
+            "\n".join("- {}".format(Path(str(pth)).name) for pth in instance_exec_pths)))
+        
+        self.calibrate_notebook(nb, notebook_filename_pth, notebook_exec_pth, notebook_index, inputs)
+        pipeline_info = nb['metadata']['pipeline_info']
+        pipeline_info['map_over'] = map_over
+        pipeline_info['map_instances'] = [str(pth) for pth in instance_exec_pths]
+        pipeline_info['outputs'] = outputs
+        pipeline_info['outputs_hash'] = calculate_notebook_node_hash(outputs)
+        pipeline_info['notebook_started'] = notebook_started.isoformat()
+        pipeline_info['notebook_started_timestamp'] = notebook_started.timestamp()
+        pipeline_info['notebook_finished'] = notebook_finished.isoformat()
+        pipeline_info['notebook_finished_timestamp'] = notebook_finished.timestamp()
+        
+        notebook_exec_pth = self.write_exec_notebook(nb, notebook_exec_pth)
+        self.exec_notebooks.append(notebook_exec_pth)
+        self.registry.mark_executed(self.registry[notebook_index], notebook_exec_pth,
+                                    outputs, pipeline_info['notebook_finished'])
+        
+        return nb, {}
     
     
     def get_last_exec_notebook_outputs(self):
         
-        notebook_filename_pth = Path(self.exec_notebooks[-1])
+        #harvested outputs are cached in the registry
+        record = self.registry.last_executed
+        if record is not None and record.outputs is not None:
+            return record.outputs
         
-        nb = None
-    
-        with open(str(notebook_filename_pth)) as f:
-            nb = nbformat.read(f, as_version=nbformat.current_nbformat)
+        nb = self.storage.read_notebook(self.exec_notebooks[-1])
 
         try:
             return nb['metadata']['pipeline_info']['outputs']
@@ -243,17 +610,326 @@ class Pipeline(Exporter):
             return {}
     
     
+    def get_recorded_notebook_outputs(self, notebook_filename):
+        #outputs of a notebook executed by a previous run into the output dir
+        try:
+            nb = self.storage.read_notebook(self._exec_notebook_path(notebook_filename))
+        except FileNotFoundError:
+            raise Exception("No executed notebook of {} in {}: run it first."\
+                            .format(Path(notebook_filename).name, str(self._output)))
+        
+        return nb['metadata'].get('pipeline_info', {}).get('outputs', {})
+    
+    
+    def restore_notebook_outputs(self, record):
+        #the notebook is not part of this run: use the outputs recorded by a previous run
+        if record.status not in (EXECUTED, RESTORED):
+            self.logger.info("Restoring outputs of {} from a previous run".format(record.name))
+            self.registry.mark_restored(record, self._exec_notebook_path(record.source),
+                                        self.get_recorded_notebook_outputs(record.source))
+        
+        return record.outputs
+    
+    
+    def get_notebook_inputs(self, notebook_index):
+        if notebook_index == 0:
+            return {}
+        
+        record = self.registry[notebook_index - 1]
+        outputs = self.restore_notebook_outputs(record)
+        
+        if record.status == RESTORED:
+            #recorded outputs pass along values of notebooks re-executed in this run, use the fresh ones
+            outputs = dict(outputs, **self.get_fresh_outputs(notebook_index))
+        
+        return outputs
+    
+    
+    def get_fresh_outputs(self, notebook_index):
+        #declared __outputs__ of the notebooks executed in this run before notebook_index,
+        #unless a later notebook that was not executed declares them too
+        fresh = {}
+        
+        for record in self.registry.records[:notebook_index]:
+            declared = self.get_declarations(record.source).get('__outputs__', [])
+            for output in declared:
+                if record.status == EXECUTED and output in record.outputs:
+                    fresh[output] = record.outputs[output]
+                else:
+                    fresh.pop(output, None)
+        
+        return fresh
+    
+    
+    def write_profile_summary(self):
+        #top-N hotspots across all the notebooks profiled in this run
+        profile_dir = self._output_subdir('results') / 'profiles'
+        summary_pth = write_profile_summary(self.profile_paths, profile_dir / SUMMARY_FILENAME, top=self.profile_top)
+        if summary_pth is not None:
+            self.logger.info("Profile summary written to {}".format(str(summary_pth)))
+    
+    
+    def init_stages(self):
+        """Background worker for the stages that may overlap the execution of the next notebook.
+        
+        What may overlap:
+        - the kernel of notebook i+1 starts while notebook i runs, unless i+1 continues
+          the session of notebook i or is a __map_over__ notebook (which starts its own kernels)
+        - writing (and rendering to html) notebook i runs while notebook i+1 runs; notebook i+1
+          takes its inputs from the registry, never from the written notebook
+        Calibrating notebook i+1 needs the outputs of notebook i, so it does not overlap.
+        One worker keeps the writes and renders in pipeline order.
+        """
+        self.stage_futures = []
+        self.stage_executor = None
+        
+        if self.overlap_stages:
+            self.stage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ipype-stage')
+    
+    def submit_stage(self, fn, *args):
+        if self.stage_executor is None:
+            return fn(*args)
+        
+        self.stage_futures.append(self.stage_executor.submit(fn, *args))
+    
+    def check_stages(self):
+        #a failed background write fails the run before the next notebook starts
+        for future in self.stage_futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+    
+    def wait_stages(self):
+        if self.stage_executor is None:
+            return
+        
+        try:
+            for future in self.stage_futures:
+                future.result()
+        finally:
+            self.stage_futures = []
+            self.stage_executor.shutdown()
+            self.stage_executor = None
+    
+    def _next_kernel(self, index, next_index):
+        #(nb, resources) to prestart the kernel of the next notebook with, if it needs a new one
+        if next_index is None or self._continues_session(index, next_index):
+            return None
+        
+        next_notebook = self.notebooks[next_index]
+        if '__map_over__' in self.get_declarations(next_notebook) or self.get_kernel_backend(next_notebook) == 'inprocess':
+            return None
+        
+        return open_notebook(next_notebook), {'metadata': {'path': str(self._output)},
+                                              'notebook_name': Path(str(next_notebook)).stem}
+    
+    def collect_artifacts(self):
+        #artifacts referenced by the outputs of this run are never evicted, nor the files of
+        #the pipeline dir when it is the output dir
+        gc_plan = plan_gc([self._output], quota=parse_size(self.artifact_quota) if self.artifact_quota else None,
+                          max_age_days=self.artifact_max_age or None, exclude=[self._path])
+        
+        if gc_plan.evict:
+            freed = apply_gc(gc_plan)
+            self.logger.info("Evicted {} artifacts ({})".format(len(gc_plan.evict), format_size(freed)))
+    
+    def _speculation_inputs(self, index, next_index):
+        #inputs recorded by the previous run to speculatively run notebook next_index with
+        #while notebook index runs, or None if it cannot be run ahead
+        if not self.speculate or next_index != index + 1 or self._continues_session(index, next_index):
+            return None
+        
+        next_notebook = self.notebooks[next_index]
+        if '__map_over__' in self.get_declarations(next_notebook) or self.get_kernel_backend(next_notebook) != 'subprocess':
+            return None
+        
+        try:
+            nb = self.storage.read_notebook(self._exec_notebook_path(next_notebook))
+        except Exception:
+            return None #never executed (completely) into this output dir
+        
+        pipeline_info = nb['metadata'].get('pipeline_info', {})
+        if pipeline_info.get('incomplete', False) or 'inputs' not in pipeline_info:
+            return None
+        
+        return pipeline_info['inputs']
+    
+    def start_speculation(self, index, inputs):
+        """Run notebook index in the background with recorded inputs, see resolve_speculation.
+        
+        The run works in its own dir under tmp/speculative/, on copies of its input
+        files, so that it never reads files the running notebook is still writing
+        and never writes into the output dir before it is kept.
+        """
+        notebook_filename_pth = Path(self.notebooks[index])
+        notebook_exec_pth = self._exec_notebook_path(notebook_filename_pth)
+        
+        working_dir = self._output_subdir('tmp') / SPECULATIVE_SUBDIR / notebook_filename_pth.stem
+        shutil.rmtree(str(working_dir), ignore_errors=True)
+        
+        snapshot = snapshot_inputs(inputs, working_dir / SNAPSHOT_SUBDIR)
+        if snapshot is None:
+            shutil.rmtree(str(working_dir), ignore_errors=True)
+            return None #inputs referring to dirs are not copied
+        for subdir in PROMOTED_SUBDIRS:
+            (working_dir / subdir).mkdir(parents=True, exist_ok=True)
+        
+        nb = open_notebook(notebook_filename_pth)
+        self.calibrate_notebook(nb, notebook_filename_pth, notebook_exec_pth, index, snapshot)
+        nb['metadata']['pipeline_info']['output_dir'] = str(working_dir)
+        
+        self.logger.info("Speculatively executing {} with the inputs of the previous run".format(notebook_exec_pth.name))
+        
+        #not reported to the status until it is kept; no journal: a discarded run must not replace the recorded notebook
+        preprocessor = self._make_preprocessor()
+        if self.status in preprocessor.observers:
+            preprocessor.observers.remove(self.status)
+        preprocessor.stream_log_dir = str(working_dir / 'logs')
+        if preprocessor.profile_dir is not None:
+            preprocessor.profile_dir = str(working_dir / 'results' / 'profiles')
+        
+        future = self.speculation_executor.submit(self.execute_notebook, nb, notebook_filename_pth, notebook_exec_pth,
+                                                  preprocessor, False, working_dir)
+        
+        return Speculation(index, inputs, nb['metadata']['pipeline_info']['inputs_hash'], working_dir, preprocessor, future)
+    
+    def resolve_speculation(self, speculation):
+        """Keep the speculative run of a notebook if it ran with its actual inputs; returns whether it was kept.
+        
+        The actual inputs are compared with the recorded ones by value, and by hash
+        with the copies of the input files the run read, which covers files that
+        were rewritten (or still being written) when the run started.
+        """
+        notebook_filename = self.notebooks[speculation.index]
+        name = Path(str(notebook_filename)).stem
+        inputs = self.get_notebook_inputs(speculation.index)
+        
+        if inputs != speculation.inputs or calculate_notebook_node_hash(inputs) != speculation.inputs_hash:
+            self.logger.info("Discarding the speculative run of {}: its inputs changed".format(name))
+            self.cancel_speculation(speculation)
+            return False
+        
+        try:
+            nb, resources = speculation.future.result()
+        except Exception as e:
+            self.logger.info("Speculative run of {} failed, running it again: {}".format(name, e))
+            self.discard_speculation(speculation)
+            return False
+        
+        self.logger.info("Keeping the speculative run of {}".format(name))
+        
+        promote_outputs(speculation.working_dir, self._output)
+        pipeline_info = nb['metadata']['pipeline_info']
+        nb['metadata']['pipeline_info'] = pipeline_info = relocate(pipeline_info, speculation.working_dir, self._output)
+        pipeline_info['output_dir'] = self.config.Pipeline.output_dir
+        pipeline_info['inputs'] = inputs
+        pipeline_info['inputs_hash'] = calculate_notebook_node_hash(inputs)
+        self.profile_paths = relocate(self.profile_paths, speculation.working_dir, self._output)
+        shutil.rmtree(str(speculation.working_dir), ignore_errors=True)
+        
+        self.status.notebook_started(nb, resources)
+        self.status.notebook_finished(nb, resources)
+        self.finish_single_notebook(notebook_filename, nb)
+        return True
+    
+    def cancel_speculation(self, speculation):
+        speculation.preprocessor.cancelled = True
+        
+        km = getattr(speculation.preprocessor, 'km', None)
+        if km is not None:
+            km.interrupt_kernel()
+        
+        try:
+            speculation.future.result()
+        except Exception:
+            pass
+        
+        self.discard_speculation(speculation)
+    
+    def discard_speculation(self, speculation):
+        #nothing a discarded run wrote is left for the re-run to race with
+        working_dir = str(speculation.working_dir)
+        self.profile_paths = [pth for pth in self.profile_paths if not str(pth).startswith(working_dir)]
+        shutil.rmtree(working_dir, ignore_errors=True)
+    
+    def _continues_session(self, index, next_index):
+        #whether the kernel of notebook index stays alive for notebook next_index
+        if not self.sessions or next_index != index + 1:
+            return False
+        
+        return continues_session(self.get_declarations(self.notebooks[index]),
+                                 self.get_declarations(self.notebooks[next_index]))
+    
+    
+    def get_kernel_backend(self, notebook_filename):
+        #instances of a __map_over__ notebook run in parallel, always in kernel subprocesses
+        return declared_kernel_backend(self.get_declarations(notebook_filename), self.kernel_backend,
+                                       Path(str(notebook_filename)).name)
+    
+    def get_declarations(self, notebook_filename):
+        #parsed once per run
+        record = self.registry.get(notebook_filename)
+        if record.declarations is None:
+            record.declarations = get_notebook_declarations(open_notebook(record.source), record.name)
+        return record.declarations
+    
+    
+    def _resolve_notebook_selector(self, selector):
+        return self.registry.resolve(selector).index
+    
+    
+    def select_notebooks(self):
+        """Indices of the notebooks selected with only / from_notebook / until_notebook."""
+        first = 0
+        last = len(self.notebooks) - 1
+        
+        if self.from_notebook:
+            first = self._resolve_notebook_selector(self.from_notebook)
+        if self.until_notebook:
+            last = self._resolve_notebook_selector(self.until_notebook)
+        
+        selected = list(range(first, last + 1))
+        
+        if self.only:
+            only = set(self._resolve_notebook_selector(selector) for selector in self.only)
+            selected = [index for index in selected if index in only]
+        
+        if not selected:
+            raise Exception("No notebooks selected to run.")
+        
+        return selected
+    
+    
+    def verify_selection_integrity(self, selected):
+        #every declared input of a selected notebook must come either from a notebook
+        #run before it in this selection or from the restored outputs of a previous run
+        available = set([])
+        
+        for index in selected:
+            notebook_filename = self.notebooks[index]
+            
+            if index > 0 and (index - 1) not in selected:
+                available = set(self.restore_notebook_outputs(self.registry[index - 1]).keys())
+            
+            vars_dict = self.get_declarations(notebook_filename)
+            available.update(vars_dict.get('__outputs__', []))
+            
+            if index > 0:
+                for input_ in vars_dict.get('__inputs__', []):
+                    if input_ not in available:
+                        raise Exception("Pipeline integrity compromised: "\
+                                        "Notebook {} requires the input {}, which is neither "\
+                                        "produced by the selected notebooks nor recorded in {}."\
+                                        .format(str(notebook_filename), str(input_), str(self._output))
+                                        )
+    
+    
     def verify_pipeline_integrity(self):
         
-        vars_dict = {}
         outputs_prev = set([])
         
         for index, notebook_filename in enumerate(self.notebooks):
                     
-            with open(str(notebook_filename)) as f:
-                nb = nbformat.read(f, as_version=nbformat.current_nbformat)
-            
-            exec(nb['cells'][0]['source'], globals(), vars_dict)
+            vars_dict = self.get_declarations(notebook_filename)
             outputs_prev.update(vars_dict.get('__outputs__', []))
             
             if index > 0:
@@ -270,24 +946,104 @@ class Pipeline(Exporter):
             
                 
         
+    def _report_renderer(self):
+        #one renderer (and render cache) per run, shared by the background and the final renders
+        if getattr(self, 'report_renderer', None) is None:
+            self.report_renderer = ReportRenderer(self._output, storage=self.storage,
+                                                  incremental=self.incremental_html,
+                                                  external_images=self.external_images, log=self.logger)
+        return self.report_renderer
+    
+    def render_notebook_html(self, exec_notebook):
+        return self._report_renderer().render(exec_notebook)
+    
     def _convert_executed_notebooks_to_html(self, executed_notebooks):
-        for exec_notebook in self.exec_notebooks:
-            html_notebook_name = exec_notebook.name.split('.exec.ipynb')[0] + ".html"
-            html_notebook_pth = self._output_subdir('html') / html_notebook_name
-            notebook_to_html(exec_notebook, html_notebook_pth)
+        self._report_renderer().render_all(executed_notebooks, title=self._path.name)
     
     def convert_notebooks(self):
         
         self.verify_pipeline_integrity()
         
+        selected = self.select_notebooks()
+        self.verify_selection_integrity(selected)
+        
         self.exec_notebooks = []
+        self.profile_paths = []
+        self.map_preprocessors = []
+        self.report_renderer = None
+        self.init_stages()
+        
+        #the next notebook run ahead with recorded inputs, see start_speculation
+        speculation = None
+        self.speculation_executor = None
+        if self.speculate:
+            self.speculation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ipype-speculative')
+        
+        try:
+            for position, index in enumerate(selected):
+                self.check_stages()
+                
+                if self.cancelled:
+                    raise Exception("Run cancelled.")
+                
+                notebook_filename = self.notebooks[index]
+                declarations = self.get_declarations(notebook_filename)
+                next_index = selected[position + 1] if position + 1 < len(selected) else None
+                
+                if speculation is not None:
+                    kept = self.resolve_speculation(speculation)
+                    speculation = None
+                    if kept:
+                        continue
+                
+                speculative_inputs = self._speculation_inputs(index, next_index)
+                if speculative_inputs is not None:
+                    speculation = self.start_speculation(next_index, speculative_inputs)
+                
+                if self.stage_executor is not None:
+                    #a speculative run starts its own kernel
+                    self.preprocessor.prestart_next = None if speculation is not None else self._next_kernel(index, next_index)
+                
+                if '__map_over__' in declarations:
+                    nb, resources = self.convert_map_notebook(notebook_filename, declarations)
+                    
+                    #no kernel of the preprocessor was started to trigger the prestart
+                    if self.preprocessor.prestart_next is not None:
+                        self.preprocessor.prestart_kernel(*self.preprocessor.prestart_next)
+                        self.preprocessor.prestart_next = None
+                else:
+                    self.preprocessor.keep_kernel = self._continues_session(index, next_index)
+                    self.preprocessor.kernel_backend = self.get_kernel_backend(notebook_filename)
+                    if self.preprocessor.kernel_backend == 'inprocess' and not self.allow_inprocess:
+                        self.logger.warning("Other runs share this process, running {} in a kernel subprocess"\
+                                            .format(Path(str(notebook_filename)).name))
+                        self.preprocessor.kernel_backend = 'subprocess'
+                    nb, resources = self.convert_single_notebook(notebook_filename)
+        finally:
+            if speculation is not None:
+                self.cancel_speculation(speculation)
+            if self.speculation_executor is not None:
+                self.speculation_executor.shutdown()
+                self.speculation_executor = None
+            
+            self.preprocessor.keep_kernel = False
+            self.preprocessor.prestart_next = None
+            self.preprocessor.shutdown_kernel()
+            self.preprocessor.discard_prestarted_kernel()
+            
+            #executed notebooks are written even if a later notebook failed
+            self.wait_stages()
+        
+        if self.profile:
+            self.write_profile_summary()
         
-        for notebook_filename in self.notebooks:
-            nb, resources = self.calibrate_single_notebook(notebook_filename)
-            nb, resources = self.convert_single_notebook(notebook_filename)
+        #export notebooks (to html), including the ones executed by previous runs
+        if self.defer_html:
+            self.logger.info("Html export deferred: use ipype render or ipype view")
+            return
         
-        #export notebooks (to html)
-        self._convert_executed_notebooks_to_html(self.exec_notebooks)
+        self._convert_executed_notebooks_to_html([self._exec_notebook_path(notebook_filename) \
+                                                  for notebook_filename in self.notebooks])
         
     def run(self):
         output_path = self._output
@@ -297,9 +1053,29 @@ class Pipeline(Exporter):
         
         #make subdirs
         self._make_output_subdirs()
-
+        
         #setup logging
-        self._setup_logging()        
+        self._setup_logging()
+        
+        try:
+            self.run_notebooks()
+        finally:
+            #the run's handles are closed, so that many runs can share one process
+            self.preprocessor.shutdown()
+            self.close_logging()
+    
+    def run_notebooks(self):
+        #where executed notebooks and html are written
+        self.init_storage()
+        
+        try:
+            self._run_notebooks()
+        finally:
+            #also when the run failed before executing: no open archive or outputs.<fmt>.tmp is left
+            self.storage.close()
+    
+    def _run_notebooks(self):
+        self.recover_journals()
         
         #copy "unexecuted" notebooks (to pipeline subdir)
         self.init_notebooks()
@@ -308,14 +1084,53 @@ class Pipeline(Exporter):
         #the output dir
         self.init_config_json()
         
+        #live status (status.json, optional http endpoint)
+        self.init_status()
+        self.status.run_started([Path(str(notebook)).stem for notebook in self.notebooks])
+        
         #execute notebooks
-        self.convert_notebooks()
+        failed = True
+        try:
+            self.convert_notebooks()
+            failed = False
+            
+            if self.artifact_quota or self.artifact_max_age:
+                self.collect_artifacts()
+        finally:
+            #finalizes (renames into place) the output archive before the status reports the run finished
+            self.storage.close()
+            
+            self.status.run_finished(failed)
+            self.preprocessor.observers.remove(self.status)
+            self.status.close()
         
     
     def start(self):
         """Run start after initialization process has completed"""
         self.run()
     
+    def cancel(self):
+        """Stop the run: the running cells (of every mapped instance) are interrupted, no further cell starts."""
+        self.cancelled = True
+        
+        #the running notebook, or the running instances of a __map_over__ notebook
+        preprocessors = [getattr(self, 'preprocessor', None)] + list(getattr(self, 'map_preprocessors', []))
+        for preprocessor in preprocessors:
+            if preprocessor is None:
+                continue
+            preprocessor.cancelled = True
+            km = getattr(preprocessor, 'km', None)
+            if km is not None:
+                try:
+                    km.interrupt_kernel()
+                except NotImplementedError:
+                    pass #in-process kernels stop before their next cell
+    
+    def plan(self):
+        """Dry run: which notebooks would run and which of them are unchanged, without starting a kernel."""
+        #a run executes every notebook, unchanged ones included
+        return plan_pipeline(self._notebooks, self._output_subdir('exec_notebooks'), reuse=False)
+    
     
     
 class IPypeApp(Application):
@@ -0,0 +1,143 @@
+import hashlib
+from pathlib import Path
+
+from ipype.notebook import ZipFileTuple, open_notebook, read_notebook_source_bytes, \
+    get_notebook_declarations, calculate_notebook_node_hash
+from ipype.storage import bytes_to_notebook
+
+
+RUN = 'run'
+REUSE = 'reuse'
+
+
+class NotebookPlan(object):
+    """What a run would do with a single pipeline notebook."""
+
+    def __init__(self, index, name, action, reason, estimated_seconds=None):
+        self.index = index
+        self.name = name
+        self.action = action
+        self.reason = reason
+        self.estimated_seconds = estimated_seconds
+
+    def __repr__(self):
+        return "NotebookPlan({!r}, {!r}, {!r})".format(self.name, self.action, self.reason)
+
+
+def notebook_file_name(notebook_file):
+    if isinstance(notebook_file, ZipFileTuple):
+        return Path(notebook_file.member_info.filename).name
+    return Path(str(notebook_file)).name
+
+
+def recorded_duration(pipeline_info):
+    try:
+        return float(pipeline_info['notebook_finished_timestamp']) \
+            - float(pipeline_info['notebook_started_timestamp'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def check_recorded_run(source_hash, pipeline_info):
+    """Return the reason a notebook has to run again, or None if its last run can be reused."""
+    if pipeline_info.get('incomplete', False):
+        return "last run did not complete"
+
+    if pipeline_info.get('source_hash') != source_hash:
+        return "notebook changed"
+
+    if 'inputs_hash' not in pipeline_info or 'outputs_hash' not in pipeline_info:
+        return "no recorded hashes"
+
+    if calculate_notebook_node_hash(pipeline_info.get('inputs', {})) != pipeline_info['inputs_hash']:
+        return "inputs changed"
+
+    if calculate_notebook_node_hash(pipeline_info.get('outputs', {})) != pipeline_info['outputs_hash']:
+        return "outputs missing or modified"
+
+    return None
+
+
+def plan_pipeline(notebook_files, exec_notebooks_dir, reuse=True):
+    """Compare the pipeline notebooks with the executed notebooks of a previous run.
+
+    Nothing is executed: notebook declarations are parsed from the first cell
+    and the previous run is read from the executed notebooks' pipeline_info.
+    Without reuse (a pipeline run executes all its notebooks), unchanged
+    notebooks are planned to run too.
+    """
+    exec_notebooks_dir = Path(str(exec_notebooks_dir))
+
+    plans = []
+    producers = {} #output name -> index of the notebook declaring it
+
+    for index, notebook_file in enumerate(notebook_files):
+        name = notebook_file_name(notebook_file)
+        source_bytes = read_notebook_source_bytes(notebook_file)
+        source_hash = hashlib.md5(source_bytes).hexdigest()
+        declarations = get_notebook_declarations(bytes_to_notebook(source_bytes), name)
+
+        #notebooks whose outputs this notebook depends on
+        if '__inputs__' in declarations:
+            upstream = set(producers.get(input_) for input_ in declarations['__inputs__']) - {None}
+        else:
+            upstream = set(range(index))
+
+        for output in declarations.get('__outputs__', []):
+            producers[output] = index
+
+        exec_name = Path(name).with_suffix('.exec.ipynb').name
+
+        try:
+            pipeline_info = open_notebook(exec_notebooks_dir / exec_name)['metadata'].get('pipeline_info', {})
+        except FileNotFoundError:
+            plans.append(NotebookPlan(index, name, RUN, "no previous run"))
+            continue
+
+        estimated_seconds = recorded_duration(pipeline_info)
+
+        rerun_upstream = sorted(plans[i].name for i in upstream if plans[i].action == RUN)
+
+        if rerun_upstream:
+            reason = "upstream re-runs: {}".format(", ".join(rerun_upstream))
+        else:
+            reason = check_recorded_run(source_hash, pipeline_info)
+
+        if reason is None:
+            plans.append(NotebookPlan(index, name, REUSE, "unchanged", estimated_seconds))
+        else:
+            plans.append(NotebookPlan(index, name, RUN, reason, estimated_seconds))
+
+    if not reuse:
+        for plan in plans:
+            if plan.action == REUSE:
+                plan.action, plan.reason = RUN, "unchanged (will run)"
+
+    return plans
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+def format_plan(plans):
+    lines = []
+
+    for plan in plans:
+        lines.append("{:>4}  {:<6} {:>9}  {}  ({})".format(plan.index, plan.action,
+                                                            format_duration(plan.estimated_seconds),
+                                                            plan.name, plan.reason))
+
+    to_run = [plan for plan in plans if plan.action == RUN]
+    known = [plan.estimated_seconds for plan in to_run if plan.estimated_seconds is not None]
+
+    lines.append("")
+    lines.append("{} to run, {} to reuse; estimated time {}{}".format(
+        len(to_run), len(plans) - len(to_run), format_duration(sum(known)),
+        "" if len(known) == len(to_run) else " (+{} without previous timings)".format(len(to_run) - len(known))))
+
+    return "\n".join(lines)
@@ -1,17 +1,25 @@
 import os
+import base64
+import subprocess
 import pprint
 import json
 import shutil
 from datetime import datetime
 from pathlib import Path
 from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
 
 from traitlets.config import Config
 from nbconvert.preprocessors import Preprocessor
 from nbconvert.preprocessors.execute import ExecutePreprocessor, CellExecutionError
 from nbformat.notebooknode import NotebookNode
+from nbformat.v4 import new_code_cell
 
 from .notebook import get_notebook_pipeline_outputs
+from .report import copy_static_assets, AssetStore, ASSETS_SUBDIR
+from .profiling import is_python_notebook, start_profiling, collect_profile
+from .streams import StreamBuffer
+from .inprocess import acquire_inprocess_kernel, release_inprocess_kernel
 
 
 CELLL_EXEC_ERR_MSG = \
@@ -45,26 +53,139 @@ class IPypeExecutePreprocessor(ExecutePreprocessor):
     timeout = -1
     pipeline_config = Config()
     expose_env_variables = False
+    keep_kernel = False
+    #with a profile_dir, every cell runs under cProfile (and tracemalloc with profile_memory)
+    profile_dir = None
+    profile_memory = False
+    profile_top = 30
+    #stream outputs are coalesced and bounded to their first head and last tail lines per cell,
+    #the full stream goes to <stream_log_dir>/<notebook>.cell<index>.<stream>.log (0: unbounded)
+    stream_head_lines = 0
+    stream_tail_lines = 0
+    stream_log_dir = None
+    #(nb, resources) of the next notebook, whose kernel is started once this notebook's kernel is up
+    prestart_next = None
+    #warm kernels of a long-running service, see ipype.service.KernelPool
+    kernel_pool = None
+    #'subprocess', or 'inprocess' to run (trusted) Python notebooks in this interpreter
+    kernel_backend = 'subprocess'
+    #with an ipype.logs.LogPipeline, kernel stderr is logged to <stream_log_dir>/<notebook>.kernel.log
+    log_pipeline = None
+    #set to stop a (speculative) run before its next cell
+    cancelled = False
     
-    def preprocess(self, nb, resources):
-        
+    def __init__(self, pipeline_config=None, **kwargs):
+        super().__init__(**kwargs)
+        #a plain attribute, not a trait: traitlets does not set unknown constructor arguments
+        if pipeline_config is not None:
+            self.pipeline_config = pipeline_config
+        #objects notified with notebook_started(nb, resources), cell_executed(cell, cell_index),
+        #notebook_failed(nb, resources) and notebook_finished(nb, resources)
+        self.observers = []
+        #(kernel spec, future of (km, kc)) of a kernel started ahead of the next notebook
+        self._prestarted = None
+        self._prestart_executor = None
+    
+    def notify_observers(self, event, *args):
+        for observer in list(self.observers):
+            callback = getattr(observer, event, None)
+            if callback is not None:
+                callback(*args)
+    
+    def _kernel_spec(self, nb, resources):
         path = resources.get('metadata', {}).get('path', '')
         if path == '':
             path = None
-
-        from jupyter_client.manager import start_new_kernel
+        
         kernel_name = nb.metadata.get('kernelspec', {}).get('name', 'python')
         if self.kernel_name:
             kernel_name = self.kernel_name
-        self.log.debug("Executing notebook with kernel: %s" % kernel_name)
         
-        self.km, self.kc = start_new_kernel(
+        return kernel_name, path
+    
+    def _kernel_log_name(self, nb, resources):
+        #the kernel's stderr is logged to <stream_log_dir>/<notebook>.kernel.log
+        return nb['metadata'].get('pipeline_info', {}).get('notebook_name') or resources.get('notebook_name', 'kernel')
+    
+    def _launch_kernel(self, kernel_name, path, log_name='kernel'):
+        from jupyter_client.manager import start_new_kernel
+        
+        capture = self.log_pipeline is not None and self.stream_log_dir is not None
+        
+        km, kc = start_new_kernel(
             kernel_name=kernel_name,
             extra_arguments=self.extra_arguments,
-            stderr=open(os.devnull, 'w'),
+            stderr=subprocess.PIPE if capture else subprocess.DEVNULL,
             cwd=path)
         
-        self.kc.allow_stdin = False
+        process = getattr(km, 'kernel', None) or getattr(getattr(km, 'provisioner', None), 'process', None)
+        if capture and getattr(process, 'stderr', None) is not None:
+            self.log_pipeline.capture(process.stderr, Path(self.stream_log_dir) / '{}.kernel.log'.format(log_name))
+        
+        kc.allow_stdin = False
+        
+        return km, kc
+    
+    def prestart_kernel(self, nb, resources):
+        """Start the kernel for nb in the background, to be taken by the next start_kernel."""
+        self.discard_prestarted_kernel()
+        
+        if self._prestart_executor is None:
+            self._prestart_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ipype-kernel')
+        
+        kernel_spec = self._kernel_spec(nb, resources)
+        self._prestarted = (kernel_spec, self._prestart_executor.submit(self._launch_kernel, *kernel_spec,
+                                                                        self._kernel_log_name(nb, resources)))
+    
+    def _take_prestarted_kernel(self, kernel_spec):
+        if self._prestarted is None:
+            return None
+        
+        prestarted_spec, future = self._prestarted
+        if prestarted_spec != kernel_spec:
+            self.discard_prestarted_kernel()
+            return None
+        
+        self._prestarted = None
+        try:
+            return future.result()
+        except Exception as e:
+            self.log.warning("Prestarted kernel failed to start: {}".format(e))
+            return None
+    
+    def discard_prestarted_kernel(self):
+        if self._prestarted is None:
+            return
+        
+        prestarted_spec, future = self._prestarted
+        self._prestarted = None
+        try:
+            km, kc = future.result()
+        except Exception:
+            return
+        kc.stop_channels()
+        km.shutdown_kernel(now=True)
+    
+    def start_kernel(self, nb, resources):
+        
+        kernel_spec = self._kernel_spec(nb, resources)
+        self.log.debug("Executing notebook with kernel: %s" % kernel_spec[0])
+        
+        kernel = None
+        self._inprocess = self.kernel_backend == 'inprocess' and is_python_notebook(nb)
+        if self._inprocess:
+            kernel = acquire_inprocess_kernel(cwd=kernel_spec[1])
+        elif self.kernel_backend == 'inprocess':
+            self.log.warning("The inprocess kernel backend runs Python notebooks only, using a kernel subprocess")
+        
+        if kernel is None:
+            kernel = self._take_prestarted_kernel(kernel_spec)
+        if kernel is None and self.kernel_pool is not None and is_python_notebook(nb):
+            kernel = self.kernel_pool.take(*kernel_spec)
+        if kernel is None:
+            kernel = self._launch_kernel(*kernel_spec, self._kernel_log_name(nb, resources))
+        
+        self.km, self.kc = kernel
         
         env = {}
         
@@ -73,26 +194,67 @@ class IPypeExecutePreprocessor(ExecutePreprocessor):
             
         env.update(self.pipeline_config)
         
-        pipeline_info_repr = pprint.pformat(dict(nb['metadata']['pipeline_info']), width=1, compact=True)
-        
-        
-        nb.cells.insert(0, NotebookNode({'cell_type': 'code',
-                            'source': CELL_PIPELINE.format(pipeline_info_repr),
-                            'metadata': {'collapsed':False},
-                            }))
-        
         env_code_str = 'env={}'.format(repr(env))
         env_pipeline_code_str = 'pipeline = {}'.format(repr(env["Pipeline"]))
         self.kc.execute(env_code_str, silent=True)
         self.kc.execute(env_pipeline_code_str, silent=True)
+    
+    def shutdown_kernel(self):
+        if getattr(self, 'km', None) is None:
+            return
+        
+        if getattr(self, '_inprocess', False):
+            #the in-process kernel is kept for the next notebook, with an empty namespace
+            release_inprocess_kernel()
+        else:
+            self.kc.stop_channels()
+            self.km.shutdown_kernel(now=True)
+        self.km = self.kc = None
+    
+    def preprocess(self, nb, resources):
+        
+        #in a shared-kernel session the kernel of the previous notebook is still alive
+        if getattr(self, 'km', None) is None:
+            self.start_kernel(nb, resources)
+        
+        #the kernel of the next notebook starts while this one runs
+        if self.prestart_next is not None:
+            self.prestart_kernel(*self.prestart_next)
+            self.prestart_next = None
+        
+        pipeline_info_repr = pprint.pformat(dict(nb['metadata']['pipeline_info']), width=1, compact=True)
+        
+        #(re-)injects the per-notebook pipeline_info into the kernel namespace
+        nb.cells.insert(0, new_code_cell(CELL_PIPELINE.format(pipeline_info_repr),
+                                         metadata={'collapsed':False}))
+        
+        self.notify_observers('notebook_started', nb, resources)
+        
+        self._notebook_name = nb['metadata']['pipeline_info'].get('notebook_name', 'notebook')
+        
+        self._profiling = self.profile_dir is not None and is_python_notebook(nb)
+        if self._profiling:
+            start_profiling(self.kc, memory=self.profile_memory)
+        
+        failed = True
         
         try:
             nb, resources = super(ExecutePreprocessor, self).preprocess(nb, resources)
+            failed = False
         finally:
+            #collected first, so reading pipeline_info back is not profiled
+            if self._profiling:
+                self.preprocess_profile(nb, resources)
+            
             self.preprocess_pipeline_outputs(nb, resources)
-        
-            self.kc.stop_channels()
-            self.km.shutdown_kernel(now=True)
+            
+            #keep_kernel keeps the namespace alive for the next notebook of a session
+            if failed or not self.keep_kernel:
+                self.shutdown_kernel()
+            
+            if failed:
+                self.notify_observers('notebook_failed', nb, resources)
+            self.notify_observers('notebook_finished', nb, resources)
         
         
         return nb, resources
@@ -125,6 +287,19 @@ class IPypeExecutePreprocessor(ExecutePreprocessor):
         #TODO
         #shouldn't it be nb['pipeline_info'] = pipeline_info
         
+    def preprocess_profile(self, nb, resources):
+        notebook_name = nb['metadata']['pipeline_info']['notebook_name']
+        profile_pth = Path(self.profile_dir) / (notebook_name + '.pstats')
+        
+        try:
+            collect_profile(self.kc, profile_pth, memory=self.profile_memory, top=self.profile_top)
+        except Exception as e:
+            self.log.warning("Could not collect the profile of {}: {}".format(notebook_name, e))
+            return
+        
+        resources['profile_path'] = str(profile_pth)
+        nb['metadata']['pipeline_info']['profile_path'] = str(profile_pth)
+        
 
     def preprocess_cell(self, cell, resources, cell_index):
         """
@@ -134,9 +309,20 @@ class IPypeExecutePreprocessor(ExecutePreprocessor):
         """
         if cell.cell_type != 'code':
             return cell, resources
+        
+        if self.cancelled:
+            raise Exception("Notebook cancelled.")
 
-        reply, outputs = self.run_cell(cell, cell_index)
+        self._cell_streams = {}
+        
+        try:
+            reply, outputs = self.run_cell(cell, cell_index)
+        finally:
+            self._flush_streams()
+        
         cell.outputs = outputs
+        
+        self.notify_observers('cell_executed', cell, cell_index)
 
         if not self.allow_errors:
             for out in outputs:
@@ -147,9 +333,54 @@ class IPypeExecutePreprocessor(ExecutePreprocessor):
         return cell, resources
 
 
+    def output(self, outs, msg, display_id, cell_index):
+        if msg['msg_type'] != 'stream' or not (self.stream_head_lines or self.stream_tail_lines):
+            return super().output(outs, msg, display_id, cell_index)
+        
+        if getattr(self, 'clear_before_next_output', False):
+            outs[:] = []
+            self.clear_before_next_output = False
+            self._flush_streams()
+        
+        name = msg['content']['name']
+        stream = self._cell_streams.get(name)
+        
+        if stream is None:
+            log_pth = None
+            if self.stream_log_dir is not None:
+                notebook_name = getattr(self, '_notebook_name', 'notebook')
+                log_pth = Path(self.stream_log_dir) / '{}.cell{}.{}.log'.format(notebook_name, cell_index, name)
+            
+            #one coalesced output per stream and cell, filled in when the cell finishes
+            stream = StreamBuffer(self.stream_head_lines, self.stream_tail_lines, log_pth)
+            stream.output = NotebookNode({'output_type': 'stream', 'name': name, 'text': ''})
+            outs.append(stream.output)
+            self._cell_streams[name] = stream
+        
+        stream.add(msg['content']['text'])
+        
+        return stream.output
+    
+    def clear_output(self, outs, msg, cell_index):
+        super().clear_output(outs, msg, cell_index)
+        
+        if not msg['content'].get('wait'):
+            self._flush_streams()
+    
+    def _flush_streams(self):
+        for stream in getattr(self, '_cell_streams', {}).values():
+            stream.output['text'] = stream.text()
+            stream.close()
+        
+        self._cell_streams = {}
+    
     def shutdown(self):
-        self.kc.stop_channels()
-        self.km.shutdown_kernel(now=True)
+        self.shutdown_kernel()
+        self.discard_prestarted_kernel()
+        
+        if self._prestart_executor is not None:
+            self._prestart_executor.shutdown()
+            self._prestart_executor = None
         
 
 
@@ -163,7 +394,9 @@ class CalibratePipelineNotebookPreprocessor(Preprocessor):
         output_subdir = Path(resources['output_subdir']) #resources
         notebook_exec_pth = output_subdir / notebook_exec_name
         
-        pipeline_info_dict = resources['pipeline_info'] #resources
+        #notebook lists are referenced, not embedded, so metadata stays O(1) per notebook
+        pipeline_info_dict = {k: v for k, v in dict(resources['pipeline_info']).items() \
+                              if k not in ('pipeline_notebooks', 'executed_notebooks')} #resources
         pipeline_notebooks = resources['pipeline_notebooks'] #resources
         
         if 'pipeline_info' not in nb['metadata']:
@@ -171,10 +404,15 @@ class CalibratePipelineNotebookPreprocessor(Preprocessor):
         else: #assume it is a dict / dict-like
             nb['metadata']['pipeline_info'].update(pipeline_info_dict)
         
+        notebook_index = resources.get('notebook_index')
+        if notebook_index is None:
+            notebook_index = pipeline_notebooks.index(str(notebook_filename_pth))
+        
         nb['metadata']['pipeline_info']['notebook_filename'] = notebook_exec_name
         nb['metadata']['pipeline_info']['notebook_name'] = notebook_exec_name.split(".exec.ipynb")[0]
         nb['metadata']['pipeline_info']['notebook_path'] = str(notebook_exec_pth)
-        nb['metadata']['pipeline_info']['notebook_index'] = notebook_index = pipeline_notebooks.index(str(notebook_filename_pth))
+        nb['metadata']['pipeline_info']['notebook_index'] = notebook_index
+        nb['metadata']['pipeline_info']['pipeline_notebooks_count'] = len(pipeline_notebooks)
         
         if notebook_index == 0:
             previous_notebook = None
@@ -186,14 +424,15 @@ class CalibratePipelineNotebookPreprocessor(Preprocessor):
             previous_notebook = str(pipeline_notebooks[notebook_index - 1])
             nb['metadata']['pipeline_info']['previous_notebook'] = previous_notebook 
             
-            nb['metadata']['pipeline_info']['executed_notebooks'] = resources['executed_notebooks']
+            last_exec_notebook = resources['last_executed_notebook']
+            nb['metadata']['pipeline_info']['previous_executed_notebook'] = last_exec_notebook
         
             #set inputs from previous executed notebook output
-            def get_last_exec_notebook_outputs():
-                last_exec_notebook = nb['metadata']['pipeline_info']['executed_notebooks'][-1] 
-                return get_notebook_pipeline_outputs(last_exec_notebook)
-                
-            nb['metadata']['pipeline_info']['inputs'] = get_last_exec_notebook_outputs()
+            #(cached by the caller, or read back from the executed notebook)
+            if resources.get('last_executed_outputs') is not None:
+                nb['metadata']['pipeline_info']['inputs'] = resources['last_executed_outputs']
+            else:
+                nb['metadata']['pipeline_info']['inputs'] = get_notebook_pipeline_outputs(last_exec_notebook)
         
         notebook_started = datetime.now()
         nb['metadata']['pipeline_info']['notebook_started'] = notebook_started.isoformat()
@@ -234,7 +473,7 @@ class ExecutePipelineNotebookPreprocessor(ExecutePreprocessor):
         self.km, self.kc = start_new_kernel(
             kernel_name=kernel_name,
             extra_arguments=self.extra_arguments,
-            stderr=open(os.devnull, 'w'),
+            stderr=subprocess.DEVNULL,
             cwd=path)
         
         self.kc.allow_stdin = False
@@ -287,6 +526,8 @@ class ExecutePipelineNotebookPreprocessor(ExecutePreprocessor):
         outputs = pipeline_info.get('outputs', {})
         
         nb['metadata']['pipeline_info']['outputs'] = outputs
+        #harvested outputs for the caller, so it need not re-read the notebook
+        resources['pipeline_outputs'] = outputs
         
         return nb, resources
         
@@ -318,15 +559,63 @@ class ExecutePipelineNotebookPreprocessor(ExecutePreprocessor):
         
 
 
+#image outputs of the reports, in the html exporter's display priority
+IMAGE_MIMETYPES = [('image/svg+xml', 'svg'), ('image/png', 'png'), ('image/jpeg', 'jpg')]
+
+
+class ExternalImagesPreprocessor(Preprocessor):
+    """Moves image outputs into the AssetStore of resources['assets'], referenced by relative url."""
+    
+    def preprocess(self, nb, resources):
+        assets = resources.get('assets')
+        
+        if assets is None:
+            return nb, resources
+        
+        for cell in nb.cells:
+            for output in cell.get('outputs', []):
+                self.externalize_output(output, assets)
+        
+        return nb, resources
+    
+    def externalize_output(self, output, assets):
+        data = output.get('data', {})
+        
+        #an html representation is displayed instead of the images anyway
+        if 'text/html' in data:
+            return
+        
+        for mimetype, ext in IMAGE_MIMETYPES:
+            if mimetype not in data:
+                continue
+            
+            if mimetype == 'image/svg+xml':
+                image = data[mimetype]
+                image = ("".join(image) if isinstance(image, list) else image).encode('utf-8')
+            else:
+                image = base64.b64decode(data[mimetype])
+            
+            name = assets.add(image, ext)
+            
+            metadata = output.get('metadata', {}).get(mimetype, {})
+            size = "".join(' {}="{}"'.format(k, int(metadata[k])) for k in ('width', 'height') if k in metadata)
+            
+            #the reports are next to the assets dir
+            data['text/html'] = '<img src="{}/{}"{}>'.format(assets.assets_dir.name, name, size)
+            for other, other_ext in IMAGE_MIMETYPES:
+                data.pop(other, None)
+            return
+    
+    
 class CustomJsCssPreprocessor(Preprocessor):
     def preprocess(self, nb, resources): 
-        output_subdir = Path(resources['output_subdir']) #resources
+        output_subdir = resources.get('output_subdir') #resources
+        
+        if output_subdir is None:
+            return nb, resources
         
-        #copy custom files
-        module_path = Path(__loader__.path).absolute().parent
-        custom_js = module_path / 'custom' / 'custom.js'
-        custom_css = module_path / 'custom' / 'custom.css'
-        shutil.copy(str(custom_js), str(output_subdir))
+        #copy custom files (once per output dir)
+        copy_static_assets(output_subdir)
                 
         return nb, resources
     
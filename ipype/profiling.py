@@ -0,0 +1,127 @@
+import io
+import json
+import base64
+import pstats
+from queue import Empty
+from pathlib import Path
+
+
+#callbacks of a previous notebook in the same (shared or in-process) kernel
+PROFILE_UNREGISTER = \
+"""
+for _ipype_event, _ipype_callback in getattr(get_ipython(), '_ipype_profile_callbacks', []):
+    get_ipython().events.unregister(_ipype_event, _ipype_callback)
+get_ipython()._ipype_profile_callbacks = []
+"""
+
+#the profiler runs around the cell body only, not the kernel's message dispatch
+PROFILE_SETUP = PROFILE_UNREGISTER + \
+"""
+import cProfile as _ipype_cProfile
+_ipype_profile = _ipype_cProfile.Profile()
+get_ipython()._ipype_profile_callbacks = [
+    ('pre_run_cell', lambda *args, profile=_ipype_profile: profile.enable()),
+    ('post_run_cell', lambda *args, profile=_ipype_profile: profile.disable()),
+]
+for _ipype_event, _ipype_callback in get_ipython()._ipype_profile_callbacks:
+    get_ipython().events.register(_ipype_event, _ipype_callback)
+"""
+
+PROFILE_MEMORY_SETUP = \
+"""
+import tracemalloc as _ipype_tracemalloc
+if not _ipype_tracemalloc.is_tracing():
+    _ipype_tracemalloc.start(10)
+_ipype_tracemalloc.clear_traces()
+"""
+
+PROFILE_COLLECT = \
+"""
+import json as _ipype_json, marshal as _ipype_marshal, base64 as _ipype_base64
+_ipype_profile.create_stats()
+_ipype_profile_result = {{'pstats': _ipype_base64.b64encode(_ipype_marshal.dumps(_ipype_profile.stats)).decode()}}
+if {memory}:
+    _ipype_snapshot = _ipype_tracemalloc.take_snapshot()
+    _ipype_profile_result['tracemalloc'] = '\\n'.join(str(stat) for stat in _ipype_snapshot.statistics('lineno')[:{top}])
+    _ipype_profile_result['tracemalloc_peak'] = _ipype_tracemalloc.get_traced_memory()[1]
+print(_ipype_json.dumps(_ipype_profile_result))
+"""
+
+SUMMARY_FILENAME = 'summary.txt'
+
+
+def execute_and_collect_stdout(kc, code, timeout=60):
+    """Execute code in the kernel and return everything it printed to stdout."""
+    msg_id = kc.execute(code)
+
+    chunks = []
+
+    while True:
+        try:
+            msg = kc.get_iopub_msg(timeout=timeout)
+        except Empty:
+            break
+
+        if msg['parent_header'].get('msg_id') != msg_id:
+            continue
+
+        if msg['msg_type'] == 'stream' and msg['content'].get('name') == 'stdout':
+            chunks.append(msg['content']['text'])
+        elif msg['msg_type'] == 'status' and msg['content']['execution_state'] == 'idle':
+            break
+
+    return ''.join(chunks)
+
+
+def is_python_notebook(nb):
+    language = nb['metadata'].get('kernelspec', {}).get('language') \
+        or nb['metadata'].get('language_info', {}).get('name', 'python')
+    return language == 'python'
+
+
+def start_profiling(kc, memory=False):
+    kc.execute(PROFILE_SETUP, silent=True)
+    if memory:
+        kc.execute(PROFILE_MEMORY_SETUP, silent=True)
+
+
+def collect_profile(kc, profile_pth, memory=False, top=30):
+    """Fetch the kernel's profile through the kernel channel and save it as .pstats."""
+    profile_pth = Path(str(profile_pth))
+
+    #silent: does not run the pre_run_cell callbacks
+    kc.execute(PROFILE_UNREGISTER, silent=True)
+    output = execute_and_collect_stdout(kc, PROFILE_COLLECT.format(memory=bool(memory), top=int(top)))
+    result = json.loads(output)
+
+    profile_pth.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(str(profile_pth), 'wb') as f:
+        f.write(base64.b64decode(result['pstats']))
+
+    if 'tracemalloc' in result:
+        with open(str(profile_pth.with_suffix('.tracemalloc.txt')), 'w') as f:
+            print("peak traced memory: {} bytes".format(result['tracemalloc_peak']), file=f)
+            print(result['tracemalloc'], file=f)
+
+    return profile_pth
+
+
+def write_profile_summary(profile_pths, summary_pth, top=30, sort_by='cumulative'):
+    """Aggregate the per-notebook profiles into one top-N hotspot summary."""
+    profile_pths = [str(pth) for pth in profile_pths]
+
+    if not profile_pths:
+        return None
+
+    stream = io.StringIO()
+    stats = pstats.Stats(*profile_pths, stream=stream)
+    stats.sort_stats(sort_by).print_stats(top)
+
+    with open(str(summary_pth), 'w') as f:
+        print("Aggregated profile of {} notebooks:".format(len(profile_pths)), file=f)
+        for pth in profile_pths:
+            print("    {}".format(Path(pth).name), file=f)
+        f.write(stream.getvalue())
+
+    return summary_pth
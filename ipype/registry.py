@@ -0,0 +1,88 @@
+from pathlib import Path
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+EXECUTED = 'executed'
+RESTORED = 'restored'
+FAILED = 'failed'
+
+
+class NotebookRecord(object):
+    """In-memory state of one pipeline notebook during a run."""
+
+    def __init__(self, index, source):
+        self.index = index
+        self.source = source
+        self.name = Path(str(source)).name
+        self.stem = Path(str(source)).stem
+        self.status = PENDING
+        self.exec_path = None
+        self.declarations = None
+        #harvested pipeline_info['outputs'], cached so that the next
+        #notebook does not have to re-read the executed notebook
+        self.outputs = None
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return "NotebookRecord({}, {!r}, {})".format(self.index, self.name, self.status)
+
+
+class RunRegistry(object):
+    """Indexed records of the notebooks of a pipeline run.
+
+    Lookups by path, name, stem or index are O(1), so the bookkeeping of a
+    run stays linear in the number of notebooks.
+    """
+
+    def __init__(self, notebooks):
+        self.records = [NotebookRecord(index, source) for index, source in enumerate(notebooks)]
+        self._by_source = {}
+        self._by_selector = {}
+        self.last_executed = None
+
+        for record in self.records:
+            self._by_source[str(record.source)] = record
+            for selector in (record.name, record.stem, str(record.index)):
+                self._by_selector.setdefault(selector, record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    def get(self, notebook_filename):
+        return self._by_source[str(notebook_filename)]
+
+    def index_of(self, notebook_filename):
+        return self.get(notebook_filename).index
+
+    def resolve(self, selector):
+        try:
+            return self._by_selector[str(selector)]
+        except KeyError:
+            raise Exception("Unknown notebook {}: not in the pipeline.".format(selector))
+
+    def mark_running(self, record, started=None):
+        record.status = RUNNING
+        record.started = started
+
+    def mark_executed(self, record, exec_path, outputs, finished=None):
+        record.status = EXECUTED
+        record.exec_path = exec_path
+        record.outputs = outputs
+        record.finished = finished
+        self.last_executed = record
+
+    def mark_restored(self, record, exec_path, outputs):
+        record.status = RESTORED
+        record.exec_path = exec_path
+        record.outputs = outputs
+
+    def mark_failed(self, record):
+        record.status = FAILED
@@ -0,0 +1,281 @@
+import re
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from html import escape
+from datetime import datetime
+from pathlib import Path
+
+from ipype.notebook import md5sum, notebook_node_to_html
+from ipype.storage import atomic_write, bytes_to_notebook, FilesStorage
+
+
+RENDER_MANIFEST = '.render_manifest.json'
+#content-addressed images of the reports, shared by all the reports of an html dir
+ASSETS_SUBDIR = 'assets'
+INDEX_FILENAME = 'index.html'
+STATIC_ASSETS = ['custom.js']
+EXEC_SUFFIX = '.exec.ipynb'
+
+#<stem>.<index>.exec.ipynb: an instance of a __map_over__ notebook, rendered after its summary
+MAP_INSTANCE_RE = re.compile(r'\.\d+\.exec\.ipynb$')
+
+#pipeline_info of a run the reports do not show: a re-run with the same cells renders the same html
+VOLATILE_PIPELINE_INFO = ['notebook_started', 'notebook_started_timestamp',
+                          'notebook_finished', 'notebook_finished_timestamp']
+#their lines in the pipeline_info cell injected into every executed notebook (one key per line)
+VOLATILE_LINE_RE = re.compile(r"^\s*'(?:{})': .*$".format("|".join(VOLATILE_PIPELINE_INFO)), re.MULTILINE)
+
+
+INDEX_TEMPLATE = \
+"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{font-family: sans-serif; margin: 2em;}}
+table {{border-collapse: collapse;}}
+th, td {{padding: 0.3em 1em; border-bottom: 1px solid #ddd; text-align: left;}}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+<p>Generated {generated}</p>
+<table>
+<tr><th>#</th><th>Notebook</th><th>Started</th><th>Finished</th></tr>
+{rows}
+</table>
+</body>
+</html>
+"""
+
+INDEX_ROW_TEMPLATE = \
+"""<tr><td>{index}</td><td><a href="{href}">{name}</a></td><td>{started}</td><td>{finished}</td></tr>"""
+
+
+def render_digest(nb):
+    """Digest of what the report of an executed notebook shows: its cells and metadata, without run times."""
+    metadata = dict(nb['metadata'])
+    metadata['pipeline_info'] = {key: value for key, value in metadata.get('pipeline_info', {}).items() \
+                                 if key not in VOLATILE_PIPELINE_INFO}
+    #per-cell execution timestamps (nbclient's record_timing)
+    cells = [dict(cell, source=VOLATILE_LINE_RE.sub('', cell['source']),
+                  metadata={key: value for key, value in cell.get('metadata', {}).items() if key != 'execution'}) \
+             for cell in nb['cells']]
+
+    data = json.dumps({'metadata': metadata, 'cells': cells}, sort_keys=True, default=str)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def static_assets():
+    module_path = Path(__loader__.path).absolute().parent
+    return [(asset, module_path / 'custom' / asset) for asset in STATIC_ASSETS]
+
+
+def copy_static_assets(html_dir):
+    """Write the shared static assets (custom.js etc.) of an html dir, unless they are current."""
+    html_dir = Path(html_dir).absolute()
+    html_dir.mkdir(parents=True, exist_ok=True)
+
+    copied = []
+
+    for asset, src in static_assets():
+        dst = html_dir / asset
+        if dst.exists() and md5sum(dst) == md5sum(src):
+            continue
+        shutil.copy(str(src), str(dst))
+        copied.append(dst)
+
+    return copied
+
+
+class AssetStore(object):
+    """Content-addressed files of a dir: identical contents are written once."""
+
+    def __init__(self, assets_dir, storage=None):
+        self.assets_dir = Path(str(assets_dir))
+        self.storage = storage
+        self._written = set()
+
+    def add(self, data, ext):
+        """Store data (if new) and return its file name."""
+        name = "{}.{}".format(hashlib.sha256(data).hexdigest(), ext)
+        pth = self.assets_dir / name
+
+        if name in self._written:
+            return name
+
+        if self.storage is not None and self.storage.is_archive:
+            self.storage.write_bytes(pth, data)
+        elif not pth.exists():
+            atomic_write(pth, data)
+
+        self._written.add(name)
+        return name
+
+
+class HTMLRenderCache(object):
+    """Executed-notebook content hashes of the last html render, per html file."""
+
+    def __init__(self, html_dir):
+        self.html_dir = Path(html_dir)
+        self.manifest_pth = self.html_dir / RENDER_MANIFEST
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(str(self.manifest_pth)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def is_current(self, html_name, digest):
+        entry = self.entries.get(html_name, {})
+        return entry.get('hash') == digest and (self.html_dir / html_name).exists()
+
+    def update(self, html_name, digest, **info):
+        entry = dict(info)
+        entry['hash'] = digest
+        entry['rendered'] = datetime.now().isoformat()
+        self.entries[html_name] = entry
+
+    def save(self):
+        atomic_write(self.manifest_pth, json.dumps(self.entries, indent=1, sort_keys=True).encode('utf-8'))
+
+
+def render_html_index(entries, title="ipype pipeline"):
+    """Render a lightweight index page linking all the html reports.
+
+    entries is a list of dicts with the keys: name, href, started, finished.
+    """
+    rows = []
+    for index, entry in enumerate(entries):
+        rows.append(INDEX_ROW_TEMPLATE.format(index=index,
+                                              href=escape(entry['href']),
+                                              name=escape(entry['name']),
+                                              started=escape(str(entry.get('started') or '')),
+                                              finished=escape(str(entry.get('finished') or '')),
+                                              ))
+
+    return INDEX_TEMPLATE.format(title=escape(title),
+                                 generated=datetime.now().isoformat(),
+                                 rows="\n".join(rows))
+
+
+def write_html_index(html_dir, entries, title="ipype pipeline"):
+    html_dir = Path(html_dir)
+    index_html = render_html_index(entries, title)
+
+    return atomic_write(html_dir / INDEX_FILENAME, index_html.encode('utf-8'))
+
+
+def executed_notebook_name(exec_notebook):
+    return Path(str(exec_notebook)).name.split(EXEC_SUFFIX)[0]
+
+
+def find_executed_notebooks(output_dir):
+    """Executed notebooks of an output dir, in pipeline order when its config.json lists them."""
+    output_dir = Path(str(output_dir)).absolute()
+    exec_notebooks_dir = output_dir / 'exec_notebooks'
+
+    try:
+        with open(str(output_dir / 'config.json')) as f:
+            notebooks = json.load(f).get('pipeline_notebooks', [])
+        return [exec_notebooks_dir / Path(notebook).with_suffix(EXEC_SUFFIX).name for notebook in notebooks]
+    except (FileNotFoundError, ValueError):
+        pass
+
+    names = set(pth.name.split(EXEC_SUFFIX)[0] for pth in exec_notebooks_dir.glob('*' + EXEC_SUFFIX + '*') \
+                if pth.name.endswith((EXEC_SUFFIX, EXEC_SUFFIX + '.gz')) and not MAP_INSTANCE_RE.search(pth.name.replace('.gz', '')))
+    return [exec_notebooks_dir / (name + EXEC_SUFFIX) for name in sorted(names)]
+
+
+class ReportRenderer(object):
+    """Renders the executed notebooks of an output dir to html/.
+
+    Notebooks whose content hash matches the last render are skipped, so
+    rendering can happen after the run, in batch or on first request.
+    """
+
+    def __init__(self, output_dir, storage=None, incremental=True, external_images=False, log=None):
+        self.output_dir = Path(str(output_dir)).absolute()
+        self.html_dir = self.output_dir / 'html'
+        #images written to html/assets/ instead of inlined as base64
+        self.external_images = external_images
+        self.storage = storage if storage is not None else FilesStorage(self.output_dir)
+        self.assets = AssetStore(self.html_dir / ASSETS_SUBDIR, self.storage)
+        #a fresh archive is written every run, so there is nothing to skip
+        self.incremental = incremental and not self.storage.is_archive
+        self.render_cache = HTMLRenderCache(self.html_dir)
+        self.log = log or logging.getLogger(__name__)
+        self._lock = threading.RLock()
+
+    def write_static_assets(self):
+        #shared static assets are written once per output dir
+        if self.storage.is_archive:
+            for asset, src in static_assets():
+                self.storage.write_bytes(self.html_dir / asset, src.read_bytes())
+        else:
+            copy_static_assets(self.html_dir)
+
+    def render(self, exec_notebook, force=False):
+        """Render one executed notebook; returns its pipeline_info, or None if it was not executed."""
+        exec_notebook = Path(str(exec_notebook))
+        html_notebook_name = executed_notebook_name(exec_notebook) + ".html"
+
+        try:
+            exec_notebook_bytes = self.storage.read_bytes(exec_notebook)
+        except FileNotFoundError:
+            return None #not executed yet
+
+        nb = bytes_to_notebook(exec_notebook_bytes)
+        digest = render_digest(nb)
+        if self.external_images:
+            digest += '.' + ASSETS_SUBDIR #a report with inlined images is not current
+
+        with self._lock:
+            if not force and self.incremental and self.render_cache.is_current(html_notebook_name, digest):
+                self.log.info("Skipping html export of {} (unchanged)".format(str(exec_notebook)))
+            else:
+                body = notebook_node_to_html(nb, assets=self.assets if self.external_images else None)
+                self.storage.write_text(self.html_dir / html_notebook_name, body)
+                self.render_cache.update(html_notebook_name, digest, notebook=str(exec_notebook))
+
+        return nb['metadata'].get('pipeline_info', {})
+
+    def render_all(self, exec_notebooks, title="ipype pipeline", force=False):
+        """Render the executed notebooks (and their mapped instances) and write the index page."""
+        self.write_static_assets()
+
+        index_entries = []
+        exec_notebooks = list(exec_notebooks)
+
+        for exec_notebook in exec_notebooks:
+            pipeline_info = self.render(exec_notebook, force=force)
+            if pipeline_info is None:
+                continue
+
+            #instances of a mapped notebook are rendered after its summary
+            exec_notebooks.extend(pipeline_info.get('map_instances', []))
+
+            notebook_name = executed_notebook_name(exec_notebook)
+            index_entries.append({'name': notebook_name,
+                                  'href': notebook_name + ".html",
+                                  'started': pipeline_info.get('notebook_started'),
+                                  'finished': pipeline_info.get('notebook_finished'),
+                                  })
+
+        self.save()
+
+        #one index page linking all the reports
+        self.storage.write_text(self.html_dir / INDEX_FILENAME, render_html_index(index_entries, title=title))
+
+        return index_entries
+
+    def save(self):
+        if not self.storage.is_archive:
+            with self._lock:
+                self.render_cache.save()
@@ -0,0 +1,473 @@
+import os
+import json
+import hmac
+import heapq
+import socket
+import secrets
+import subprocess
+import logging
+import itertools
+import threading
+import http.client
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from traitlets.config import Config
+
+
+#the Unix socket is the default transport, a TCP port is opt-in and needs a token
+SOCKET_NAME = 'service.sock'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+#finished jobs kept for polling, the oldest ones are forgotten first
+MAX_FINISHED_JOBS = 1000
+
+#job request keys -> Pipeline traits
+JOB_OPTIONS = {'pipeline': 'path',
+               'output_dir': 'output_dir',
+               'output_mode': 'output_mode',
+               'only': 'only',
+               'from': 'from_notebook',
+               'until': 'until_notebook',
+               'profile': 'profile',
+               'args': 'cmdline_args',
+               }
+
+
+def service_dir():
+    #private to the user that runs the service
+    return Path(os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('XDG_CACHE_HOME', str(Path.home() / '.cache'))) / 'ipype'
+
+
+def default_socket_path():
+    return str(service_dir() / SOCKET_NAME)
+
+
+def default_token_path(port):
+    return str(service_dir() / 'service-{}.token'.format(port))
+
+
+def write_token(token_path):
+    """Write a new random token to a file only its owner can read."""
+    token = secrets.token_hex(32)
+
+    token_path = Path(str(token_path))
+    token_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if token_path.exists():
+        token_path.unlink()
+
+    fd = os.open(str(token_path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+
+    return token
+
+
+def read_token(token_path):
+    with open(str(token_path)) as f:
+        return f.read().strip()
+
+
+def job_config(request):
+    unknown = set(request) - set(JOB_OPTIONS)
+    if unknown:
+        raise Exception("Unknown job options: {}.".format(", ".join(sorted(unknown))))
+    if 'pipeline' not in request or 'output_dir' not in request:
+        raise Exception("A job needs a pipeline and an output_dir.")
+
+    c = Config()
+    for key, value in request.items():
+        if key == 'args':
+            value = tuple(value)
+        elif key == 'pipeline' or key == 'output_dir':
+            value = os.path.abspath(value)
+        c.Pipeline[JOB_OPTIONS[key]] = value
+    return c
+
+
+class KernelPool(object):
+    """Kernels started ahead of the notebooks that will take them.
+
+    A taken kernel is replaced in the background, so a notebook starts
+    without waiting for the kernel process while the pool keeps up.
+    """
+
+    def __init__(self, size=1, kernel_name='python3'):
+        self.size = size
+        self.kernel_name = kernel_name
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, size), thread_name_prefix='ipype-kernel-pool')
+        self._kernels = [self._executor.submit(self._launch) for i in range(size)]
+
+    def _launch(self):
+        from jupyter_client.manager import start_new_kernel
+
+        km, kc = start_new_kernel(kernel_name=self.kernel_name, stderr=subprocess.DEVNULL)
+        kc.allow_stdin = False
+        return km, kc
+
+    def take(self, kernel_name, cwd=None):
+        """A warm (km, kc) for kernel_name running in cwd, or None."""
+        with self._lock:
+            if kernel_name not in (self.kernel_name, 'python') or not self._kernels:
+                return None
+            future = self._kernels.pop(0)
+            self._kernels.append(self._executor.submit(self._launch))
+
+        try:
+            km, kc = future.result()
+        except Exception:
+            return None
+
+        #pool kernels are started before the output dir of the run is known
+        if cwd is not None:
+            kc.execute("import os as _ipype_os; _ipype_os.chdir({!r}); del _ipype_os".format(str(cwd)), silent=True)
+
+        return km, kc
+
+    def close(self):
+        with self._lock:
+            kernels, self._kernels = self._kernels, []
+
+        for future in kernels:
+            try:
+                km, kc = future.result()
+            except Exception:
+                continue
+            kc.stop_channels()
+            km.shutdown_kernel(now=True)
+
+        self._executor.shutdown()
+
+
+class Job(object):
+
+    def __init__(self, job_id, request, priority=0):
+        self.id = job_id
+        self.request = request
+        self.priority = priority
+        self.state = QUEUED
+        self.submitted = datetime.now().isoformat()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.pipeline = None
+        #request paths resolved once, when the job is submitted
+        self.config = None
+
+    def to_dict(self):
+        job = {'id': self.id,
+               'state': self.state,
+               'priority': self.priority,
+               'request': self.request,
+               'submitted': self.submitted,
+               'started': self.started,
+               'finished': self.finished,
+               'error': self.error,
+               }
+
+        status = getattr(self.pipeline, 'status', None)
+        if self.state == RUNNING and status is not None:
+            job['status'] = status.snapshot()
+
+        return job
+
+
+class PipelineService(object):
+    """Runs submitted pipelines from a priority queue, concurrency at a time.
+
+    Modules and exporters are loaded once for all runs, and notebook kernels
+    come warm from a shared KernelPool.
+    """
+
+    def __init__(self, concurrency=1, warm_kernels=1, kernel_name='python3', log=None,
+                 max_finished_jobs=MAX_FINISHED_JOBS):
+        self.log = log or logging.getLogger(__name__)
+        self.concurrency = concurrency
+        self.max_finished_jobs = max_finished_jobs
+        self.kernel_pool = KernelPool(warm_kernels, kernel_name) if warm_kernels else None
+
+        self.jobs = {}
+        self._queue = []
+        self._counter = itertools.count(1)
+        self._condition = threading.Condition()
+        self._closing = False
+
+        self.preload()
+
+        self._workers = [threading.Thread(target=self._work, name='ipype-service-{}'.format(i), daemon=True) \
+                         for i in range(concurrency)]
+        for worker in self._workers:
+            worker.start()
+
+    def preload(self):
+        #import and render once, so that the first job does not pay for it
+        import nbformat
+        from ipype.notebook import notebook_node_to_html
+
+        try:
+            notebook_node_to_html(nbformat.v4.new_notebook())
+        except Exception as e:
+            self.log.warning("Could not preload the html exporter: {}".format(e))
+
+    def submit(self, request, priority=0):
+        #validated before it is queued, and its paths resolved against the cwd of the submit
+        config = job_config(request)
+
+        with self._condition:
+            job = Job(str(next(self._counter)), request, priority)
+            job.config = config
+            self.jobs[job.id] = job
+            #higher priority first, then first come first served
+            heapq.heappush(self._queue, (-priority, int(job.id), job))
+            self._condition.notify()
+
+        return job
+
+    def list_jobs(self):
+        #a snapshot: workers expire finished jobs concurrently
+        with self._condition:
+            return list(self.jobs.values())
+
+    def get(self, job_id):
+        try:
+            return self.jobs[str(job_id)]
+        except KeyError:
+            raise Exception("Unknown job {}.".format(job_id))
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+
+        with self._condition:
+            if job.state == QUEUED:
+                job.state = CANCELLED
+                job.finished = datetime.now().isoformat()
+                self._expire_jobs()
+                return job
+
+        if job.state == RUNNING and job.pipeline is not None:
+            job.pipeline.cancel()
+
+        return job
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closing:
+                    self._condition.wait()
+                if self._closing:
+                    return
+                priority, order, job = heapq.heappop(self._queue)
+                if job.state != QUEUED:
+                    continue #cancelled while queued
+                job.state = RUNNING
+                job.started = datetime.now().isoformat()
+
+            self.run_job(job)
+
+    def run_job(self, job):
+        from ipype.pipeline import IPypeApp, Pipeline
+
+        #every job logs to its own (unregistered) logger, whose handlers are closed with the job
+        log = logging.Logger('ipype.service.job.{}'.format(job.id))
+        log.parent = self.log
+
+        try:
+            app = IPypeApp(config=job.config, log=log)
+            app.pipeline = job.pipeline = Pipeline(config=app.config, parent=app)
+            job.pipeline.kernel_pool = self.kernel_pool
+            #an in-process kernel changes the working dir of the whole process
+            job.pipeline.allow_inprocess = self.concurrency == 1
+            job.pipeline.initialize()
+            job.pipeline.start()
+            job.state = FINISHED
+        except Exception as e:
+            job.state = CANCELLED if getattr(job.pipeline, 'cancelled', False) else FAILED
+            job.error = "{}: {}".format(type(e).__name__, e)
+            self.log.warning("Job {} {}: {}".format(job.id, job.state, job.error))
+        finally:
+            job.finished = datetime.now().isoformat()
+            for handler in list(log.handlers):
+                log.removeHandler(handler)
+                handler.close()
+            #the run's registry, preprocessors and status are not kept with the job
+            job.pipeline = None
+            with self._condition:
+                self._expire_jobs()
+
+    def _expire_jobs(self):
+        #called with the condition held
+        finished = [job for job in self.jobs.values() if job.state in (FINISHED, FAILED, CANCELLED)]
+        finished.sort(key=lambda job: job.finished or '')
+        for job in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job.id]
+
+    def close(self):
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+
+        for job in self.list_jobs():
+            if job.state in (QUEUED, RUNNING):
+                self.cancel(job.id)
+
+        if self.kernel_pool is not None:
+            self.kernel_pool.close()
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """JSON API: POST /jobs, GET /jobs, GET /jobs/<id>, DELETE /jobs/<id>.
+
+    On a TCP port every request needs the server's token as a bearer token.
+    """
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job_id(self):
+        parts = self.path.strip('/').split('/')
+        if parts[0] != 'jobs' or len(parts) > 2:
+            return False
+        return parts[1] if len(parts) == 2 else None
+
+    def _handle(self, method):
+        service = self.server.service
+        job_id = self._job_id()
+
+        token = getattr(self.server, 'token', None)
+        if token is not None and not hmac.compare_digest(self.headers.get('Authorization', ''), 'Bearer ' + token):
+            return self._send(401, {'error': "Unauthorized"})
+
+        if job_id is False:
+            return self._send(404, {'error': "Not found: {}".format(self.path)})
+
+        try:
+            if method == 'POST' and job_id is None:
+                #no form posts: a cross-site page cannot send application/json without a preflight
+                if self.headers.get_content_type() != 'application/json':
+                    return self._send(415, {'error': "Jobs are submitted as application/json"})
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                job = service.submit(body.get('request', {}), body.get('priority', 0))
+                return self._send(201, job.to_dict())
+            elif method == 'GET' and job_id is None:
+                return self._send(200, [job.to_dict() for job in service.list_jobs()])
+            elif method == 'GET':
+                return self._send(200, service.get(job_id).to_dict())
+            elif method == 'DELETE' and job_id is not None:
+                return self._send(200, service.cancel(job_id).to_dict())
+        except Exception as e:
+            return self._send(400, {'error': str(e)})
+
+        return self._send(405, {'error': "Method not allowed"})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        pass #no access log on stderr
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, client_address = super().get_request()
+        return request, ('local', 0) #BaseHTTPRequestHandler expects a host, port pair
+
+
+def make_server(service, port=None, socket_path=None, token_path=None):
+    """Serve the service on a Unix socket only its owner can use (default), or on a
+    local TCP port, with a token written to token_path that clients must send."""
+    if port:
+        server = ThreadingHTTPServer(('127.0.0.1', port), ServiceRequestHandler)
+        server.token = write_token(token_path or default_token_path(port))
+    else:
+        socket_path = socket_path or default_socket_path()
+        Path(socket_path).parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        #created without group and other permissions, never connectable by other users
+        umask = os.umask(0o177)
+        try:
+            server = UnixHTTPServer(socket_path, ServiceRequestHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(socket_path, 0o600)
+
+    server.service = service
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path):
+        super().__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class ServiceClient(object):
+    """Submit, poll and cancel jobs of an ipype service."""
+
+    def __init__(self, port=None, socket_path=None, token=None, token_path=None):
+        self.port = port
+        self.socket_path = socket_path or default_socket_path()
+        self.token = token
+        if port and token is None:
+            self.token = read_token(token_path or default_token_path(port))
+
+    def _request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'}
+
+        if self.port:
+            connection = http.client.HTTPConnection('127.0.0.1', self.port)
+            headers['Authorization'] = 'Bearer ' + self.token
+        else:
+            connection = UnixHTTPConnection(self.socket_path)
+
+        try:
+            data = None if body is None else json.dumps(body).encode('utf-8')
+            connection.request(method, path, body=data, headers=headers)
+            response = connection.getresponse()
+            result = json.loads(response.read().decode('utf-8'))
+        finally:
+            connection.close()
+
+        if response.status >= 400:
+            raise Exception(result.get('error', response.reason))
+        return result
+
+    def submit(self, request, priority=0):
+        return self._request('POST', '/jobs', {'request': request, 'priority': priority})
+
+    def jobs(self):
+        return self._request('GET', '/jobs')
+
+    def job(self, job_id):
+        return self._request('GET', '/jobs/{}'.format(job_id))
+
+    def cancel(self, job_id):
+        return self._request('DELETE', '/jobs/{}'.format(job_id))
@@ -0,0 +1,214 @@
+import gc
+import os
+import csv
+import time
+import shutil
+import logging
+import tempfile
+import statistics
+import threading
+from pathlib import Path
+
+import nbformat
+from traitlets.config import Config
+
+from ipype.benchmark import benchmark_notebooks
+from ipype.artifacts import parse_size, format_size
+
+
+#resource -> default allowed growth from the warmup to the end of a soak
+DEFAULT_THRESHOLDS = {'rss': 64 * 1024 * 1024,
+                      'fds': 4,
+                      'threads': 2,
+                      'children': 0,
+                      }
+
+
+def current_rss():
+    #resident set size in bytes; the peak where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def open_fds():
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(fd_dir)) - 1 #the listdir's own fd
+        except OSError:
+            continue
+    return None
+
+
+def child_processes():
+    """Live child processes of this process (Linux only, None elsewhere)."""
+    try:
+        pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+    except OSError:
+        return None
+
+    children = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                #pid (comm) state ppid ...; comm may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[1]) == os.getpid() and fields[0] != 'Z':
+            children += 1
+    return children
+
+
+def take_sample(iteration):
+    gc.collect()
+    return {'iteration': iteration,
+            'time': time.time(),
+            'rss': current_rss(),
+            'fds': open_fds(),
+            'threads': threading.active_count(),
+            'children': child_processes(),
+            }
+
+
+def write_soak_pipeline(pipeline_dir, notebooks=3, cells=3, failing=False):
+    """Notebook files of a synthetic pipeline; with failing, its last notebook raises."""
+    pipeline_dir = Path(str(pipeline_dir))
+    pipeline_dir.mkdir(parents=True, exist_ok=True)
+
+    entries = benchmark_notebooks(notebooks, cells)
+    if failing:
+        entries[-1][1].cells.append(nbformat.v4.new_code_cell("raise RuntimeError('soak: failing notebook')"))
+
+    for index, (name, nb) in enumerate(entries):
+        nbformat.write(nb, str(pipeline_dir / "{:02d}_{}.ipynb".format(index, name)))
+
+    return pipeline_dir
+
+
+class SoakResult(object):
+    """Resource samples of a soak, and the resources that grew past their threshold."""
+
+    def __init__(self, samples, thresholds, warmup):
+        self.samples = samples
+        self.thresholds = thresholds
+        self.warmup = warmup
+
+    def growth(self, resource):
+        #medians, so that a single slow garbage collection does not count
+        values = [sample[resource] for sample in self.samples if sample[resource] is not None]
+        if len(values) < 2:
+            return 0
+        window = max(1, min(self.warmup, len(values) // 2))
+        return statistics.median(values[-window:]) - statistics.median(values[:window])
+
+    @property
+    def failures(self):
+        return [resource for resource, threshold in self.thresholds.items() if self.growth(resource) > threshold]
+
+    @property
+    def ok(self):
+        return not self.failures
+
+
+def run_soak(iterations=200, notebooks=3, cells=3, warmup=10, fail_every=0, thresholds=None,
+             kernel_backend='subprocess', work_dir=None, on_sample=None, log=None):
+    """Run a synthetic pipeline iterations times in this process and sample its resources after every run.
+
+    Every fail_every-th run uses a pipeline whose last notebook raises, to soak the
+    error paths too. Any other failed run stops the soak.
+    """
+    log = log or logging.getLogger(__name__)
+    thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+
+    temporary = work_dir is None
+    work_dir = Path(work_dir or tempfile.mkdtemp(prefix='ipype-soak-'))
+    pipeline_dir = write_soak_pipeline(work_dir / 'pipeline', notebooks, cells)
+    failing_pipeline_dir = write_soak_pipeline(work_dir / 'failing_pipeline', notebooks, cells, failing=True)
+    output_dir = work_dir / 'output'
+
+    samples = [take_sample(0)]
+
+    try:
+        for iteration in range(1, iterations + 1):
+            run_soak_iteration(iteration, pipeline_dir, failing_pipeline_dir, output_dir, fail_every, kernel_backend, log)
+
+            sample = take_sample(iteration)
+            samples.append(sample)
+            if on_sample is not None:
+                on_sample(sample)
+    finally:
+        if temporary:
+            shutil.rmtree(str(work_dir), ignore_errors=True)
+
+    return SoakResult(samples, thresholds, warmup)
+
+
+def run_soak_iteration(iteration, pipeline_dir, failing_pipeline_dir, output_dir, fail_every, kernel_backend, log):
+    from ipype.pipeline import IPypeApp, Pipeline
+
+    failing = fail_every > 0 and iteration % fail_every == 0
+
+    c = Config()
+    c.Pipeline.path = str(failing_pipeline_dir if failing else pipeline_dir)
+    c.Pipeline.output_dir = str(output_dir)
+    c.Pipeline.kernel_backend = kernel_backend
+
+    #every run logs to its own (unregistered) logger, like the runs of an ipype service
+    run_log = logging.Logger('ipype.soak.run')
+    run_log.parent = log
+
+    try:
+        app = IPypeApp(config=c, log=run_log)
+        app.pipeline = Pipeline(config=app.config, parent=app)
+        app.pipeline.initialize()
+        app.pipeline.start()
+    except Exception as e:
+        if not failing:
+            raise
+        log.debug("Run {} failed as expected: {}".format(iteration, e))
+        return
+
+    if failing:
+        raise Exception("Run {} should have failed".format(iteration))
+
+
+def write_soak_csv(result, path):
+    with open(str(path), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['iteration', 'time', 'rss', 'fds', 'threads', 'children'])
+        writer.writeheader()
+        writer.writerows(result.samples)
+
+
+def format_sample(sample):
+    return "{:>6}  rss {:>9}  fds {:>5}  threads {:>3}  children {:>3}".format(
+        sample['iteration'], format_size(sample['rss']), str(sample['fds']), sample['threads'], str(sample['children']))
+
+
+def format_soak(result):
+    lines = []
+
+    for resource, threshold in result.thresholds.items():
+        growth = result.growth(resource)
+        if resource == 'rss':
+            growth, threshold = format_size(growth), format_size(threshold)
+        lines.append("{:<9} grew {:>9} (threshold {:>9})  {}".format(
+            resource, str(growth), str(threshold), "FAILED" if resource in result.failures else "ok"))
+
+    lines.append("")
+    lines.append("{} runs: {}".format(len(result.samples) - 1, "ok" if result.ok else "leaking " + ", ".join(result.failures)))
+
+    return "\n".join(lines)
+
+
+def parse_thresholds(max_rss_growth=None, max_fd_growth=None, max_thread_growth=None, max_child_growth=None):
+    thresholds = {}
+    if max_rss_growth is not None:
+        thresholds['rss'] = parse_size(max_rss_growth)
+    for resource, value in (('fds', max_fd_growth), ('threads', max_thread_growth), ('children', max_child_growth)):
+        if value is not None:
+            thresholds[resource] = value
+    return thresholds
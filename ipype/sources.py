@@ -0,0 +1,243 @@
+import os
+import json
+import shutil
+import hashlib
+import zipfile
+import subprocess
+from fnmatch import fnmatch
+from zipfile import is_zipfile
+from pathlib import Path
+
+from ipype.storage import atomic_write
+
+
+LINK_MODES = ['hardlink', 'reflink', 'copy']
+SOURCES_MANIFEST = '.sources.json'
+
+#linux ioctl cloning a file's extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def default_source_store():
+    return str(Path(os.environ.get('XDG_CACHE_HOME', str(Path.home() / '.cache'))) / 'ipype' / 'sources')
+
+
+def _digest_stream(f):
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def match_source_file(name, pattern):
+    #patterns without a / only match files at the top of the source
+    if '/' not in pattern and '/' in name:
+        return False
+    return fnmatch(name, pattern)
+
+
+def is_git_checkout(path):
+    return (Path(str(path)) / '.git').exists()
+
+
+def git_source_files(path):
+    #tracked files, and untracked ones that are not ignored (e.g. a new notebook)
+    output = subprocess.check_output(['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard'],
+                                     cwd=str(path))
+    return sorted(set(name for name in output.decode('utf-8').split('\0') if name))
+
+
+def git_commit(path):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(path)).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def reflink(src, dst):
+    import fcntl
+    with open(str(src), 'rb') as fsrc, open(str(dst), 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+class SourceStore(object):
+    """Content-addressed store of pipeline sources.
+
+    Every file is stored once under objects/<digest[:2]>/<digest[2:]>, read-only,
+    and pipeline dirs are populated with hardlinks (or reflinks, or copies across
+    file systems) to the stored objects. Digests of unchanged source files are
+    looked up by size and mtime instead of re-reading the files.
+    """
+
+    def __init__(self, store_dir, link_mode='hardlink'):
+        if link_mode not in LINK_MODES:
+            raise Exception("Unknown link mode {}: use one of {}.".format(link_mode, ", ".join(LINK_MODES)))
+
+        self.store_dir = Path(str(store_dir))
+        self.link_mode = link_mode
+        self.index_pth = self.store_dir / 'index.json'
+        self._index = None
+        self._index_modified = False
+
+    def object_path(self, digest):
+        return self.store_dir / 'objects' / digest[:2] / digest[2:]
+
+    def has(self, digest):
+        return self.object_path(digest).exists()
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(str(self.index_pth)) as f:
+                    self._index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self._index = {}
+        return self._index
+
+    def save_index(self):
+        if self._index_modified:
+            atomic_write(self.index_pth, json.dumps(self._index).encode('utf-8'))
+            self._index_modified = False
+
+    def _cached_digest(self, key, stamp):
+        entry = self._load_index().get(key)
+        if entry is not None and entry[:-1] == list(stamp):
+            return entry[-1]
+        return None
+
+    def _cache_digest(self, key, stamp, digest):
+        self._load_index()[key] = list(stamp) + [digest]
+        self._index_modified = True
+
+    def _store(self, digest, write):
+        #write(tmp_pth) fills a temporary file that becomes the object
+        object_pth = self.object_path(digest)
+        if object_pth.exists():
+            return digest
+
+        object_pth.parent.mkdir(parents=True, exist_ok=True)
+        tmp_pth = object_pth.with_name(object_pth.name + '.{}.tmp'.format(os.getpid()))
+        try:
+            write(tmp_pth)
+            os.chmod(str(tmp_pth), 0o444) #shared by every pipeline dir linking to it
+            os.replace(str(tmp_pth), str(object_pth))
+        except:
+            if tmp_pth.exists():
+                tmp_pth.unlink()
+            raise
+
+        return digest
+
+    def add_file(self, path):
+        path = Path(str(path)).absolute()
+        stat = path.stat()
+        stamp = (stat.st_size, stat.st_mtime_ns)
+
+        digest = self._cached_digest(str(path), stamp)
+        if digest is None:
+            with open(str(path), 'rb') as f:
+                digest = _digest_stream(f)
+            self._cache_digest(str(path), stamp, digest)
+
+        return self._store(digest, lambda tmp_pth: shutil.copyfile(str(path), str(tmp_pth)))
+
+    def add_zip_member(self, zipped, zipinfo):
+        key = "{}:{}".format(Path(zipped.filename).absolute(), zipinfo.filename)
+        stamp = (zipinfo.file_size, zipinfo.CRC)
+
+        digest = self._cached_digest(key, stamp)
+        if digest is None:
+            with zipped.open(zipinfo) as f:
+                digest = _digest_stream(f)
+            self._cache_digest(key, stamp, digest)
+
+        def write(tmp_pth):
+            with zipped.open(zipinfo) as fsrc, open(str(tmp_pth), 'wb') as fdst:
+                shutil.copyfileobj(fsrc, fdst)
+
+        return self._store(digest, write)
+
+    def link(self, digest, dst):
+        """Make dst a link to (or a copy of) the stored object; existing links are kept."""
+        dst = Path(str(dst))
+        object_pth = self.object_path(digest)
+
+        try:
+            if os.path.samefile(str(dst), str(object_pth)):
+                return dst
+        except FileNotFoundError:
+            pass
+
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp_pth = dst.with_name('.' + dst.name + '.tmp')
+        if tmp_pth.exists():
+            tmp_pth.unlink()
+
+        modes = LINK_MODES[LINK_MODES.index(self.link_mode):]
+        for mode in modes:
+            try:
+                if mode == 'hardlink':
+                    os.link(str(object_pth), str(tmp_pth))
+                elif mode == 'reflink':
+                    reflink(object_pth, tmp_pth)
+                else:
+                    shutil.copyfile(str(object_pth), str(tmp_pth))
+                break
+            except (OSError, ImportError):
+                if tmp_pth.exists():
+                    tmp_pth.unlink()
+                if mode == modes[-1]:
+                    raise
+
+        #replaces dst even when it is the source file itself (rerun of an output dir)
+        os.replace(str(tmp_pth), str(dst))
+
+        return dst
+
+    def add_source(self, source, patterns=('*.ipynb',), files=()):
+        """Store the files of a source dir, zip, git checkout or single file; returns {relative path: digest}.
+
+        Files (relative paths) are stored even when a git checkout ignores them.
+        """
+        source = Path(str(source)).absolute()
+        matches = lambda name: name in files or any(match_source_file(name, pattern) for pattern in patterns)
+        digests = {}
+
+        if source.is_dir():
+            if is_git_checkout(source):
+                names = sorted(set(git_source_files(source)) | set(files))
+            else:
+                names = [pth.relative_to(source).as_posix() for pth in sorted(source.rglob('*')) \
+                         if pth.is_file() and not any(part.startswith('.') for part in pth.relative_to(source).parts)]
+
+            for name in names:
+                if matches(name) and (source / name).is_file():
+                    digests[name] = self.add_file(source / name)
+
+        elif is_zipfile(str(source)):
+            with zipfile.ZipFile(str(source), 'r') as zipped:
+                for zipinfo in zipped.infolist():
+                    if not zipinfo.is_dir() and matches(zipinfo.filename):
+                        digests[zipinfo.filename] = self.add_zip_member(zipped, zipinfo)
+
+        else:
+            digests[source.name] = self.add_file(source)
+
+        self.save_index()
+
+        return digests
+
+    def populate(self, source, pipeline_dir, patterns=('*.ipynb',), files=()):
+        """Populate pipeline_dir with links to the source files matching patterns, and to files."""
+        pipeline_dir = Path(str(pipeline_dir))
+        digests = self.add_source(source, patterns, files)
+
+        for name, digest in digests.items():
+            self.link(digest, pipeline_dir / name)
+
+        manifest = {'source': str(source), 'files': digests}
+        if Path(str(source)).is_dir() and is_git_checkout(source):
+            manifest['git_commit'] = git_commit(source)
+        atomic_write(pipeline_dir / SOURCES_MANIFEST, json.dumps(manifest, indent=1).encode('utf-8'))
+
+        return digests
@@ -0,0 +1,83 @@
+import os
+import shutil
+from collections import namedtuple
+from pathlib import Path
+
+
+#working dirs of speculative runs, under tmp/ of the output dir
+SPECULATIVE_SUBDIR = 'speculative'
+#output subdirs written by a speculative run, moved into the output dir when it is kept
+PROMOTED_SUBDIRS = ['data', 'results', 'logs', 'tmp']
+#copies of the input files of a speculative run, in its working dir (never promoted)
+SNAPSHOT_SUBDIR = 'inputs'
+
+
+#a notebook run ahead of its turn, in working_dir, with the inputs recorded by the previous run;
+#inputs_hash is the hash of the snapshot of the input files it actually read
+Speculation = namedtuple('Speculation', ['index', 'inputs', 'inputs_hash', 'working_dir', 'preprocessor', 'future'])
+
+
+def snapshot_inputs(inputs, snapshot_dir):
+    """Inputs referring to copies (in snapshot_dir) of the files they refer to; None if one refers to a dir.
+
+    Like calculate_notebook_node_hash, only string values and the strings of
+    list values are taken as paths.
+    """
+    snapshot_dir = Path(str(snapshot_dir))
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    copies = {}
+
+    def snapshot(value):
+        if not isinstance(value, str):
+            return value
+
+        pth = Path(value)
+        try:
+            if pth.is_dir():
+                raise IsADirectoryError(value)
+            if not pth.is_file():
+                return value
+        except IsADirectoryError:
+            raise
+        except OSError:
+            return value #not a path, e.g. too long
+
+        if value not in copies:
+            copy = snapshot_dir / '{}_{}'.format(len(copies), pth.name)
+            shutil.copyfile(str(pth), str(copy))
+            copies[value] = str(copy.absolute())
+        return copies[value]
+
+    try:
+        return {key: type(value)(snapshot(v) for v in value) if isinstance(value, (list, tuple)) else snapshot(value)
+                for key, value in inputs.items()}
+    except IsADirectoryError:
+        return None
+
+
+def relocate(value, working_dir, output_dir):
+    #paths into the working dir of a kept speculative run, as they are once promoted
+    working_dir = str(working_dir)
+
+    if isinstance(value, str):
+        if value == working_dir or value.startswith(working_dir + os.sep):
+            return str(output_dir) + value[len(working_dir):]
+        return value
+    elif isinstance(value, dict):
+        return type(value)((key, relocate(v, working_dir, output_dir)) for key, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return type(value)(relocate(v, working_dir, output_dir) for v in value)
+
+    return value
+
+
+def promote_outputs(working_dir, output_dir):
+    """Move the files written by a kept speculative run into the output dir."""
+    working_dir = Path(str(working_dir))
+
+    for subdir in PROMOTED_SUBDIRS:
+        for pth in sorted((working_dir / subdir).rglob('*')):
+            if pth.is_file():
+                target = Path(str(output_dir)) / pth.relative_to(working_dir)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(str(pth), str(target))
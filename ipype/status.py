@@ -0,0 +1,147 @@
+import json
+import time
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ipype.storage import atomic_write
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+
+class StatusTracker(object):
+    """Live status of a pipeline run.
+
+    Notified like any other preprocessor observer, it keeps the current
+    notebook and cell, elapsed time, throughput and per-notebook state. The
+    model is rewritten atomically to a status JSON file (at most every
+    write_interval seconds) and, with a port, served over local HTTP.
+    """
+
+    def __init__(self, status_pth, write_interval=1.0, port=0):
+        self.status_pth = status_pth
+        self.write_interval = write_interval
+        self.port = port
+
+        self._lock = threading.RLock()
+        #notebook run by the current thread (mapped instances run in parallel)
+        self._local = threading.local()
+        self._last_write = 0
+        self._server = None
+
+        self.started = time.time()
+        self.state = PENDING
+        self.current_notebook = None
+        self.cells_executed = 0
+        self.notebooks = {}
+
+        if port:
+            self.serve(port)
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = time.time() - self.started
+            running = [name for name, notebook in self.notebooks.items() if notebook['state'] == RUNNING]
+            current = self.notebooks.get(self.current_notebook, {})
+
+            return {
+                'state': self.state,
+                'started': datetime.fromtimestamp(self.started).isoformat(),
+                'elapsed_seconds': round(elapsed, 1),
+                'current_notebook': self.current_notebook,
+                'current_cell': current.get('cell'),
+                'current_total_cells': current.get('total_cells'),
+                'running_notebooks': running,
+                'cells_executed': self.cells_executed,
+                'cells_per_minute': round(self.cells_executed / (elapsed / 60.0), 2) if elapsed > 0 else 0.0,
+                'notebooks': {name: dict(notebook) for name, notebook in self.notebooks.items()},
+            }
+
+    def write(self, force=False):
+        with self._lock:
+            now = time.time()
+            if not force and now - self._last_write < self.write_interval:
+                return
+            self._last_write = now
+            status = self.snapshot()
+
+        atomic_write(self.status_pth, json.dumps(status, indent=1).encode('utf-8'))
+
+    def run_started(self, notebook_names):
+        with self._lock:
+            self.started = time.time()
+            self.state = RUNNING
+            for name in notebook_names:
+                self.notebooks[name] = {'state': PENDING}
+        self.write(force=True)
+
+    def run_finished(self, failed=False):
+        with self._lock:
+            self.state = FAILED if failed else FINISHED
+        self.write(force=True)
+
+    #preprocessor observer interface
+    def notebook_started(self, nb, resources):
+        name = nb['metadata']['pipeline_info']['notebook_name']
+        total_cells = len([cell for cell in nb['cells'] if cell['cell_type'] == 'code'])
+
+        with self._lock:
+            self.current_notebook = self._local.notebook = name
+            self.notebooks[name] = {'state': RUNNING,
+                                    'started': datetime.now().isoformat(),
+                                    'cell': 0,
+                                    'total_cells': total_cells}
+        self.write(force=True)
+
+    def cell_executed(self, cell, cell_index):
+        with self._lock:
+            self.cells_executed += 1
+            notebook = self.notebooks.get(getattr(self._local, 'notebook', self.current_notebook))
+            if notebook is not None:
+                notebook['cell'] = notebook.get('cell', 0) + 1
+        self.write()
+
+    def notebook_failed(self, nb, resources):
+        name = nb['metadata']['pipeline_info']['notebook_name']
+        with self._lock:
+            self.notebooks.setdefault(name, {})['state'] = FAILED
+
+    def notebook_finished(self, nb, resources):
+        name = nb['metadata']['pipeline_info']['notebook_name']
+        with self._lock:
+            notebook = self.notebooks.setdefault(name, {})
+            if notebook.get('state') != FAILED:
+                notebook['state'] = FINISHED
+            notebook['finished'] = datetime.now().isoformat()
+        self.write(force=True)
+
+    def serve(self, port, host='127.0.0.1'):
+        tracker = self
+
+        class StatusRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(tracker.snapshot()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass #no access log on stderr
+
+        self._server = ThreadingHTTPServer((host, port), StatusRequestHandler)
+        thread = threading.Thread(target=self._server.serve_forever, name='ipype-status', daemon=True)
+        thread.start()
+
+        return self._server.server_address
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,301 @@
+import os
+import io
+import time
+import gzip
+import tarfile
+import zipfile
+import tempfile
+import threading
+from pathlib import Path
+
+import nbformat
+
+
+OUTPUT_MODES = ['files', 'gzip', 'zip', 'tar.gz', 'tar.xz']
+ARCHIVE_FORMATS = ['zip', 'tar.gz', 'tar.xz']
+ARCHIVE_NAME = 'outputs'
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def atomic_write(path, data):
+    """Write bytes to path through a temporary file in the same dir and a rename."""
+    path = Path(str(path))
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix='.' + path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, str(path))
+    except:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    return path
+
+
+def gzip_bytes(data):
+    #mtime=0 keeps the compressed bytes reproducible
+    return gzip.compress(data, mtime=0)
+
+
+def maybe_gunzip(data):
+    if data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    return data
+
+
+def notebook_to_bytes(nb):
+    from ipype.validation import notebook_digest, validate_notebook
+    
+    nb = nbformat.convert(nb, nbformat.current_nbformat)
+    data = nbformat.versions[nbformat.current_nbformat].writes_json(nb).encode('utf-8')
+    
+    #validated once here, later reads of the same bytes (in this process) skip the schema;
+    #freshly executed notebooks are all unseen, their verdicts are not persisted
+    error = validate_notebook(nb, notebook_digest(data), persist=False)
+    if error is not None:
+        nbformat.get_logger().error("Notebook JSON is invalid: %s", error)
+    
+    return data
+
+
+def bytes_to_notebook(data):
+    """Parse a (gzipped) notebook; the schema validation runs once per content digest."""
+    from ipype.validation import notebook_digest, validate_notebook
+    
+    data = maybe_gunzip(data)
+    nb = nbformat.convert(nbformat.reader.reads(data.decode('utf-8')), nbformat.current_nbformat)
+    
+    error = validate_notebook(nb, notebook_digest(data))
+    if error is not None:
+        nbformat.get_logger().error("Notebook JSON is invalid: %s", error)
+    
+    return nb
+
+
+def find_output_archive(directory):
+    for fmt in ARCHIVE_FORMATS:
+        archive_pth = Path(str(directory)) / '{}.{}'.format(ARCHIVE_NAME, fmt)
+        if archive_pth.is_file():
+            return archive_pth
+    return None
+
+
+def read_archive_member(archive_pth, member):
+    archive_pth = Path(str(archive_pth))
+
+    if archive_pth.name.endswith('.zip'):
+        with zipfile.ZipFile(str(archive_pth), 'r') as zipped:
+            return zipped.read(member)
+    else:
+        with tarfile.open(str(archive_pth), 'r:*') as tarred:
+            return tarred.extractfile(tarred.getmember(member)).read()
+
+
+def iter_archive_members(archive_pth, prefix=''):
+    """(name, bytes) of the file members of an output archive under prefix, in one pass."""
+    archive_pth = Path(str(archive_pth))
+
+    if archive_pth.name.endswith('.zip'):
+        with zipfile.ZipFile(str(archive_pth), 'r') as zipped:
+            for info in zipped.infolist():
+                if not info.is_dir() and info.filename.startswith(prefix):
+                    yield info.filename, zipped.read(info)
+    else:
+        with tarfile.open(str(archive_pth), 'r:*') as tarred:
+            for tarinfo in tarred:
+                if tarinfo.isfile() and tarinfo.name.startswith(prefix):
+                    yield tarinfo.name, tarred.extractfile(tarinfo).read()
+
+
+def read_archived_bytes(path):
+    """Look for path inside an output archive of any of its parent dirs."""
+    path = Path(str(path)).absolute()
+
+    for parent in path.parents:
+        archive_pth = find_output_archive(parent)
+        if archive_pth is None:
+            continue
+        try:
+            return read_archive_member(archive_pth, path.relative_to(parent).as_posix())
+        except KeyError:
+            continue
+
+    raise FileNotFoundError(str(path))
+
+
+def read_output_bytes(path):
+    """Read (decompressed) bytes of an output file written in any output mode."""
+    path = Path(str(path))
+
+    for candidate in (path, path.with_name(path.name + '.gz')):
+        if candidate.is_file():
+            with open(str(candidate), 'rb') as f:
+                return maybe_gunzip(f.read())
+
+    return maybe_gunzip(read_archived_bytes(path))
+
+
+class FilesStorage(object):
+    """Writes every output artifact as a separate file, atomically."""
+    is_archive = False
+    notebook_suffix = ''
+
+    def __init__(self, output_dir):
+        self.output_dir = Path(str(output_dir)).absolute()
+
+    def _relpath(self, path):
+        path = Path(str(path))
+        if path.is_absolute():
+            path = path.relative_to(self.output_dir)
+        return path.as_posix()
+
+    def _encode_notebook(self, nb):
+        return notebook_to_bytes(nb)
+
+    def write_bytes(self, path, data):
+        return atomic_write(self.output_dir / self._relpath(path), data)
+
+    def write_text(self, path, text):
+        return self.write_bytes(path, text.encode('utf-8'))
+
+    def notebook_path(self, path):
+        """The path a notebook written to path can be read back from."""
+        return self.output_dir / (self._relpath(path) + self.notebook_suffix)
+
+    def write_notebook(self, nb, path):
+        """Write nb and return the path it can be read back from."""
+        path = self.notebook_path(path)
+        self.write_bytes(path, self._encode_notebook(nb))
+        return path
+
+    def read_bytes(self, path):
+        return read_output_bytes(self.output_dir / self._relpath(path))
+
+    def read_notebook(self, path):
+        return bytes_to_notebook(self.read_bytes(path))
+
+    def close(self):
+        pass
+
+
+class GzipStorage(FilesStorage):
+    """Writes notebooks as compressed .ipynb.gz files."""
+    notebook_suffix = '.gz'
+
+    def _encode_notebook(self, nb):
+        return gzip_bytes(notebook_to_bytes(nb))
+
+
+class ArchiveStorage(FilesStorage):
+    """Streams all artifacts into one compressed archive in the output dir.
+
+    The archive is written to a temporary file and renamed into place on close,
+    together with the members of the previous archive not written again (e.g.
+    the notebooks not selected for this run).
+    """
+    is_archive = True
+    #bytes of tar members kept in memory before their copies spill to a temporary file
+    spool_max_size = 16 * 1024 * 1024
+
+    def __init__(self, output_dir, archive_format='zip'):
+        super().__init__(output_dir)
+
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError("Unknown archive format: {}".format(archive_format))
+
+        self.archive_format = archive_format
+        self.archive_pth = self.output_dir / '{}.{}'.format(ARCHIVE_NAME, archive_format)
+        self._tmp_pth = self.archive_pth.with_name(self.archive_pth.name + '.tmp')
+        self._lock = threading.Lock()
+        #written members -> (offset, size) of their copy in the spool, for tar archives:
+        #a compressed tar stream cannot be read back while it is still open
+        self._members = {}
+        self._spool = None
+
+        if archive_format == 'zip':
+            self._archive = zipfile.ZipFile(str(self._tmp_pth), 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self._archive = tarfile.open(str(self._tmp_pth), 'w:' + archive_format.split('.')[-1])
+            self._spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+
+    def write_bytes(self, path, data):
+        member = self._relpath(path)
+
+        with self._lock:
+            if self.archive_format == 'zip':
+                self._archive.writestr(member, data)
+            else:
+                tarinfo = tarfile.TarInfo(member)
+                tarinfo.size = len(data)
+                tarinfo.mtime = int(time.time())
+                self._archive.addfile(tarinfo, io.BytesIO(data))
+
+            spooled = None
+            if self._spool is not None:
+                self._spool.seek(0, io.SEEK_END)
+                spooled = (self._spool.tell(), len(data))
+                self._spool.write(data)
+            self._members[member] = spooled
+
+        return self.output_dir / member
+
+    def read_bytes(self, path):
+        member = self._relpath(path)
+
+        with self._lock:
+            if self._archive is not None and member in self._members:
+                if self._spool is None:
+                    return self._archive.read(member)
+                offset, size = self._members[member]
+                self._spool.seek(offset)
+                return self._spool.read(size)
+
+        return super().read_bytes(path)
+
+    def _carry_over_previous(self):
+        #members of the previous archive this run did not write again
+        if not self.archive_pth.is_file():
+            return
+
+        if self.archive_format == 'zip':
+            with zipfile.ZipFile(str(self.archive_pth), 'r') as previous:
+                for info in previous.infolist():
+                    if info.filename not in self._members:
+                        self._archive.writestr(info, previous.read(info))
+        else:
+            with tarfile.open(str(self.archive_pth), 'r:*') as previous:
+                for tarinfo in previous:
+                    if tarinfo.name not in self._members:
+                        self._archive.addfile(tarinfo, previous.extractfile(tarinfo) if tarinfo.isfile() else None)
+
+    def close(self):
+        with self._lock:
+            if self._archive is None:
+                return
+            try:
+                self._carry_over_previous()
+            finally:
+                self._archive.close()
+                self._archive = None
+                self._members = {}
+                if self._spool is not None:
+                    self._spool.close()
+                    self._spool = None
+            os.replace(str(self._tmp_pth), str(self.archive_pth))
+
+
+def make_storage(output_dir, output_mode='files'):
+    if output_mode == 'files':
+        return FilesStorage(output_dir)
+    elif output_mode == 'gzip':
+        return GzipStorage(output_dir)
+    elif output_mode in ARCHIVE_FORMATS:
+        return ArchiveStorage(output_dir, output_mode)
+    else:
+        raise ValueError("Unknown output mode: {}".format(output_mode))
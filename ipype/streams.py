@@ -0,0 +1,80 @@
+from collections import deque
+from pathlib import Path
+
+
+OMITTED_NOTICE = "\n... [{omitted} lines omitted; full output in {log}] ...\n\n"
+#without a log dir the omitted lines are not kept anywhere
+DROPPED_NOTICE = "\n... [{omitted} lines omitted; output truncated, not kept] ...\n\n"
+
+#a "line" without a newline (e.g. a progress bar using \r) is cut at this length
+MAX_PARTIAL_LINE = 65536
+
+
+class StreamBuffer(object):
+    """Coalesced text of one output stream of one cell, bounded in memory.
+
+    The first head_lines and the last tail_lines lines are kept. Once the
+    head is full, the whole stream is written to log_pth, so nothing is lost.
+    """
+
+    def __init__(self, head_lines=500, tail_lines=500, log_pth=None):
+        self.head_lines = head_lines
+        self.log_pth = log_pth
+        self.head = []
+        self.tail = deque(maxlen=tail_lines)
+        self.total_lines = 0
+        self.output = None
+        self._partial = ''
+        self._log = None
+
+    def _spill(self, text):
+        if self.log_pth is None:
+            return
+
+        if self._log is None:
+            Path(str(self.log_pth)).parent.mkdir(parents=True, exist_ok=True)
+            self._log = open(str(self.log_pth), 'w')
+            self._log.write(''.join(self.head))
+
+        self._log.write(text)
+
+    def add(self, text):
+        text = self._partial + text
+        self._partial = ''
+
+        lines = text.splitlines(True)
+        if lines and not lines[-1].endswith(('\n', '\r')):
+            self._partial = lines.pop()
+            if len(self._partial) > MAX_PARTIAL_LINE:
+                lines.append(self._partial)
+                self._partial = ''
+
+        for line in lines:
+            self.total_lines += 1
+            if len(self.head) < self.head_lines:
+                self.head.append(line)
+            else:
+                self._spill(line)
+                self.tail.append(line)
+
+    @property
+    def omitted(self):
+        return self.total_lines - len(self.head) - len(self.tail)
+
+    def text(self):
+        parts = list(self.head)
+
+        if self.omitted > 0:
+            notice = OMITTED_NOTICE if self.log_pth is not None else DROPPED_NOTICE
+            parts.append(notice.format(omitted=self.omitted, log=self.log_pth))
+
+        parts.extend(self.tail)
+        parts.append(self._partial)
+
+        return ''.join(parts)
+
+    def close(self):
+        if self._log is not None:
+            self._log.write(self._partial)
+            self._log.close()
+            self._log = None
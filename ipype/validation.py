@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import nbformat
+from nbformat.validator import validate, ValidationError
+
+
+#verdicts kept in memory and in the persistent cache
+MAX_VERDICTS = 10000
+
+CELL_TYPES = ('code', 'markdown', 'raw')
+
+
+def default_validation_cache():
+    #verdicts are kept in memory only, unless IPYPE_VALIDATION_CACHE names a file to persist them in
+    return os.environ.get('IPYPE_VALIDATION_CACHE') or None
+
+
+def notebook_digest(data):
+    #verdicts of another nbformat (schema) version do not count
+    md5 = hashlib.md5(nbformat.__version__.encode('utf-8'))
+    md5.update(data)
+    return md5.hexdigest()
+
+
+def check_notebook_structure(nb):
+    """Cheap checks of the nbformat 4 layout, before the JSON schema; returns an error or None."""
+    if not isinstance(nb, dict):
+        return "not a JSON object"
+    if nb.get('nbformat') != 4:
+        return None #older formats are left to their schema
+    if not isinstance(nb.get('nbformat_minor'), int):
+        return "no nbformat_minor"
+    if not isinstance(nb.get('metadata'), dict):
+        return "metadata is not an object"
+    if not isinstance(nb.get('cells'), list):
+        return "cells is not a list"
+
+    for index, cell in enumerate(nb['cells']):
+        if not isinstance(cell, dict) or cell.get('cell_type') not in CELL_TYPES:
+            return "cell {} has no valid cell_type".format(index)
+        if not isinstance(cell.get('source'), (str, list)):
+            return "cell {} has no source".format(index)
+        if cell['cell_type'] == 'code' and not isinstance(cell.get('outputs'), list):
+            return "code cell {} has no outputs list".format(index)
+
+    return None
+
+
+class ValidationCache(object):
+    """Validation verdicts of notebooks by content digest.
+
+    With a path, new verdicts are appended to a JSON lines file, which is
+    compacted to the MAX_VERDICTS latest ones when it grows beyond twice as
+    many lines.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self._verdicts = None
+        self._lines = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self._verdicts = OrderedDict()
+        if self.path is None:
+            return
+
+        lines = 0
+        try:
+            with open(str(self.path)) as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        digest, error = json.loads(line)
+                    except ValueError:
+                        continue #a line cut short by a crash
+                    self._verdicts[digest] = error
+                    self._verdicts.move_to_end(digest)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logging.getLogger(__name__).warning("Could not read the validation cache: {}".format(e))
+            self.path = None
+            return
+
+        self._lines = lines
+        self._trim()
+        if lines > 2 * MAX_VERDICTS:
+            self._compact()
+
+    def _trim(self):
+        while len(self._verdicts) > MAX_VERDICTS:
+            self._verdicts.popitem(last=False)
+
+    def _compact(self):
+        from ipype.storage import atomic_write
+
+        data = "".join(json.dumps([digest, error]) + "\n" for digest, error in self._verdicts.items())
+        atomic_write(self.path, data.encode('utf-8'))
+        self._lines = len(self._verdicts)
+
+    def get(self, digest):
+        """(True, error or None) for a known digest, (False, None) otherwise."""
+        with self._lock:
+            if self._verdicts is None:
+                self._load()
+            if digest not in self._verdicts:
+                return False, None
+            return True, self._verdicts[digest]
+
+    def put(self, digest, error, persist=True):
+        """Record a verdict; without persist (e.g. for a notebook just serialized by ipype) in memory only."""
+        with self._lock:
+            if self._verdicts is None:
+                self._load()
+            self._verdicts[digest] = error
+            self._trim()
+
+            if self.path is None or not persist:
+                return
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                #one short line per write: appends of concurrent processes do not interleave
+                with open(str(self.path), 'a') as f:
+                    f.write(json.dumps([digest, error]) + "\n")
+                self._lines += 1
+                if self._lines > 2 * MAX_VERDICTS:
+                    self._compact()
+            except OSError as e:
+                logging.getLogger(__name__).warning("Could not write the validation cache: {}".format(e))
+                self.path = None
+
+
+_cache = None
+
+
+def validation_cache():
+    global _cache
+    if _cache is None:
+        _cache = ValidationCache(default_validation_cache())
+    return _cache
+
+
+def validate_notebook(nb, digest=None, persist=True):
+    """Validate nb against the nbformat schema once per content digest; returns an error or None."""
+    if digest is not None:
+        known, error = validation_cache().get(digest)
+        if known:
+            return error
+
+    error = check_notebook_structure(nb)
+    if error is None:
+        try:
+            validate(nb)
+        except ValidationError as e:
+            #short, so that a verdict is one small line of the cache
+            error = str(e).split("\n")[0][:200]
+
+    if digest is not None:
+        validation_cache().put(digest, error, persist)
+
+    return error
@@ -0,0 +1,91 @@
+import mimetypes
+from pathlib import Path
+from urllib.parse import unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ipype.report import ReportRenderer, INDEX_FILENAME, EXEC_SUFFIX, find_executed_notebooks, \
+    executed_notebook_name, render_html_index
+from ipype.storage import bytes_to_notebook
+
+
+class ReportViewer(object):
+    """Serves the html reports of an output dir, rendering each one when it is first requested.
+
+    Rendered reports are cached in html/ by executed-notebook hash, like ipype render.
+    """
+
+    def __init__(self, output_dir, title=None, external_images=False):
+        self.output_dir = Path(str(output_dir)).absolute()
+        self.title = title or self.output_dir.name
+        self.renderer = ReportRenderer(self.output_dir, external_images=external_images)
+        self.renderer.write_static_assets()
+
+    def index_html(self):
+        entries = []
+        exec_notebooks = list(find_executed_notebooks(self.output_dir))
+
+        for exec_notebook in exec_notebooks:
+            try:
+                nb = bytes_to_notebook(self.renderer.storage.read_bytes(exec_notebook))
+            except FileNotFoundError:
+                continue
+            pipeline_info = nb['metadata'].get('pipeline_info', {})
+            exec_notebooks.extend(pipeline_info.get('map_instances', []))
+
+            notebook_name = executed_notebook_name(exec_notebook)
+            entries.append({'name': notebook_name,
+                            'href': notebook_name + ".html",
+                            'started': pipeline_info.get('notebook_started'),
+                            'finished': pipeline_info.get('notebook_finished'),
+                            })
+
+        return render_html_index(entries, title=self.title)
+
+    def report_path(self, html_name):
+        """Path of an up-to-date html report, rendered if needed; None if there is no such notebook."""
+        exec_notebook = self.output_dir / 'exec_notebooks' / (html_name[:-len('.html')] + EXEC_SUFFIX)
+
+        if self.renderer.render(exec_notebook) is None:
+            return None
+
+        self.renderer.save()
+        return self.renderer.html_dir / html_name
+
+    def serve(self, port=8000, host='127.0.0.1'):
+        viewer = self
+
+        class ReportRequestHandler(BaseHTTPRequestHandler):
+            def _send(self, code, body, content_type='text/html; charset=utf-8'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                name = unquote(self.path.split('?')[0]).lstrip('/') or INDEX_FILENAME
+
+                if name == INDEX_FILENAME:
+                    return self._send(200, viewer.index_html().encode('utf-8'))
+
+                if name.endswith('.html') and '/' not in name:
+                    pth = viewer.report_path(name)
+                else:
+                    #static assets next to the reports
+                    pth = (viewer.renderer.html_dir / name).resolve()
+                    if viewer.renderer.html_dir.resolve() not in pth.parents or not pth.is_file():
+                        pth = None
+
+                if pth is None:
+                    return self._send(404, b"Not found")
+
+                content_type = mimetypes.guess_type(str(pth))[0] or 'application/octet-stream'
+                self._send(200, pth.read_bytes(), content_type)
+
+            def log_message(self, format, *args):
+                pass #no access log on stderr
+
+        server = ThreadingHTTPServer((host, port), ReportRequestHandler)
+        server.daemon_threads = True
+
+        return server
@@ -0,0 +1,250 @@
+import time
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from zipfile import is_zipfile
+
+from traitlets.config import Config
+
+from ipype.notebook import ZipFileTuple, read_notebook_source_bytes, get_notebook_declarations
+from ipype.storage import bytes_to_notebook
+from ipype.planner import RUN, notebook_file_name, plan_pipeline
+from ipype.registry import EXECUTED
+
+
+CONFIG_FILES = ['config.py', 'config.json']
+
+
+def downstream_notebooks(declarations, changed):
+    """Indices of the changed notebooks and of all the notebooks depending on them.
+
+    A notebook declaring __inputs__ depends on the notebooks producing them (as
+    declared __outputs__), a notebook without __inputs__ on all notebooks before it.
+    """
+    affected = set(changed)
+    producers = {} #output name -> index of the last notebook declaring it
+
+    for index, declarations_ in enumerate(declarations):
+        if '__inputs__' in declarations_:
+            upstream = set(producers.get(input_) for input_ in declarations_['__inputs__']) - {None}
+        else:
+            upstream = set(range(index))
+
+        if upstream & affected:
+            affected.add(index)
+
+        for output in declarations_.get('__outputs__', []):
+            producers[output] = index
+
+    return sorted(affected)
+
+
+class SourceState(object):
+    """Notebook and config digests and declared input files of a pipeline source."""
+
+    def __init__(self, path, notebook_pattern="*.ipynb"):
+        from ipype.pipeline import find_pipeline_notebooks
+
+        self.path = Path(str(path)).absolute()
+        self.notebooks = find_pipeline_notebooks(self.path, notebook_pattern)
+        self.names = [notebook_file_name(notebook) for notebook in self.notebooks]
+        self.digests = []
+        self.declarations = []
+
+        for notebook, name in zip(self.notebooks, self.names):
+            source_bytes = read_notebook_source_bytes(notebook)
+            self.digests.append(hashlib.md5(source_bytes).hexdigest())
+            self.declarations.append(get_notebook_declarations(bytes_to_notebook(source_bytes), name))
+
+        self.config_digest = hashlib.md5(b"".join(pth.read_bytes() for pth in self.config_files())).hexdigest()
+        self.input_files = [self.input_files_of(declarations) for declarations in self.declarations]
+
+    def config_files(self):
+        if self.path.is_dir():
+            return [self.path / name for name in CONFIG_FILES if (self.path / name).exists()]
+        return [] #the config of a zipped pipeline is covered by the zip
+
+    def input_files_of(self, declarations):
+        #__input_files__ = ['raw.csv', ...], relative to the pipeline dir (or the dir of a zip)
+        base = self.path if self.path.is_dir() else self.path.parent
+        return [(base / input_file).absolute() for input_file in declarations.get('__input_files__', [])]
+
+    def watched_files(self):
+        if self.path.is_dir():
+            files = [notebook for notebook in self.notebooks if not isinstance(notebook, ZipFileTuple)]
+            files += [self.path / name for name in CONFIG_FILES]
+        else:
+            files = [self.path]
+
+        for input_files in self.input_files:
+            files.extend(input_files)
+
+        return files
+
+    def changed_since(self, previous, changed_files=()):
+        """Indices of the notebooks to re-run because of this state, compared to previous."""
+        if self.names != previous.names or self.config_digest != previous.config_digest:
+            return set(range(len(self.notebooks)))
+
+        changed = set(index for index, digest in enumerate(self.digests) if digest != previous.digests[index])
+
+        for index, input_files in enumerate(self.input_files):
+            if set(input_files) & set(changed_files):
+                changed.add(index)
+
+        return changed
+
+
+def stat_files(files):
+    #cheap fingerprint: the notebooks are only hashed again when it changes
+    stats = {}
+    for pth in files:
+        try:
+            stat = pth.stat()
+            stats[pth] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            stats[pth] = None
+    return stats
+
+
+class PipelineWatcher(object):
+    """Re-runs the notebooks affected by changes of a pipeline source and its input files.
+
+    Changes are debounced; a run still in flight when newer changes settle is
+    cancelled, and its unfinished notebooks are run again with the new ones.
+    """
+
+    def __init__(self, path, output_dir, cmdline_args=(), config=None, debounce=1.0, poll_interval=0.5, log=None):
+        self.path = Path(str(path)).absolute()
+        self.output_dir = Path(str(output_dir)).absolute()
+        self.cmdline_args = tuple(cmdline_args)
+        self.config = config or Config()
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.log = log or logging.getLogger(__name__)
+
+        self.state = SourceState(self.path)
+        self.stats = stat_files(self.state.watched_files())
+        #notebook names selected for a run and not executed yet
+        self.pending = set()
+        self.pipeline = None
+        self._thread = None
+
+    def outdated_notebooks(self):
+        #notebooks changed since the last run into the output dir, as ipype plan sees them
+        plans = plan_pipeline(self.state.notebooks, self.output_dir / 'exec_notebooks')
+        return [plan.index for plan in plans if plan.action == RUN]
+
+    def poll(self):
+        """Indices of the notebooks changed since the last poll (empty if none)."""
+        stats = stat_files(self.state.watched_files())
+        if stats == self.stats:
+            return set()
+
+        changed_files = [pth for pth in set(stats) | set(self.stats) if stats.get(pth) != self.stats.get(pth)]
+        self.stats = stats
+
+        try:
+            state = SourceState(self.path)
+        except Exception as e:
+            #e.g. a notebook caught in the middle of being saved
+            self.log.warning("Could not read the pipeline: {}".format(e))
+            self.stats = {}
+            return set()
+
+        changed = state.changed_since(self.state, changed_files)
+        self.state = state
+        #input files declared by the changed notebooks are watched from now on
+        self.stats = stat_files(self.state.watched_files())
+
+        return changed
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def cancel_run(self):
+        if not self.running:
+            return
+        self.log.info("Cancelling the running notebooks")
+        self.pipeline.cancel()
+        self._thread.join()
+
+    def start_run(self, changed):
+        self.cancel_run()
+
+        affected = downstream_notebooks(self.state.declarations, changed)
+        names = [self.state.names[index] for index in affected]
+        self.pending = set(name for name in self.pending if name in self.state.names) | set(names)
+
+        selected = [name for name in self.state.names if name in self.pending]
+        self.log.info("Running {}".format(", ".join(selected)))
+
+        try:
+            pipeline = self.make_pipeline(selected)
+        except Exception as e:
+            self.log.error("Run failed: {}".format(e))
+            return
+
+        #assigned before the run starts, so that cancel_run always cancels the run in flight
+        self.pipeline = pipeline
+        self._thread = threading.Thread(target=self.run, args=(pipeline, selected), name='ipype-watch-run', daemon=True)
+        self._thread.start()
+
+    def make_pipeline(self, selected):
+        from ipype.pipeline import IPypeApp, Pipeline
+
+        c = Config()
+        c.merge(self.config)
+        c.Pipeline.path = str(self.path)
+        c.Pipeline.output_dir = str(self.output_dir)
+        c.Pipeline.cmdline_args = self.cmdline_args
+        c.Pipeline.only = selected
+
+        app = IPypeApp(config=c, log=self.log)
+        app.pipeline = Pipeline(config=app.config, parent=app)
+        return app.pipeline
+
+    def run(self, pipeline, selected):
+        try:
+            pipeline.initialize()
+            pipeline.start()
+            self.log.info("Finished {}".format(", ".join(selected)))
+        except Exception as e:
+            if pipeline.cancelled:
+                self.log.info("Cancelled")
+            else:
+                self.log.error("Run failed: {}".format(e))
+        finally:
+            registry = getattr(pipeline, 'registry', None)
+            if registry is not None:
+                self.pending -= set(record.name for record in registry if record.status == EXECUTED)
+
+    def watch(self, initial=True, stop=None):
+        """Poll until stop (a threading.Event) is set; with initial, first run the outdated notebooks."""
+        stop = stop or threading.Event()
+
+        if initial:
+            outdated = self.outdated_notebooks()
+            if outdated:
+                self.start_run(outdated)
+            else:
+                self.log.info("{} is up to date".format(str(self.output_dir)))
+
+        changed = set()
+        last_change = None
+
+        try:
+            while not stop.wait(self.poll_interval):
+                new_changes = self.poll()
+                if new_changes:
+                    changed |= new_changes
+                    last_change = time.monotonic()
+                    continue
+
+                if changed and time.monotonic() - last_change >= self.debounce:
+                    self.start_run(changed)
+                    changed = set()
+        finally:
+            self.cancel_run()